@@ -1,17 +1,29 @@
 from fastapi import FastAPI, HTTPException, Request, Depends, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import RedirectResponse, JSONResponse
+from fastapi.responses import RedirectResponse, JSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
-from pymongo import MongoClient
+from pymongo import MongoClient, InsertOne, UpdateOne, DeleteOne, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from datetime import datetime, timedelta
+from collections import OrderedDict, deque
+from abc import ABC, abstractmethod
 import uuid
 import os
+import hashlib
+import random
 import secrets
+import time
+import threading
+import zlib
 from typing import List, Optional, Dict, Any
 from dotenv import load_dotenv
 from emergentintegrations.llm.chat import LlmChat, UserMessage
 import asyncio
 import json
+from contextlib import asynccontextmanager
+import numpy as np
+import math
+import bisect
 
 # Google Calendar imports
 from google.auth.transport.requests import Request as GoogleRequest
@@ -29,6 +41,8 @@ import base64
 from pathlib import Path
 import sqlite3
 import aiohttp
+import httpx
+import re
 
 # Google Sheets imports
 import gspread
@@ -58,6 +72,8 @@ app.add_middleware(
 MONGO_URL = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
 DB_NAME = os.environ.get('DB_NAME', 'yahel_department_db')
 OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY')
+OPENAI_BASE_URL = os.environ.get('OPENAI_BASE_URL', 'https://api.openai.com/v1')
+AI_CHAT_MODEL = os.environ.get('AI_CHAT_MODEL', 'gpt-4o-mini')
 GOOGLE_SHEETS_CREDENTIALS = os.environ.get('GOOGLE_SHEETS_CREDENTIALS', '/app/backend/google_sheets_credentials.json')
 
 # JWT Authentication settings
@@ -110,6 +126,137 @@ notification_history_collection = db.notification_history  # Store notification
 authenticated_users_collection = db.authenticated_users  # Store user authentication data
 user_sessions_collection = db.user_sessions  # Store active user sessions
 
+# Collections - Equipment Usage
+equipment_hour_readings_collection = db.equipment_hour_readings  # Time-series hour meter readings
+equipment_usage_daily_collection = db.equipment_usage_daily  # Pre-aggregated daily usage buckets
+
+# Collections - Caching
+data_versions_collection = db.data_versions  # Per-user, per-table data versions for cache invalidation
+
+# Collections - Configuration
+service_intervals_collection = db.service_intervals  # Service interval tables by system type
+
+# Collections - Background Jobs
+scheduler_locks_collection = db.scheduler_locks  # Leader lock so only one worker runs scheduled jobs
+alert_events_collection = db.alert_events  # Alert level / due status transitions for notifications
+
+# Collections - AI Chat
+chat_session_summaries_collection = db.chat_session_summaries  # Rolling extractive summary of older turns per chat session
+ai_action_jobs_collection = db.ai_action_jobs  # Actions from AI replies, one job per chat record and action index
+
+# Collections - AI Chat Metrics
+chat_intent_stats_collection = db.chat_intent_stats  # Daily message counts per chat intent (answered without the LLM or not)
+llm_usage_daily_collection = db.llm_usage_daily  # Per-user daily rollup of LLM calls, tokens and latency
+
+# Buffered Log Writes
+# Append-only records (chat turns, notification log) are collected in memory and
+# written with insert_many once LOG_BUFFER_MAX_DOCS are waiting or every
+# LOG_BUFFER_FLUSH_SECONDS, and on shutdown. Readers that need a record right
+# after it was written merge pending() into their query results.
+LOG_BUFFER_MAX_DOCS = int(os.environ.get('LOG_BUFFER_MAX_DOCS', '50'))
+LOG_BUFFER_FLUSH_SECONDS = float(os.environ.get('LOG_BUFFER_FLUSH_SECONDS', '1'))
+LOG_BUFFER_MAX_PENDING = 10000  # Oldest records are dropped beyond this while the database is unavailable
+
+class BufferedWriter:
+    """Buffers inserts for one collection. Until start() is called (no running
+    app, e.g. scripts) every add() is written immediately"""
+
+    def __init__(self, name: str, collection, on_flush=None, max_docs: int = LOG_BUFFER_MAX_DOCS,
+                 flush_seconds: float = LOG_BUFFER_FLUSH_SECONDS):
+        self.name = name
+        self.collection = collection
+        self.on_flush = on_flush  # Called with each written batch, in the flushing thread
+        self.max_docs = max_docs
+        self.flush_seconds = flush_seconds
+        self._buffer = []
+        self._in_flight = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # One insert_many at a time keeps records in order
+        self._task = None
+        self.flushed = 0
+        self.dropped = 0
+
+    def add(self, document: dict):
+        if self._task is None:
+            self._write([document])
+            return
+        with self._lock:
+            self._buffer.append(document)
+            full = len(self._buffer) >= self.max_docs
+        if full:
+            try:
+                asyncio.get_running_loop().run_in_executor(None, self.flush)
+            except RuntimeError:
+                self.flush()
+
+    def pending(self, predicate) -> List[dict]:
+        """Buffered records (oldest first) that are not in the database yet"""
+        with self._lock:
+            return [dict(document) for document in self._in_flight + self._buffer if predicate(document)]
+
+    def flush(self) -> int:
+        with self._flush_lock:
+            with self._lock:
+                batch = self._buffer
+                self._buffer = []
+                self._in_flight = batch
+            try:
+                return self._write(batch)
+            except Exception as e:
+                print(f"Error flushing {self.name} log buffer, keeping {len(batch)} records: {e}")
+                with self._lock:
+                    self._buffer = batch + self._buffer
+                    overflow = len(self._buffer) - LOG_BUFFER_MAX_PENDING
+                    if overflow > 0:
+                        del self._buffer[:overflow]
+                        self.dropped += overflow
+                return 0
+            finally:
+                with self._lock:
+                    self._in_flight = []
+
+    def _write(self, batch: List[dict]) -> int:
+        if not batch:
+            return 0
+        try:
+            # insert_many adds _id to the documents; readers of pending() never see it
+            self.collection.insert_many([dict(document) for document in batch], ordered=False)
+        except BulkWriteError as e:
+            # Duplicate ids were already written by an earlier flush - the rest went in
+            if any(error.get('code') != 11000 for error in e.details.get('writeErrors', [])):
+                raise
+        self.flushed += len(batch)
+        if self.on_flush:
+            try:
+                self.on_flush(batch)
+            except Exception as e:
+                print(f"Error after flushing {self.name} log buffer: {e}")
+        return len(batch)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_seconds)
+            if self._buffer:
+                await asyncio.to_thread(self.flush)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await asyncio.to_thread(self.flush)
+
+    def metrics(self) -> dict:
+        return {"buffered": len(self._buffer), "flushed": self.flushed, "dropped": self.dropped}
+
+chat_log_writer = BufferedWriter("ai_chat_history", ai_chat_history_collection,
+                                 on_flush=lambda batch: update_flushed_session_summaries(batch))
+notification_log_writer = BufferedWriter("notification_history", notification_history_collection)
+buffered_writers = [chat_log_writer, notification_log_writer]
+
 # Pydantic Models - Department Management
 
 class ActiveFailure(BaseModel):
@@ -149,6 +296,7 @@ class PendingMaintenance(BaseModel):
     last_performed: str  # תאריך ביצוע אחרון
     next_due: str = None  # תאריך ביצוע הבא - מחושב אוטומטית
     days_until_due: int = None  # ימים עד ביצוע - מחושב
+    due_status: str = None  # באיחור, מתקרב, בזמן - מחושב
     status: str = "ממתין"  # ממתין, בביצוע, הושלם
     created_at: str = None
 
@@ -161,6 +309,9 @@ class EquipmentHours(BaseModel):
     hours_until_service: float = None  # שעות עד טיפול - מחושב
     alert_level: str = None  # ירוק, כתום, אדום
     last_service_date: str = None
+    last_reading_at: str = None  # זמן קריאת המונה האחרונה
+    usage_rate_per_day: float = None  # קצב שימוש (שעות ליום) - מחושב מקריאות
+    predicted_service_date: str = None  # תאריך משוער לטיפול הבא - מחושב
     created_at: str = None
 
 class DailyWorkPlan(BaseModel):
@@ -175,6 +326,19 @@ class DailyWorkPlan(BaseModel):
     notes: str = ""
     created_at: str = None
 
+class HourReading(BaseModel):
+    equipment_id: str
+    hours: float  # קריאת מונה שעות
+    timestamp: Optional[str] = None  # ISO format, default now
+
+class HourReadingsBatch(BaseModel):
+    readings: List[HourReading]
+
+class ServiceIntervalTable(BaseModel):
+    system_type: str  # מנועים, תשלובות, גנרטורים, מדחסים
+    intervals: List[float]  # שעות טיפול
+    updated_at: str = None
+
 # Pydantic Models - Leadership Coaching
 
 class Conversation(BaseModel):
@@ -212,12 +376,17 @@ class NinetyDayPlan(BaseModel):
 class ChatMessage(BaseModel):
     user_message: str
     session_id: Optional[str] = None
-    chat_history: List[dict] = []
+    chat_history: List[dict] = []  # Deprecated - history is loaded server-side by session_id
     user_id: Optional[str] = None  # Will be set by the endpoint
+    client_message_id: Optional[str] = None  # Sent again on retries, so the message is answered and executed once
 
 class ChatResponse(BaseModel):
     response: str
     updated_tables: List[str] = []
+    context_tokens: int = 0  # Tokens used by the data context in the system prompt
+    intent: Optional[str] = None  # Set when the message was answered without the LLM
+    chat_id: Optional[str] = None  # Chat record id, for the action status endpoint
+    pending_actions: int = 0  # Actions still executing in the background
 
 class ExportRequest(BaseModel):
     table_name: str
@@ -235,6 +404,7 @@ class User(BaseModel):
     email: str
     name: str
     google_id: Optional[str] = None
+    preferred_name: Optional[str] = None  # Name Jessica uses for the user, captured from chat
     created_at: str = None
     last_login: str = None
     is_active: bool = True
@@ -434,9 +604,22 @@ def calculate_maintenance_dates(maintenance: dict):
         
         maintenance['next_due'] = next_date.isoformat()[:10]
         maintenance['days_until_due'] = days_until
+        maintenance['due_status'] = maintenance_due_status(days_until)
     
     return maintenance
 
+MAINTENANCE_DUE_SOON_DAYS = 7
+
+def maintenance_due_status(days_until_due: Optional[int]) -> Optional[str]:
+    """Get due status for a maintenance item: באיחור, מתקרב or בזמן"""
+    if days_until_due is None:
+        return None
+    if days_until_due <= 0:
+        return "באיחור"
+    if days_until_due <= MAINTENANCE_DUE_SOON_DAYS:
+        return "מתקרב"
+    return "בזמן"
+
 # Push Notification Management Classes
 class VAPIDKeyManager:
     def __init__(self, private_key_path: str = "vapid_private_key.pem", public_key_path: str = "vapid_public_key.pem"):
@@ -606,7 +789,36 @@ class PushNotificationService:
             "delivery_timestamp": datetime.now().isoformat(),
             "error_message": error_message
         }
-        notification_history_collection.insert_one(log_entry)
+        notification_log_writer.add(log_entry)
+
+    async def deliver_alert_events(self, limit: int = 200):
+        """Consume pending alert transition events and notify users about escalations"""
+        events = list(alert_events_collection.find({"delivered": False}, {"_id": 0}).sort("created_at", 1).limit(limit))
+        sent = 0
+        for event in events:
+            if not event.get("escalation") or not event.get("user_id"):
+                continue
+            if event["entity_type"] == "equipment":
+                title = "⚠️ התראת שעות מכלול"
+                body = f"{event['system']}: רמת ההתראה עלתה מ{event['previous']} ל{event['current']}"
+            else:
+                title = "🔧 תזכורת אחזקה"
+                body = f"{event['system']}: סטטוס האחזקה השתנה ל{event['current']}"
+            await self.send_notification(
+                user_id=event["user_id"],
+                title=title,
+                body=body,
+                category="maintenance_reminders",
+                data={"type": "alert_event", "entity_type": event["entity_type"], "entity_id": event["entity_id"]}
+            )
+            sent += 1
+
+        if events:
+            alert_events_collection.update_many(
+                {"id": {"$in": [event["id"] for event in events]}},
+                {"$set": {"delivered": True, "delivered_at": datetime.now().isoformat()}}
+            )
+        return {"events": len(events), "notifications": sent}
 
 # Initialize services
 push_service = PushNotificationService()
@@ -667,6 +879,60 @@ def create_user_session(user_id: str, session_token: str):
     user_sessions_collection.insert_one(session_data)
     return session_data
 
+USER_CACHE_SECONDS = int(os.environ.get('USER_CACHE_SECONDS', '60'))
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', '1000'))
+
+class UserCache:
+    """Short-lived LRU cache of active user documents, so each request doesn't hit authenticated_users.
+
+    The cache is per process: a user deactivated directly in the database stays
+    authenticated on workers that cached them for up to USER_CACHE_SECONDS.
+    Changes made through the API invalidate the entry in the serving process.
+    """
+
+    def __init__(self, ttl_seconds: int = USER_CACHE_SECONDS, max_size: int = USER_CACHE_SIZE):
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self._entries = OrderedDict()
+
+    def get(self, user_id: str) -> Optional[dict]:
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        loaded_at, user = entry
+        if (datetime.now() - loaded_at).total_seconds() >= self.ttl_seconds:
+            del self._entries[user_id]
+            return None
+        self._entries.move_to_end(user_id)
+        return user
+
+    def set(self, user_id: str, user: dict):
+        self._entries[user_id] = (datetime.now(), user)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: str = None):
+        if user_id is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(user_id, None)
+
+user_cache = UserCache()
+
+def set_preferred_name(user_id: str, preferred_name: str):
+    """Store the name the user wants Jessica to use on their profile"""
+    authenticated_users_collection.update_one(
+        {"id": user_id},
+        {"$set": {
+            "preferred_name": preferred_name,
+            "preferred_name_checked": True,
+            "preferred_name_updated_at": datetime.now().isoformat()
+        }}
+    )
+    user_cache.invalidate(user_id)
+    print(f"Stored preferred name for user {user_id}: {preferred_name}")
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     """Get the current authenticated user"""
     credentials_exception = HTTPException(
@@ -691,12 +957,30 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
         raise credentials_exception
     
     # Check if user exists and is active
-    user = authenticated_users_collection.find_one({"id": user_id, "is_active": True}, {"_id": 0})
-    if user is None:
+    user = user_cache.get(user_id)
+    if user is not None and not user.get('is_active', False):
+        user_cache.invalidate(user_id)
         raise credentials_exception
+    if user is None:
+        user = authenticated_users_collection.find_one({"id": user_id, "is_active": True}, {"_id": 0})
+        if user is None:
+            raise credentials_exception
+        user_cache.set(user_id, user)
     
     return user
 
+ADMIN_EMAILS = {email.strip().lower() for email in os.environ.get('ADMIN_EMAILS', '').split(',') if email.strip()}
+
+def is_admin_user(user: dict) -> bool:
+    """Admins have is_admin on their profile or are listed in ADMIN_EMAILS"""
+    return bool(user.get('is_admin')) or (user.get('email') or '').lower() in ADMIN_EMAILS
+
+async def get_current_admin(current_user = Depends(get_current_user)):
+    """Get the current user, who must be an admin (for settings shared by all users)"""
+    if not is_admin_user(current_user):
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return current_user
+
 async def get_current_user_optional(credentials: HTTPAuthorizationCredentials = Depends(security)):
     """Get the current user if authenticated, None otherwise"""
     if not credentials:
@@ -707,46 +991,489 @@ async def get_current_user_optional(credentials: HTTPAuthorizationCredentials =
     except HTTPException:
         return None
 
+# Service interval engine
+# Default service intervals by system type. Overrides live in the service_intervals
+# collection ({"system_type": ..., "intervals": [...]}) and are shared by all users.
+# They are cached in memory per process and reloaded when the global
+# "service_intervals" data version changes, so every worker sees an update.
+DEFAULT_SERVICE_INTERVALS = {
+    'מנועים': [250, 500, 1500, 3000, 6000],
+    'תשלובות': [500, 1000, 6000],
+    'גנרטורים': [400, 2000, 6000, 18000],
+    'מדחסים': [200, 600, 6000]
+}
+FALLBACK_SERVICE_INTERVALS = [500, 1000, 5000]
+SERVICE_INTERVALS_CHECK_SECONDS = int(os.environ.get('SERVICE_INTERVALS_CHECK_SECONDS', '5'))
+GLOBAL_VERSION_ID = "__global__"  # data_versions document for settings shared by all users
+
+class ServiceIntervalEngine:
+    """Table-driven service interval calculation, batched with NumPy"""
+
+    def __init__(self, collection, versions_collection=None, check_seconds: int = SERVICE_INTERVALS_CHECK_SECONDS):
+        self.collection = collection
+        self.versions_collection = versions_collection
+        self.check_seconds = check_seconds
+        self._tables = None
+        self._arrays = {}
+        self._version = None
+        self._checked_at = None
+
+    def invalidate(self):
+        """Drop the cached interval tables so the next call reloads them"""
+        self._tables = None
+        self._arrays = {}
+        self._version = None
+        self._checked_at = None
+
+    def _current_version(self) -> int:
+        if self.versions_collection is None:
+            return 0
+        try:
+            doc = self.versions_collection.find_one({"user_id": GLOBAL_VERSION_ID}, {"_id": 0, "versions.service_intervals": 1})
+            return ((doc or {}).get("versions") or {}).get("service_intervals", 0)
+        except Exception as e:
+            print(f"Error reading service intervals version: {e}")
+            return self._version or 0
+
+    def get_tables(self) -> Dict[str, List[float]]:
+        """Get interval tables (defaults merged with configured overrides)"""
+        now = datetime.now()
+        if self._tables is not None and (now - self._checked_at).total_seconds() < self.check_seconds:
+            return self._tables
+        version = self._current_version()
+        self._checked_at = now
+        if self._tables is not None and version == self._version:
+            return self._tables
+
+        tables = {key: list(value) for key, value in DEFAULT_SERVICE_INTERVALS.items()}
+        try:
+            for doc in (self.collection.find({}, {"_id": 0}) if self.collection is not None else []):
+                intervals = sorted(doc.get('intervals') or [])
+                if doc.get('system_type') and intervals:
+                    tables[doc['system_type'].lower()] = intervals
+        except Exception as e:
+            print(f"Error loading service intervals, using defaults: {e}")
+
+        self._tables = tables
+        self._arrays = {key: self._table_arrays(value) for key, value in tables.items()}
+        self._version = version
+        return tables
+
+    @staticmethod
+    def _table_arrays(intervals: List[float]) -> tuple:
+        """Interval boundaries, next-service values (one extra cycle past the last
+        interval) and whether each value is an int, so results keep the table's types"""
+        values = list(intervals) + [intervals[-1] + intervals[-1]]
+        return (
+            np.asarray(intervals, dtype=np.float64),
+            np.asarray(values, dtype=np.float64),
+            np.asarray([isinstance(value, int) for value in values], dtype=bool)
+        )
+
+    @staticmethod
+    def _as_python_numbers(values: np.ndarray, is_int: np.ndarray) -> list:
+        if is_int.all():
+            return values.astype(np.int64).tolist()
+        if not is_int.any():
+            return values.tolist()
+        return [int(value) if integer else value for value, integer in zip(values.tolist(), is_int.tolist())]
+
+    def calculate_batch(self, equipment_items: List[dict]) -> List[dict]:
+        """Calculate next service hours and alert level for many items in one pass"""
+        if not equipment_items:
+            return equipment_items
+
+        tables = self.get_tables()
+        count = len(equipment_items)
+
+        # Code each row by its interval table, so each table is searched once for its rows
+        system_types = [item['system_type'] for item in equipment_items]
+        table_keys = {}
+        row_codes = {}
+        for system_type in set(system_types):
+            row_codes[system_type] = table_keys.setdefault(system_type.lower(), len(table_keys))
+        codes = np.fromiter(map(row_codes.__getitem__, system_types), dtype=np.intp, count=count)
+
+        current_hours = [item['current_hours'] for item in equipment_items]
+        hours_array = np.asarray(current_hours, dtype=np.float64)
+        next_service = np.empty(count, dtype=np.float64)
+        int_next = np.empty(count, dtype=bool)
+        for system_type, code in table_keys.items():
+            arrays = self._arrays.get(system_type)
+            if arrays is None:
+                arrays = self._table_arrays(tables.get(system_type, FALLBACK_SERVICE_INTERVALS))
+            interval_array, next_values, next_is_int = arrays
+            rows = np.flatnonzero(codes == code) if len(table_keys) > 1 else slice(None)
+            # First interval strictly greater than the current hours;
+            # past the last interval - add another full cycle
+            positions = np.searchsorted(interval_array, hours_array[rows], side='right')
+            next_service[rows] = next_values[positions]
+            int_next[rows] = next_is_int[positions]
+        hours_until = next_service - hours_array
+
+        # Alert levels
+        alert_levels = np.where(
+            hours_until <= 10, "אדום",
+            np.where(hours_until <= 50, "כתום", "ירוק")
+        )
+
+        # Days until service at the forecast usage rate
+        rates = np.asarray([item.get('usage_rate_per_day') or 0.0 for item in equipment_items], dtype=np.float64)
+        if rates.any():
+            days_list = np.divide(hours_until, rates, out=np.full(count, np.nan), where=rates > 0).tolist()
+        else:
+            days_list = [None] * count
+
+        # Results are ints when the interval and the current hours are ints, as in the table
+        int_until = int_next & np.fromiter((type(hours) is int for hours in current_hours), dtype=bool, count=count)
+        next_list = self._as_python_numbers(next_service, int_next)
+        until_list = self._as_python_numbers(hours_until, int_until)
+
+        for item, next_hours, until, alert_level, days in zip(equipment_items, next_list, until_list, alert_levels.tolist(), days_list):
+            item['next_service_hours'] = next_hours
+            item['hours_until_service'] = until
+            item['alert_level'] = alert_level
+            item['predicted_service_date'] = predict_service_date(item.get('last_reading_at'), days) if days is not None else None
+
+        return equipment_items
+
+service_interval_engine = ServiceIntervalEngine(service_intervals_collection, data_versions_collection)
+
+def predict_service_date(last_reading_at: Optional[str], days_until_service: float) -> Optional[str]:
+    """Calendar date when the next service is reached, counted from the last reading"""
+    if days_until_service != days_until_service:  # NaN - no usage rate
+        return None
+    try:
+        anchor = datetime.fromisoformat(last_reading_at) if last_reading_at else datetime.now()
+    except ValueError:
+        anchor = datetime.now()
+    return (anchor + timedelta(days=min(max(days_until_service, 0.0), 3650))).isoformat()[:10]
+
 def calculate_service_hours(equipment: dict):
     """Calculate next service hours and alert level based on system type"""
-    system_type = equipment['system_type'].lower()
-    current_hours = equipment['current_hours']
-    
-    # Service intervals by system type
-    intervals = {
-        'מנועים': [250, 500, 1500, 3000, 6000],
-        'תשלובות': [500, 1000, 6000], 
-        'גנרטורים': [400, 2000, 6000, 18000],
-        'מדחסים': [200, 600, 6000]
+    return service_interval_engine.calculate_batch([equipment])[0]
+
+def calculate_service_hours_batch(equipment_items: List[dict]):
+    """Calculate service hours for a list of equipment items in one call"""
+    return service_interval_engine.calculate_batch(equipment_items)
+
+# Equipment Hour Readings (time-series)
+def ensure_hour_readings_collection():
+    """Create the hour readings time-series collection, bucketed per equipment"""
+    try:
+        if "equipment_hour_readings" not in db.list_collection_names():
+            db.create_collection(
+                "equipment_hour_readings",
+                timeseries={"timeField": "timestamp", "metaField": "meta", "granularity": "hours"}
+            )
+        equipment_hour_readings_collection.create_index([("meta.equipment_id", 1), ("timestamp", -1)])
+        equipment_usage_daily_collection.create_index([("equipment_id", 1), ("day", 1)], unique=True)
+        equipment_usage_daily_collection.create_index([("user_id", 1), ("day", 1)])
+    except Exception as e:
+        print(f"Error creating hour readings collection: {e}")
+
+def parse_reading_timestamp(timestamp: Optional[str]) -> datetime:
+    """Parse an ISO reading timestamp into a naive local datetime"""
+    if not timestamp:
+        return datetime.now()
+    parsed = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+    if parsed.tzinfo:
+        parsed = parsed.astimezone().replace(tzinfo=None)
+    return parsed
+
+def store_hour_readings(user_id: str, readings: List[tuple], source: str = "manual"):
+    """Store (equipment_id, hours, timestamp) readings and update the daily usage buckets"""
+    if not readings:
+        return 0
+
+    documents = []
+    buckets = {}
+    for equipment_id, hours, timestamp in readings:
+        documents.append({
+            "timestamp": timestamp,
+            "meta": {"equipment_id": equipment_id, "user_id": user_id},
+            "hours": hours,
+            "source": source
+        })
+        key = (equipment_id, timestamp.isoformat()[:10])
+        bucket = buckets.setdefault(key, {"min_hours": hours, "max_hours": hours, "readings": 0})
+        bucket["min_hours"] = min(bucket["min_hours"], hours)
+        bucket["max_hours"] = max(bucket["max_hours"], hours)
+        bucket["readings"] += 1
+
+    equipment_hour_readings_collection.insert_many(documents, ordered=False)
+    equipment_usage_daily_collection.bulk_write([
+        UpdateOne(
+            {"equipment_id": equipment_id, "day": day},
+            {
+                "$min": {"min_hours": bucket["min_hours"]},
+                "$max": {"max_hours": bucket["max_hours"]},
+                "$inc": {"readings": bucket["readings"]},
+                "$setOnInsert": {"user_id": user_id}
+            },
+            upsert=True
+        )
+        for (equipment_id, day), bucket in buckets.items()
+    ], ordered=False)
+    refresh_usage_forecasts({equipment_id for equipment_id, _ in buckets})
+    bump_data_version(user_id, 'equipment')
+    return len(documents)
+
+def ingest_hour_readings(user_id: str, readings: List[dict], source: str = "api"):
+    """Ingest a batch of hour readings and advance current_hours on the equipment"""
+    equipment_ids = list({reading['equipment_id'] for reading in readings})
+    equipment_items = {
+        item['id']: item for item in equipment_hours_collection.find(
+            {"id": {"$in": equipment_ids}, "user_id": user_id},
+            {"_id": 0}
+        )
     }
-    
-    # Find next service interval
-    service_intervals = intervals.get(system_type, [500, 1000, 5000])
-    next_service = None
-    
-    for interval in service_intervals:
-        if current_hours < interval:
-            next_service = interval
-            break
-    
-    if not next_service:
-        next_service = service_intervals[-1] + service_intervals[-1]  # Add another full cycle
-    
-    hours_until = next_service - current_hours
-    
-    # Alert levels
-    if hours_until <= 10:
-        alert_level = "אדום"
-    elif hours_until <= 50:
-        alert_level = "כתום"
-    else:
-        alert_level = "ירוק"
-    
-    equipment['next_service_hours'] = next_service
-    equipment['hours_until_service'] = hours_until
-    equipment['alert_level'] = alert_level
-    
-    return equipment
+
+    accepted = []
+    rejected = []
+    for reading in readings:
+        try:
+            timestamp = parse_reading_timestamp(reading.get('timestamp'))
+        except ValueError:
+            rejected.append({"equipment_id": reading['equipment_id'], "reason": "invalid timestamp"})
+            continue
+        if reading['equipment_id'] not in equipment_items:
+            rejected.append({"equipment_id": reading['equipment_id'], "reason": "equipment not found"})
+        elif reading['hours'] < 0:
+            rejected.append({"equipment_id": reading['equipment_id'], "reason": "negative hours"})
+        else:
+            accepted.append((reading['equipment_id'], float(reading['hours']), timestamp))
+
+    # Latest reading per equipment becomes the current meter value
+    latest = {}
+    for equipment_id, hours, timestamp in accepted:
+        if equipment_id not in latest or timestamp >= latest[equipment_id][1]:
+            latest[equipment_id] = (hours, timestamp)
+
+    changed = []
+    for equipment_id, (hours, timestamp) in latest.items():
+        item = equipment_items[equipment_id]
+        if item.get('last_reading_at') and item['last_reading_at'] > timestamp.isoformat():
+            continue
+        item['current_hours'] = hours
+        item['last_reading_at'] = timestamp.isoformat()
+        changed.append(item)
+
+    calculate_service_hours_batch(changed)
+    if changed:
+        equipment_hours_collection.bulk_write([
+            UpdateOne({"id": item['id'], "user_id": user_id}, {"$set": {
+                "current_hours": item['current_hours'],
+                "last_reading_at": item['last_reading_at'],
+                "next_service_hours": item['next_service_hours'],
+                "hours_until_service": item['hours_until_service'],
+                "alert_level": item['alert_level']
+            }})
+            for item in changed
+        ], ordered=False)
+        bump_data_version(user_id, 'equipment')
+
+    # After current_hours moved, so the refreshed forecast starts from the new value
+    store_hour_readings(user_id, accepted, source)
+
+    return {"accepted": len(accepted), "rejected": rejected, "equipment_updated": len(changed)}
+
+def get_equipment_usage(user_id: str, equipment_ids: List[str] = None, interval: str = "day", days: int = 30):
+    """Get usage per day or week from the pre-aggregated daily buckets"""
+    start_day = (datetime.now() - timedelta(days=days)).isoformat()[:10]
+    query = {"user_id": user_id, "day": {"$gte": start_day}}
+    if equipment_ids is not None:
+        query["equipment_id"] = {"$in": equipment_ids}
+
+    per_equipment = {}
+    for bucket in equipment_usage_daily_collection.find(query, {"_id": 0}).sort("day", 1):
+        if interval == "week":
+            # Israeli work week starts on Sunday
+            day = datetime.fromisoformat(bucket['day'])
+            period = (day - timedelta(days=(day.weekday() + 1) % 7)).isoformat()[:10]
+        else:
+            period = bucket['day']
+
+        periods = per_equipment.setdefault(bucket['equipment_id'], {})
+        current = periods.setdefault(period, {"period": period, "min_hours": bucket['min_hours'], "max_hours": bucket['max_hours'], "readings": 0})
+        current["min_hours"] = min(current["min_hours"], bucket['min_hours'])
+        current["max_hours"] = max(current["max_hours"], bucket['max_hours'])
+        current["readings"] += bucket.get('readings', 0)
+
+    usage = {}
+    for equipment_id, periods in per_equipment.items():
+        series = []
+        previous_max = None
+        for period in periods.values():
+            # Usage is the meter advance since the previous period's last reading
+            start_hours = previous_max if previous_max is not None else period["min_hours"]
+            period["usage_hours"] = round(max(0.0, period["max_hours"] - start_hours), 2)
+            previous_max = period["max_hours"]
+            series.append(period)
+        usage[equipment_id] = series
+    return usage
+
+# Usage Rate Forecasting
+FORECAST_WINDOW_DAYS = int(os.environ.get('FORECAST_WINDOW_DAYS', '30'))
+FORECAST_MIN_SPAN_DAYS = 1.0
+
+def fit_usage_rates(readings: List[dict]) -> Dict[str, tuple]:
+    """Least-squares hours-per-day slope for every equipment in one vectorized pass.
+
+    Returns {equipment_id: (rate or None, sample_count)}. A rate needs at least two
+    readings spanning FORECAST_MIN_SPAN_DAYS.
+    """
+    if not readings:
+        return {}
+
+    equipment_ids, groups = np.unique(
+        np.asarray([reading['meta']['equipment_id'] for reading in readings]),
+        return_inverse=True
+    )
+    origin = min(reading['timestamp'] for reading in readings)
+    x = np.asarray([(reading['timestamp'] - origin).total_seconds() / 86400 for reading in readings], dtype=float)
+    y = np.asarray([reading['hours'] for reading in readings], dtype=float)
+    count = len(equipment_ids)
+
+    n = np.bincount(groups, minlength=count).astype(float)
+    sum_x = np.bincount(groups, weights=x, minlength=count)
+    sum_y = np.bincount(groups, weights=y, minlength=count)
+    sum_xx = np.bincount(groups, weights=x * x, minlength=count)
+    sum_xy = np.bincount(groups, weights=x * y, minlength=count)
+
+    span_min = np.full(count, np.inf)
+    span_max = np.full(count, -np.inf)
+    np.minimum.at(span_min, groups, x)
+    np.maximum.at(span_max, groups, x)
+
+    denominator = n * sum_xx - sum_x * sum_x
+    valid = (n >= 2) & (span_max - span_min >= FORECAST_MIN_SPAN_DAYS) & (denominator > 0)
+    slopes = np.divide(n * sum_xy - sum_x * sum_y, denominator, out=np.zeros(count), where=valid)
+
+    return {
+        equipment_id: (round(max(float(slope), 0.0), 3) if is_valid else None, int(samples))
+        for equipment_id, slope, is_valid, samples in zip(equipment_ids.tolist(), slopes, valid, n)
+    }
+
+def refresh_usage_forecasts(equipment_ids: List[str]):
+    """Recompute the usage rate and the predicted service date for equipment that received new readings"""
+    if not equipment_ids:
+        return {}
+    start = datetime.now() - timedelta(days=FORECAST_WINDOW_DAYS)
+    readings = list(equipment_hour_readings_collection.find(
+        {"meta.equipment_id": {"$in": list(equipment_ids)}, "timestamp": {"$gte": start}},
+        {"_id": 0, "meta": 1, "timestamp": 1, "hours": 1}
+    ))
+    rates = fit_usage_rates(readings)
+    items = list(equipment_hours_collection.find(
+        {"id": {"$in": list(equipment_ids)}},
+        {"_id": 0, "id": 1, "system_type": 1, "current_hours": 1, "last_reading_at": 1}
+    ))
+    for item in items:
+        item['usage_rate_per_day'] = rates.get(item['id'], (None, 0))[0]
+    calculate_service_hours_batch([item for item in items if item.get('system_type') and item.get('current_hours') is not None])
+
+    updated_at = datetime.now().isoformat()
+    if items:
+        equipment_hours_collection.bulk_write([
+            UpdateOne({"id": item['id']}, {"$set": {
+                "usage_rate_per_day": item['usage_rate_per_day'],
+                "usage_rate_samples": rates.get(item['id'], (None, 0))[1],
+                "usage_rate_updated_at": updated_at,
+                "predicted_service_date": item.get('predicted_service_date')
+            }})
+            for item in items
+        ], ordered=False)
+    return rates
+
+# Due Window Queries
+def ensure_indexes():
+    """Create indexes used by list, due-window and background queries"""
+    try:
+        pending_maintenance_collection.create_index([("user_id", 1), ("next_due", 1)])
+        equipment_hours_collection.create_index([("user_id", 1), ("hours_until_service", 1)])
+        equipment_hours_collection.create_index([("user_id", 1), ("predicted_service_date", 1)])
+        equipment_hours_collection.create_index("id")
+        active_failures_collection.create_index([("user_id", 1), ("urgency", -1)])
+        daily_work_collection.create_index([("user_id", 1), ("date", 1)])
+        chat_intent_stats_collection.create_index([("date", 1), ("intent", 1)], unique=True)
+        ai_chat_history_collection.create_index([("session_id", 1), ("timestamp", 1)])
+        ai_chat_history_collection.create_index([("user_id", 1), ("timestamp", -1)])
+        chat_session_summaries_collection.create_index([("session_id", 1), ("user_id", 1)], unique=True)
+        llm_usage_daily_collection.create_index([("date", 1), ("user_id", 1)], unique=True)
+        ai_chat_history_collection.create_index([("prompt_tokens", -1)], sparse=True)
+        ai_action_jobs_collection.create_index("id", unique=True)
+        ai_action_jobs_collection.create_index([("chat_id", 1), ("index", 1)])
+        ai_action_jobs_collection.create_index([("status", 1), ("created_at", 1)])
+        ai_chat_history_collection.create_index("id", unique=True, sparse=True)
+    except Exception as e:
+        print(f"Error creating indexes: {e}")
+
+def get_due_items(user_id: str, within_days: int = 7, within_hours: float = 50):
+    """Get maintenance due within N days and equipment within H hours of service, ranked together.
+
+    Equipment is also due when its forecast service date (from the usage rate) falls
+    within N days, even if it is further than H hours away. Served from the indexed
+    next_due / hours_until_service / predicted_service_date fields, kept fresh by the
+    write paths and the recompute job (which also fills in missing forecast dates).
+    Completed maintenance is left out. Items are ranked by how far into their window
+    they are, so overdue maintenance and equipment past service come first.
+    """
+    today = datetime.now().date()
+    due_limit = (today + timedelta(days=within_days)).isoformat()
+
+    items = []
+    for item in pending_maintenance_collection.find(
+        {"user_id": user_id, "next_due": {"$lte": due_limit}, "status": {"$ne": "הושלם"}},
+        {"_id": 0, "id": 1, "maintenance_type": 1, "system": 1, "next_due": 1, "status": 1}
+    ):
+        days_until = (datetime.fromisoformat(item['next_due']).date() - today).days
+        items.append({
+            "type": "maintenance",
+            "id": item.get('id'),
+            "title": item.get('maintenance_type', ''),
+            "system": item.get('system', ''),
+            "status": item.get('status'),
+            "next_due": item['next_due'],
+            "days_until_due": days_until,
+            "due_status": maintenance_due_status(days_until),
+            "rank_score": days_until / max(within_days, 1)
+        })
+
+    for item in equipment_hours_collection.find(
+        {"user_id": user_id, "$or": [
+            {"hours_until_service": {"$lte": within_hours}},
+            {"predicted_service_date": {"$lte": due_limit}}
+        ]},
+        {"_id": 0, "id": 1, "system": 1, "system_type": 1, "current_hours": 1, "next_service_hours": 1,
+         "hours_until_service": 1, "alert_level": 1, "predicted_service_date": 1, "usage_rate_per_day": 1}
+    ):
+        if item.get('hours_until_service') is None:
+            continue
+        predicted = item.get('predicted_service_date')
+        days_until = (datetime.fromisoformat(predicted).date() - today).days if predicted else None
+
+        rank_score = item['hours_until_service'] / max(within_hours, 1)
+        if days_until is not None:
+            rank_score = min(rank_score, days_until / max(within_days, 1))
+        items.append({
+            "type": "equipment",
+            "id": item.get('id'),
+            "title": item.get('system_type', ''),
+            "system": item.get('system', ''),
+            "current_hours": item.get('current_hours'),
+            "next_service_hours": item.get('next_service_hours'),
+            "hours_until_service": item['hours_until_service'],
+            "alert_level": item.get('alert_level'),
+            "usage_rate_per_day": item.get('usage_rate_per_day'),
+            "predicted_service_date": predicted,
+            "days_until_service": days_until,
+            "due_by": "hours" if item['hours_until_service'] <= within_hours else "forecast",
+            "rank_score": rank_score
+        })
+
+    items.sort(key=lambda x: x['rank_score'])
+    return items
 
 def get_department_summary(user_id: str):
     """Get summary of all department data for AI analysis"""
@@ -759,8 +1486,10 @@ def get_department_summary(user_id: str):
         # Recalculate dynamic fields
         for item in maintenance:
             item = calculate_maintenance_dates(item)
+        calculate_service_hours_batch(equipment)
+        usage = get_equipment_usage(user_id, interval="day", days=7)
         for item in equipment:
-            item = calculate_service_hours(item)
+            item['usage_hours_7d'] = sum(period['usage_hours'] for period in usage.get(item.get('id'), []))
             
         return {
             "failures": failures,
@@ -794,34 +1523,451 @@ def get_leadership_context(user_id: str):
         print(f"Error getting leadership context: {e}")
         return {}
 
+# AI Context Builder
+AI_CONTEXT_TOKEN_BUDGET = int(os.environ.get('AI_CONTEXT_TOKEN_BUDGET', '3000'))
+TOKEN_ENCODING = os.environ.get('TOKEN_ENCODING', 'o200k_base')
+
+_token_encoder = None
+_token_encoder_loaded = False
+_token_encoder_lock = threading.Lock()
+
+def get_token_encoder():
+    """Load the tokenizer on first use. tiktoken may download the encoding file, so this
+    never runs at import; if loading fails the character-based estimate is used."""
+    global _token_encoder, _token_encoder_loaded
+    if _token_encoder_loaded:
+        return _token_encoder
+    with _token_encoder_lock:
+        if not _token_encoder_loaded:
+            try:
+                import tiktoken
+                _token_encoder = tiktoken.get_encoding(TOKEN_ENCODING)
+            except Exception as e:
+                print(f"Tokenizer unavailable, estimating tokens from characters: {e}")
+                _token_encoder = None
+            _token_encoder_loaded = True
+    return _token_encoder
+
+def estimate_tokens(text: str) -> int:
+    """Count tokens with the model tokenizer, or estimate them when it is unavailable"""
+    if not text:
+        return 0
+    token_encoder = get_token_encoder()
+    if token_encoder is not None:
+        return len(token_encoder.encode(text))
+    # Hebrew text averages roughly 3 characters per token
+    return math.ceil(len(text) / 3)
+
+def _context_value(value) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, list):
+        value = ";".join(str(item) for item in value)
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).replace("|", "/").replace("\n", " ").strip()
+
+def _failure_relevance(item: dict) -> float:
+    return 0.5 + 0.1 * min(max(item.get('urgency', 1), 1), 5)
+
+def _maintenance_relevance(item: dict) -> float:
+    days = item.get('days_until_due')
+    if days is None:
+        return 0.3
+    if days <= 0:
+        return 1.0
+    if days <= MAINTENANCE_DUE_SOON_DAYS:
+        return 0.8
+    return 0.4
+
+def _equipment_relevance(item: dict) -> float:
+    return {"אדום": 1.0, "כתום": 0.8}.get(item.get('alert_level'), 0.3)
+
+def _daily_work_relevance(item: dict) -> float:
+    today = datetime.now().isoformat()[:10]
+    if item.get('status') == 'הושלם':
+        return 0.2
+    if item.get('date') == today:
+        return 0.9
+    return 0.5 if item.get('date', '') > today else 0.3
+
+def _plan_relevance(item: dict) -> float:
+    return {"בביצוע": 0.7, "מתוכנן": 0.5}.get(item.get('status'), 0.2)
+
+# (key, title, source data key, columns, relevance function)
+CONTEXT_SECTIONS = [
+    ("failures", "תקלות פעילות", ("dept", "failures"),
+     ["failure_number", "system", "description", "urgency", "assignee", "status", "date"], _failure_relevance),
+    ("maintenance", "אחזקות ממתינות", ("dept", "maintenance"),
+     ["id", "maintenance_type", "system", "next_due", "days_until_due", "status"], _maintenance_relevance),
+    ("equipment", "שעות מכלולים", ("dept", "equipment"),
+     ["id", "system", "system_type", "current_hours", "hours_until_service", "alert_level", "predicted_service_date"], _equipment_relevance),
+    ("daily_work", "תכנון יומי", ("dept", "daily_work"),
+     ["id", "date", "task", "assignee", "status", "notes"], _daily_work_relevance),
+    ("conversations", "שיחות אחרונות", ("leadership", "recent_conversations"),
+     ["meeting_number", "date", "main_topics", "insights", "decisions", "next_step"], None),
+    ("dna_tracker", "DNA Tracker", ("leadership", "dna_tracker"),
+     ["component_name", "clarity_level", "gaps_identified", "development_plan"],
+     lambda item: 0.5 + 0.03 * (10 - item.get('clarity_level', 5))),
+    ("ninety_day_plan", "תכנית 90 יום", ("leadership", "ninety_day_plan"),
+     ["week_number", "goals", "status"], _plan_relevance),
+]
+
+DEPARTMENT_CONTEXT_SECTIONS = tuple(section[0] for section in CONTEXT_SECTIONS if section[2][0] == "dept")
+LEADERSHIP_CONTEXT_SECTIONS = tuple(section[0] for section in CONTEXT_SECTIONS if section[2][0] == "leadership")
+
+CONTEXT_TEXT_LIMIT = 120
+
+def build_ai_context(dept_data: dict, leadership_data: dict, token_budget: int = AI_CONTEXT_TOKEN_BUDGET,
+                     section_keys: tuple = None) -> dict:
+    """Build a compact, token-budgeted data context for the system prompt.
+
+    Rows from every table are ranked together by relevance (urgency, overdue
+    maintenance, red alerts, recent conversations) and added until the budget
+    is spent. Each section is rendered once as a pipe-separated table.
+    section_keys limits the context to some sections (None = all).
+    Returns {"text", "tokens", "sections": {key: {"included", "total"}}}.
+    """
+    sources = {"dept": dept_data or {}, "leadership": leadership_data or {}}
+
+    summary = (dept_data or {}).get("summary", {})
+    summary_line = ""
+    if summary and token_budget > 0:
+        summary_line = "סיכום: " + ", ".join(f"{key}={value}" for key, value in summary.items())
+    used_tokens = estimate_tokens(summary_line)
+
+    candidates = []
+    section_rows = {}
+    for order, (key, title, (source, data_key), columns, relevance) in enumerate(CONTEXT_SECTIONS):
+        if section_keys is not None and key not in section_keys:
+            continue
+        rows = sources[source].get(data_key) or []
+        section_rows[key] = {"title": title, "columns": columns, "rows": [], "total": len(rows)}
+        for position, row in enumerate(rows):
+            values = []
+            for column in columns:
+                value = _context_value(row.get(column))
+                values.append(value[:CONTEXT_TEXT_LIMIT])
+            line = "|".join(values)
+            if relevance is not None:
+                score = relevance(row)
+            else:
+                # Conversations arrive most recent first
+                score = 0.85 - 0.1 * position
+            candidates.append((-score, order, position, key, line))
+
+    candidates.sort()
+    header_tokens = {
+        key: estimate_tokens(f"## {section['title']}\n{'|'.join(section['columns'])}\n")
+        for key, section in section_rows.items()
+    }
+    # Most relevant rows first; rows keep that order inside their section
+    for _, _, _, key, line in candidates:
+        cost = estimate_tokens(line) + 1
+        if not section_rows[key]["rows"]:
+            cost += header_tokens[key]
+        if used_tokens + cost > token_budget:
+            continue
+        section_rows[key]["rows"].append(line)
+        used_tokens += cost
+
+    parts = [summary_line] if summary_line else []
+    for key, section in section_rows.items():
+        if not section["rows"]:
+            continue
+        included = len(section["rows"])
+        header = f"## {section['title']} ({included}/{section['total']})"
+        parts.append("\n".join([header, "|".join(section["columns"])] + section["rows"]))
+
+    text = "\n\n".join(parts)
+    return {
+        "text": text,
+        "tokens": estimate_tokens(text),
+        "sections": {
+            key: {"included": len(section["rows"]), "total": section["total"]}
+            for key, section in section_rows.items()
+        }
+    }
+
+# Data Versions & AI Context Cache
+DATA_TABLES = ["failures", "resolved_failures", "maintenance", "equipment", "daily_work",
+               "conversations", "dna_tracker", "ninety_day_plan"]
+
+# Hebrew table names reported by execute_ai_actions -> data version keys
+TABLE_VERSION_KEYS = {
+    'תקלות פעילות': 'failures',
+    'תקלות שטופלו': 'resolved_failures',
+    'אחזקות ממתינות': 'maintenance',
+    'שעות מכלולים': 'equipment',
+    'תכנון יומי': 'daily_work',
+    'מעקב שיחות': 'conversations',
+    'DNA Tracker': 'dna_tracker',
+    'תכנית 90 יום': 'ninety_day_plan'
+}
+
+AI_CONTEXT_CACHE_SIZE = int(os.environ.get('AI_CONTEXT_CACHE_SIZE', '1000'))
+
+def bump_data_version(user_id: str, *tables: str):
+    """Mark tables as changed for a user, invalidating cached AI context"""
+    if not user_id or not tables:
+        return
+    try:
+        data_versions_collection.update_one(
+            {"user_id": user_id},
+            {
+                "$inc": {f"versions.{table}": 1 for table in set(tables)},
+                "$set": {"updated_at": datetime.now().isoformat()}
+            },
+            upsert=True
+        )
+    except Exception as e:
+        print(f"Error bumping data version for {user_id}: {e}")
+
+def get_data_versions(user_id: str) -> Dict[str, int]:
+    """Get the current per-table data versions for a user"""
+    doc = data_versions_collection.find_one({"user_id": user_id}, {"_id": 0, "versions": 1})
+    versions = (doc or {}).get("versions", {})
+    return {table: versions.get(table, 0) for table in DATA_TABLES}
+
+class AIContextCache:
+    """LRU cache of rendered AI context per user and context variant
+    (budget + sections), keyed by data versions"""
+
+    def __init__(self, max_size: int = AI_CONTEXT_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: str, variant: tuple, key: tuple):
+        entry = self._entries.get((user_id, variant))
+        if entry is None or entry[0] != key:
+            self.misses += 1
+            return None
+        self._entries.move_to_end((user_id, variant))
+        self.hits += 1
+        return entry[1]
+
+    def set(self, user_id: str, variant: tuple, key: tuple, value: dict):
+        self._entries[(user_id, variant)] = (key, value)
+        self._entries.move_to_end((user_id, variant))
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: str = None):
+        if user_id is None:
+            self._entries.clear()
+        else:
+            for entry_key in [entry_key for entry_key in self._entries if entry_key[0] == user_id]:
+                del self._entries[entry_key]
+
+ai_context_cache = AIContextCache()
+
+def get_cached_ai_context(user_id: str, token_budget: int = AI_CONTEXT_TOKEN_BUDGET, section_keys: tuple = None) -> dict:
+    """Get the rendered AI context for a user, rebuilding only after data changes.
+
+    Returns {"context", "summary", "leadership_context", "versions", "cached"}.
+    The key includes today's date because due dates and today's tasks are relative to it.
+    Leadership data is only loaded when one of its sections is requested.
+    """
+    versions = get_data_versions(user_id)
+    variant = (token_budget, section_keys)
+    key = (tuple(sorted(versions.items())), datetime.now().isoformat()[:10])
+
+    cached = ai_context_cache.get(user_id, variant, key)
+    if cached is not None:
+        return {**cached, "cached": True}
+
+    dept_data = get_department_summary(user_id)
+    wants_leadership = section_keys is None or any(key in LEADERSHIP_CONTEXT_SECTIONS for key in section_keys)
+    leadership_data = get_leadership_context(user_id) if wants_leadership else {}
+    entry = {
+        "context": build_ai_context(dept_data, leadership_data, token_budget, section_keys),
+        "summary": dept_data.get("summary", {}),
+        "leadership_context": len(leadership_data.get("recent_conversations", [])),
+        "versions": versions
+    }
+    ai_context_cache.set(user_id, variant, key, entry)
+    return {**entry, "cached": False}
+
+# Resolved Failure Retrieval
+# Past resolved failures similar to the user's message are added to the prompt with
+# their resolution and lessons learned. Each user's resolved failures are indexed in
+# memory as hashed character n-gram TF-IDF vectors and ranked by cosine similarity.
+RETRIEVAL_TOP_K = int(os.environ.get('RETRIEVAL_TOP_K', '3'))
+RETRIEVAL_MIN_SCORE = float(os.environ.get('RETRIEVAL_MIN_SCORE', '0.15'))
+RETRIEVAL_DIMENSIONS = 4096  # Hashed n-gram buckets
+RETRIEVAL_NGRAM = 3
+RETRIEVAL_MAX_DOCS = 2000  # Most recently resolved failures indexed per user
+RETRIEVAL_INDEX_USERS = int(os.environ.get('RETRIEVAL_INDEX_USERS', '200'))
+RETRIEVAL_FIELDS = ('system', 'description', 'resolution_method', 'lessons_learned')
+
+HEBREW_NIQQUD = re.compile(r'[\u0591-\u05BD\u05BF\u05C1\u05C2\u05C4\u05C5\u05C7]')  # Cantillation marks and vowel points (not maqaf)
+HEBREW_QUOTES = re.compile(r'[\u05F3\u05F4"\'`]')  # Geresh / gershayim inside abbreviations (צה"ל, ש')
+HEBREW_FINAL_LETTERS = str.maketrans('ךםןףץ', 'כמנפצ')
+NON_WORD = re.compile(r'[\W_]+')
+
+def normalize_hebrew(text: str) -> str:
+    """Normalize text for matching: drop niqqud and quotes, fold final letters,
+    lowercase and turn punctuation into single spaces"""
+    text = HEBREW_NIQQUD.sub('', text or '')
+    text = HEBREW_QUOTES.sub('', text).translate(HEBREW_FINAL_LETTERS).lower()
+    return NON_WORD.sub(' ', text).strip()
+
+def char_ngram_vector(text: str) -> np.ndarray:
+    """Sublinear term frequencies of the character n-grams of each normalized word, hashed into buckets"""
+    vector = np.zeros(RETRIEVAL_DIMENSIONS, dtype=np.float32)
+    for word in normalize_hebrew(text).split():
+        padded = f" {word} "
+        for start in range(max(1, len(padded) - RETRIEVAL_NGRAM + 1)):
+            gram = padded[start:start + RETRIEVAL_NGRAM]
+            vector[zlib.crc32(gram.encode('utf-8')) % RETRIEVAL_DIMENSIONS] += 1
+    np.log1p(vector, out=vector)
+    return vector
+
+def _resolved_failure_text(doc: dict) -> str:
+    return " ".join(_context_value(doc.get(field)) for field in RETRIEVAL_FIELDS)
+
+class ResolvedFailureIndex:
+    """Per-user in-memory retrieval index over resolved failures.
+
+    Entries are loaded on first use and updated in place by add(). They are
+    checked against the resolved_failures data version: bumps explained by our own
+    add() calls are accepted, any other change (edit, delete) reloads the user.
+    """
+
+    def __init__(self, max_users: int = RETRIEVAL_INDEX_USERS):
+        self.max_users = max_users
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _load(self, user_id: str, version: int) -> dict:
+        docs = list(resolved_failures_collection.find(
+            {"user_id": user_id},
+            {"_id": 0, "id": 1, "failure_number": 1, "resolved_date": 1, **{field: 1 for field in RETRIEVAL_FIELDS}}
+        ).sort("resolved_at", -1).limit(RETRIEVAL_MAX_DOCS))
+        matrix = np.array([char_ngram_vector(_resolved_failure_text(doc)) for doc in docs], dtype=np.float32).reshape(-1, RETRIEVAL_DIMENSIONS)
+        return {
+            "docs": docs,
+            "positions": {doc.get('id'): position for position, doc in enumerate(docs)},
+            "matrix": matrix,
+            "squared": matrix ** 2,  # For the row norms under changing idf weights
+            "df": (matrix > 0).sum(axis=0).astype(np.float32),
+            "version": version,
+            "pending_adds": 0
+        }
+
+    def _entry(self, user_id: str, version: int) -> dict:
+        entry = self._entries.get(user_id)
+        if entry is not None and entry["version"] != version:
+            if entry["pending_adds"] and 0 < version - entry["version"] <= entry["pending_adds"]:
+                entry["version"] = version
+                entry["pending_adds"] = 0
+            else:
+                entry = None
+        if entry is None:
+            entry = self._load(user_id, version)
+            self._entries[user_id] = entry
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_users:
+            self._entries.popitem(last=False)
+        return entry
+
+    def add(self, user_id: str, doc: dict):
+        """Add or replace one resolved failure of a user that is already indexed"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return  # Loaded with the new failure on first search
+            vector = char_ngram_vector(_resolved_failure_text(doc))
+            meta = {field: doc.get(field) for field in ("id", "failure_number", "resolved_date") + RETRIEVAL_FIELDS}
+            position = entry["positions"].get(doc.get('id'))
+            if position is None:
+                entry["positions"][doc.get('id')] = len(entry["docs"])
+                entry["docs"].append(meta)
+                entry["matrix"] = np.vstack([entry["matrix"], vector])
+                entry["squared"] = np.vstack([entry["squared"], vector ** 2])
+            else:
+                entry["df"] -= entry["matrix"][position] > 0
+                entry["docs"][position] = meta
+                entry["matrix"][position] = vector
+                entry["squared"][position] = vector ** 2
+            entry["df"] += vector > 0
+            entry["pending_adds"] += 1
+
+    def search(self, user_id: str, text: str, version: int, top_k: int = RETRIEVAL_TOP_K,
+               min_score: float = RETRIEVAL_MIN_SCORE) -> List[dict]:
+        """Most similar resolved failures to the text, best first, with their cosine score"""
+        query = char_ngram_vector(text)
+        if not query.any():
+            return []
+        with self._lock:
+            entry = self._entry(user_id, version)
+            matrix, df, docs = entry["matrix"], entry["df"], entry["docs"]
+            if not docs:
+                return []
+            idf = np.log((1 + len(docs)) / (1 + df)) + 1
+            query = query * idf
+            # cos(matrix * idf, query * idf) without materializing the weighted matrix
+            norms = np.sqrt(entry["squared"] @ (idf ** 2)) * np.linalg.norm(query)
+            scores = (matrix @ (query * idf)) / np.maximum(norms, 1e-9)
+            best = np.argsort(-scores)[:top_k]
+            return [{**docs[i], "score": round(float(scores[i]), 3)} for i in best if scores[i] >= min_score]
+
+    def invalidate(self, user_id: str = None):
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+resolved_failure_index = ResolvedFailureIndex()
+
+def build_similar_failures_section(similar: List[dict]) -> str:
+    """Prompt section with the retrieved past cases, one pipe-separated row each"""
+    if not similar:
+        return ""
+    columns = ("failure_number",) + RETRIEVAL_FIELDS
+    rows = ["|".join(_context_value(doc.get(column))[:CONTEXT_TEXT_LIMIT] for column in columns) for doc in similar]
+    return "\n".join([
+        "🔎 **תקלות דומות שטופלו בעבר** (לפי דמיון להודעה - אפשר להיעזר בפתרון ובלקחים אם רלוונטי):",
+        "|".join(columns)
+    ] + rows)
+
+def build_resolved_failure(failure_data: dict, resolution_info: dict = None) -> dict:
+    """Build the resolved failure record for a completed failure"""
+    return {
+        'id': failure_data['id'],
+        'user_id': failure_data.get('user_id'),  # Maintain user_id
+        'failure_number': failure_data['failure_number'],
+        'date': failure_data['date'],
+        'system': failure_data['system'],
+        'description': failure_data['description'],
+        'urgency': failure_data['urgency'],
+        'assignee': failure_data['assignee'],
+        'estimated_hours': failure_data['estimated_hours'],
+        'actual_hours': resolution_info.get('actual_hours') if resolution_info else failure_data['estimated_hours'],
+        'resolution_method': resolution_info.get('resolution_method', '') if resolution_info else '',
+        'resolved_date': datetime.now().isoformat()[:10],
+        'resolved_by': resolution_info.get('resolved_by', failure_data['assignee']) if resolution_info else failure_data['assignee'],
+        'lessons_learned': resolution_info.get('lessons_learned', '') if resolution_info else '',
+        'created_at': failure_data['created_at'],
+        'resolved_at': datetime.now().isoformat()
+    }
+
 async def move_failure_to_resolved(failure_data: dict, resolution_info: dict = None):
     """Move completed failure to resolved failures table"""
     try:
         # Create resolved failure record
-        resolved_failure = {
-            'id': failure_data['id'],
-            'user_id': failure_data.get('user_id'),  # Maintain user_id
-            'failure_number': failure_data['failure_number'],
-            'date': failure_data['date'],
-            'system': failure_data['system'],
-            'description': failure_data['description'],
-            'urgency': failure_data['urgency'],
-            'assignee': failure_data['assignee'],
-            'estimated_hours': failure_data['estimated_hours'],
-            'actual_hours': resolution_info.get('actual_hours') if resolution_info else failure_data['estimated_hours'],
-            'resolution_method': resolution_info.get('resolution_method', '') if resolution_info else '',
-            'resolved_date': datetime.now().isoformat()[:10],
-            'resolved_by': resolution_info.get('resolved_by', failure_data['assignee']) if resolution_info else failure_data['assignee'],
-            'lessons_learned': resolution_info.get('lessons_learned', '') if resolution_info else '',
-            'created_at': failure_data['created_at'],
-            'resolved_at': datetime.now().isoformat()
-        }
+        resolved_failure = build_resolved_failure(failure_data, resolution_info)
         
         # Insert into resolved failures
         resolved_failures_collection.insert_one(resolved_failure)
         
         # Remove from active failures (filter by user_id)
         active_failures_collection.delete_one({'id': failure_data['id'], 'user_id': failure_data.get('user_id')})
+        resolved_failure_index.add(failure_data.get('user_id'), resolved_failure)
+        bump_data_version(failure_data.get('user_id'), 'failures', 'resolved_failures')
         
         print(f"Moved failure {failure_data['failure_number']} to resolved failures")
         return True
@@ -830,488 +1976,1224 @@ async def move_failure_to_resolved(failure_data: dict, resolution_info: dict = N
         print(f"Error moving failure to resolved: {e}")
         return False
 
+# Full-Text Search
+# Per-user inverted index over failures, resolved failures, daily work and
+# conversations. Words are normalized like the retrieval index (niqqud, quotes,
+# final letters) and also indexed without attached prefix letters (ו, ה, ב, כ, ל,
+# מ, ש), so "מנוע" finds "במנוע". Query words match whole words and, from two
+# letters on, word prefixes. Each source is rebuilt when its data version changes.
+SEARCH_INDEX_USERS = int(os.environ.get('SEARCH_INDEX_USERS', '200'))
+SEARCH_MAX_DOCS = 5000  # Newest documents indexed per source and user
+SEARCH_MAX_TERMS = 8
+SEARCH_MAX_EXPANSIONS = 50  # Index words tried per query prefix
+SEARCH_PREFIX_FACTOR = 0.6  # Prefix matches rank below whole-word matches
+SEARCH_STRIPPED_FACTOR = 0.7  # Matches on a word without its prefix letters
+SEARCH_SNIPPET_CHARS = 160
+SEARCH_MAX_HIGHLIGHTS = 3
+
+HEBREW_PREFIX_LETTERS = frozenset('והבכלמש')
+SEARCH_WORD = re.compile(r'[^\W_](?:[^\W_]|[\u0591-\u05BD\u05BF\u05C1\u05C2\u05C4\u05C5\u05C7]|["\'\u05F3\u05F4](?=[^\W_]))*')  # Original words, niqqud and inner quotes included
+
+# source -> (collection, sort field, title function, {field: weight}); sources are data version keys
+SEARCH_SOURCES = {
+    "failures": (
+        active_failures_collection, "date",
+        lambda doc: f"{doc.get('failure_number', '')} - {doc.get('system', '')}",
+        {"failure_number": 3, "system": 2, "description": 1, "assignee": 1, "status": 0.5}
+    ),
+    "resolved_failures": (
+        resolved_failures_collection, "resolved_date",
+        lambda doc: f"{doc.get('failure_number', '')} - {doc.get('system', '')}",
+        {"failure_number": 3, "system": 2, "description": 1, "resolution_method": 1,
+         "lessons_learned": 1, "assignee": 0.5, "resolved_by": 0.5}
+    ),
+    "daily_work": (
+        daily_work_collection, "date",
+        lambda doc: doc.get('task', ''),
+        {"task": 2, "assignee": 1, "notes": 1, "source": 0.5, "status": 0.5}
+    ),
+    "conversations": (
+        conversations_collection, "date",
+        lambda doc: f"שיחה {doc.get('meeting_number', '')}",
+        {"main_topics": 2, "insights": 1, "decisions": 1, "next_step": 1}
+    ),
+}
+
+def hebrew_prefix_variants(word: str) -> List[str]:
+    """The word and the word without up to two attached prefix letters (והמנוע -> המנוע, מנוע)"""
+    variants = [word]
+    for count in (1, 2):
+        if len(word) - count < 2 or word[count - 1] not in HEBREW_PREFIX_LETTERS:
+            break
+        variants.append(word[count:])
+    return variants
+
+def _search_field_text(value) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, list):
+        return ", ".join(str(item) for item in value)
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
+
+def _word_matches(word: str, terms: List[str]) -> bool:
+    variants = hebrew_prefix_variants(word)
+    return any(variant == term or (len(term) > 1 and variant.startswith(term))
+               for variant in variants for term in terms)
+
+def search_highlight(text: str, terms: List[str]) -> Optional[dict]:
+    """Snippet of the text around the first matching word, with the [start, end)
+    offsets of all matching words inside the snippet, or None without a match"""
+    spans = [match.span() for match in SEARCH_WORD.finditer(text)
+             if _word_matches(normalize_hebrew(match.group()), terms)]
+    if not spans:
+        return None
+    start = 0
+    if len(text) > SEARCH_SNIPPET_CHARS:
+        start = max(0, min(spans[0][0] - SEARCH_SNIPPET_CHARS // 4, len(text) - SEARCH_SNIPPET_CHARS))
+    end = min(len(text), start + SEARCH_SNIPPET_CHARS)
+    lead = "…" if start > 0 else ""
+    snippet = lead + text[start:end] + ("…" if end < len(text) else "")
+    shift = len(lead) - start
+    return {
+        "text": snippet,
+        "matches": [[s + shift, e + shift] for s, e in spans if s >= start and e <= end]
+    }
+
+class SearchIndex:
+    """Per-user inverted index over the SEARCH_SOURCES collections.
+
+    Postings map each normalized word (and its prefix-stripped forms) to
+    {document position: field weight}. A sorted word list serves prefix queries.
+    Sources are rebuilt lazily when their data version changed; users are
+    evicted least recently used.
+    """
+
+    def __init__(self, max_users: int = SEARCH_INDEX_USERS):
+        self.max_users = max_users
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _doc_terms(doc: dict, weights: Dict[str, float]) -> Dict[str, float]:
+        terms = {}
+        for field, weight in weights.items():
+            for word in normalize_hebrew(_search_field_text(doc.get(field))).split():
+                for depth, variant in enumerate(hebrew_prefix_variants(word)):
+                    terms[variant] = terms.get(variant, 0) + weight * (SEARCH_STRIPPED_FACTOR if depth else 1)
+        return terms
+
+    def _build(self, user_id: str, source: str, version: int, previous: dict = None) -> dict:
+        """Index a source; terms of documents unchanged since the previous build are reused"""
+        collection, sort_field, title, weights = SEARCH_SOURCES[source]
+        docs = list(collection.find({"user_id": user_id}, {"_id": 0, "user_id": 0}).sort(sort_field, -1).limit(SEARCH_MAX_DOCS))
+        known = previous["doc_terms"] if previous else {}
+        doc_terms = {}
+        postings = {}
+        for position, doc in enumerate(docs):
+            texts = tuple(_search_field_text(doc.get(field)) for field in weights)
+            cached = known.get(doc.get('id'))
+            terms = cached[1] if cached and cached[0] == texts else self._doc_terms(doc, weights)
+            doc_terms[doc.get('id')] = (texts, terms)
+            for term, weight in terms.items():
+                postings.setdefault(term, {})[position] = weight
+        return {
+            "docs": docs,
+            "titles": [title(doc) for doc in docs],
+            "doc_terms": doc_terms,
+            "postings": postings,
+            "words": sorted(postings),
+            "version": version
+        }
+
+    def _source(self, user_id: str, source: str, version: int) -> dict:
+        sources = self._entries.setdefault(user_id, {})
+        entry = sources.get(source)
+        if entry is None or entry["version"] != version:
+            entry = self._build(user_id, source, version, entry)
+            sources[source] = entry
+        return entry
+
+    @staticmethod
+    def _candidates(entry: dict, term: str) -> List[tuple]:
+        """(index word, match factor) for a query term: the word itself, then words it prefixes"""
+        candidates = [(term, 1.0)] if term in entry["postings"] else []
+        if len(term) > 1:
+            words = entry["words"]
+            position = bisect.bisect_right(words, term)
+            while position < len(words) and len(candidates) < SEARCH_MAX_EXPANSIONS and words[position].startswith(term):
+                candidates.append((words[position], SEARCH_PREFIX_FACTOR))
+                position += 1
+        return candidates
+
+    @staticmethod
+    def _score(entry: dict, terms: List[str]) -> Dict[int, float]:
+        """Documents matching every term, scored by the best idf-weighted match per term"""
+        postings, total = entry["postings"], len(entry["docs"])
+        scores = None
+        for term in terms:
+            term_scores = {}
+            for word, factor in SearchIndex._candidates(entry, term):
+                posting = postings[word]
+                idf = math.log(1 + total / len(posting))
+                for position, weight in posting.items():
+                    score = idf * math.log1p(weight) * factor
+                    if score > term_scores.get(position, 0):
+                        term_scores[position] = score
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = {position: scores[position] + score for position, score in term_scores.items() if position in scores}
+            if not scores:
+                return {}
+        return scores or {}
+
+    def search(self, user_id: str, query: str, versions: Dict[str, int], sources: List[str] = None,
+               offset: int = 0, limit: int = 20) -> dict:
+        """Ranked page of matching documents across sources, with highlighted snippets"""
+        terms = list(dict.fromkeys(normalize_hebrew(query).split()))[:SEARCH_MAX_TERMS]
+        sources = sources or list(SEARCH_SOURCES)
+        matches = []
+        page = []
+        with self._lock:
+            entries = {source: self._source(user_id, source, versions.get(source, 0)) for source in sources}
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+            if terms:
+                for source, entry in entries.items():
+                    sort_field = SEARCH_SOURCES[source][1]
+                    for position, score in self._score(entry, terms).items():
+                        matches.append((round(score, 3), str(entry["docs"][position].get(sort_field) or ""), source, position))
+            # Best score first, newer first among equal scores
+            matches.sort(key=lambda match: (match[0], match[1]), reverse=True)
+            for score, date, source, position in matches[offset:offset + limit]:
+                page.append((score, date, source, entries[source]["docs"][position], entries[source]["titles"][position]))
+
+        results = []
+        for score, date, source, doc, title in page:
+            highlights = []
+            for field in SEARCH_SOURCES[source][3]:
+                highlight = search_highlight(_search_field_text(doc.get(field)), terms)
+                if highlight:
+                    highlights.append({"field": field, **highlight})
+                    if len(highlights) == SEARCH_MAX_HIGHLIGHTS:
+                        break
+            results.append({
+                "source": source,
+                "id": doc.get('id'),
+                "title": title,
+                "date": date,
+                "score": score,
+                "highlights": highlights
+            })
+        return {"total": len(matches), "offset": offset, "limit": limit, "results": results}
+
+    def invalidate(self, user_id: str = None):
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+search_index = SearchIndex()
+
+# Scheduled Jobs
+SCHEDULER_ENABLED = os.environ.get('SCHEDULER_ENABLED', 'true').lower() == 'true'
+ALERT_RECOMPUTE_INTERVAL_SECONDS = int(os.environ.get('ALERT_RECOMPUTE_INTERVAL_SECONDS', '900'))
+ALERT_EVENTS_DELIVERY_INTERVAL_SECONDS = int(os.environ.get('ALERT_EVENTS_DELIVERY_INTERVAL_SECONDS', '60'))
+SCHEDULER_LOCK_TTL_SECONDS = int(os.environ.get('SCHEDULER_LOCK_TTL_SECONDS', '90'))
+RECOMPUTE_BATCH_SIZE = 1000
+
+# Severity order used to tell escalations from de-escalations
+ALERT_LEVEL_SEVERITY = {"ירוק": 0, "כתום": 1, "אדום": 2}
+DUE_STATUS_SEVERITY = {"בזמן": 0, "מתקרב": 1, "באיחור": 2}
+
+class MongoLeaderLock:
+    """Lease-based leader lock stored in MongoDB"""
+
+    def __init__(self, collection, name: str, ttl_seconds: int = SCHEDULER_LOCK_TTL_SECONDS):
+        self.collection = collection
+        self.name = name
+        self.ttl_seconds = ttl_seconds
+        self.owner = f"{os.uname().nodename}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+    def acquire(self) -> bool:
+        """Acquire or renew the lease. Returns True if this worker is the leader"""
+        now = datetime.utcnow()
+        try:
+            lock = self.collection.find_one_and_update(
+                {"_id": self.name, "$or": [{"owner": self.owner}, {"expires_at": {"$lt": now}}]},
+                {"$set": {
+                    "owner": self.owner,
+                    "expires_at": now + timedelta(seconds=self.ttl_seconds),
+                    "renewed_at": now
+                }},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+            return bool(lock) and lock.get("owner") == self.owner
+        except DuplicateKeyError:
+            # Another worker holds a valid lease
+            return False
+
+    def release(self):
+        """Release the lease if this worker holds it"""
+        self.collection.delete_one({"_id": self.name, "owner": self.owner})
+
+class PeriodicScheduler:
+    """In-process periodic job runner. Jobs only run on the worker holding the leader lock"""
+
+    def __init__(self, lock: MongoLeaderLock):
+        self.lock = lock
+        self.is_leader = False
+        self.jobs = []
+        self._tasks = []
+
+    def add_job(self, name: str, func, interval_seconds: int):
+        self.jobs.append((name, func, interval_seconds))
+
+    async def _leadership_loop(self):
+        while True:
+            try:
+                was_leader = self.is_leader
+                self.is_leader = await asyncio.to_thread(self.lock.acquire)
+                if self.is_leader and not was_leader:
+                    print(f"Scheduler: {self.lock.owner} is now the leader")
+            except Exception as e:
+                self.is_leader = False
+                print(f"Scheduler: error acquiring leader lock: {e}")
+            await asyncio.sleep(max(1, self.lock.ttl_seconds // 3))
+
+    async def run_job(self, name: str, func):
+        """Run a single job now (sync jobs run in a worker thread)"""
+        started = datetime.now()
+        if asyncio.iscoroutinefunction(func):
+            result = await func()
+        else:
+            result = await asyncio.to_thread(func)
+        print(f"Scheduler: job {name} finished in {(datetime.now() - started).total_seconds():.2f}s: {result}")
+        return result
+
+    async def _job_loop(self, name: str, func, interval_seconds: int):
+        while True:
+            await asyncio.sleep(interval_seconds)
+            if not self.is_leader:
+                continue
+            try:
+                await self.run_job(name, func)
+            except Exception as e:
+                print(f"Scheduler: job {name} failed: {e}")
+
+    def start(self):
+        if self._tasks:
+            return
+        self._tasks.append(asyncio.create_task(self._leadership_loop()))
+        for name, func, interval_seconds in self.jobs:
+            self._tasks.append(asyncio.create_task(self._job_loop(name, func, interval_seconds)))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        if self.is_leader:
+            self.is_leader = False
+            await asyncio.to_thread(self.lock.release)
+
+def _alert_event(item: dict, entity_type: str, field: str, previous, current, severity: dict) -> dict:
+    return {
+        "id": str(uuid.uuid4()),
+        "user_id": item.get("user_id"),
+        "entity_type": entity_type,
+        "entity_id": item.get("id"),
+        "system": item.get("system", ""),
+        "field": field,
+        "previous": previous,
+        "current": current,
+        "escalation": severity.get(current, 0) > severity.get(previous, 0),
+        "created_at": datetime.now().isoformat(),
+        "delivered": False
+    }
+
+def _flush_updates(collection, operations: list) -> int:
+    if not operations:
+        return 0
+    result = collection.bulk_write(operations, ordered=False)
+    modified = result.modified_count
+    operations.clear()
+    return modified
+
+def recompute_derived_fields():
+    """Recompute maintenance due dates and equipment alert levels for all users.
+
+    Only rows whose derived fields changed are written. Every change of alert
+    level or due status produces an alert event; rows that never had a stored
+    status (e.g. before the first run) are updated silently.
+    """
+    events = []
+    changed_users = set()
+    maintenance_updates = 0
+    equipment_updates = 0
+
+    # Maintenance due dates and status
+    maintenance_fields = ("next_due", "days_until_due", "due_status")
+    operations = []
+    for item in pending_maintenance_collection.find({}, {
+        "_id": 1, "id": 1, "user_id": 1, "system": 1, "frequency_days": 1, "last_performed": 1,
+        "next_due": 1, "days_until_due": 1, "due_status": 1
+    }):
+        previous = {field: item.get(field) for field in maintenance_fields}
+        try:
+            calculate_maintenance_dates(item)
+        except (ValueError, TypeError, KeyError) as e:
+            print(f"Skipping maintenance {item.get('id')}: {e}")
+            continue
+
+        changes = {field: item.get(field) for field in maintenance_fields if item.get(field) != previous[field]}
+        if not changes:
+            continue
+        operations.append(UpdateOne({"_id": item["_id"]}, {"$set": changes}))
+        changed_users.add(item.get("user_id"))
+        if "due_status" in changes and previous["due_status"] is not None:
+            events.append(_alert_event(item, "maintenance", "due_status", previous["due_status"], item["due_status"], DUE_STATUS_SEVERITY))
+        if len(operations) >= RECOMPUTE_BATCH_SIZE:
+            maintenance_updates += _flush_updates(pending_maintenance_collection, operations)
+    maintenance_updates += _flush_updates(pending_maintenance_collection, operations)
+
+    # Equipment service hours and alert levels
+    equipment_fields = ("next_service_hours", "hours_until_service", "alert_level", "predicted_service_date")
+    batch = []
+
+    def process_equipment_batch():
+        updates = 0
+        valid = [item for item in batch if item.get("system_type") and item.get("current_hours") is not None]
+        previous = [{field: item.get(field) for field in equipment_fields} for item in valid]
+        calculate_service_hours_batch(valid)
+        for item, old in zip(valid, previous):
+            changes = {field: item.get(field) for field in equipment_fields if item.get(field) != old[field]}
+            if not changes:
+                continue
+            operations.append(UpdateOne({"_id": item["_id"]}, {"$set": changes}))
+            changed_users.add(item.get("user_id"))
+            if "alert_level" in changes and old["alert_level"] is not None:
+                events.append(_alert_event(item, "equipment", "alert_level", old["alert_level"], item["alert_level"], ALERT_LEVEL_SEVERITY))
+        updates += _flush_updates(equipment_hours_collection, operations)
+        batch.clear()
+        return updates
+
+    for item in equipment_hours_collection.find({}, {
+        "_id": 1, "id": 1, "user_id": 1, "system": 1, "system_type": 1, "current_hours": 1,
+        "next_service_hours": 1, "hours_until_service": 1, "alert_level": 1,
+        "usage_rate_per_day": 1, "last_reading_at": 1, "predicted_service_date": 1
+    }):
+        batch.append(item)
+        if len(batch) >= RECOMPUTE_BATCH_SIZE:
+            equipment_updates += process_equipment_batch()
+    equipment_updates += process_equipment_batch()
+
+    if events:
+        alert_events_collection.insert_many(events)
+    for user_id in changed_users:
+        bump_data_version(user_id, 'maintenance', 'equipment')
+
+    return {
+        "maintenance_updated": maintenance_updates,
+        "equipment_updated": equipment_updates,
+        "events": len(events)
+    }
+
+scheduler = PeriodicScheduler(MongoLeaderLock(scheduler_locks_collection, "scheduler-leader"))
+
 # AI Agent Functions
 
 # AI Agent Functions with Database Operations
 
+# Action tag name -> action type, e.g. [UPDATE_FAILURE: ...] -> update_failure
+ACTION_TYPES = {
+    # ADD actions
+    'ADD_FAILURE': 'add_failure',
+    'ADD_MAINTENANCE': 'add_maintenance',
+    'ADD_EQUIPMENT': 'add_equipment',
+    'ADD_DAILY_WORK': 'add_daily_work',
+    'ADD_CONVERSATION': 'add_conversation',
+    'ADD_DNA_ITEM': 'add_dna_item',
+    'ADD_90DAY_PLAN': 'add_90day_plan',
+
+    # UPDATE actions
+    'UPDATE_FAILURE': 'update_failure',
+    'UPDATE_MAINTENANCE': 'update_maintenance',
+    'UPDATE_EQUIPMENT': 'update_equipment',
+    'UPDATE_DAILY_WORK': 'update_daily_work',
+    'UPDATE_CONVERSATION': 'update_conversation',
+    'UPDATE_DNA_ITEM': 'update_dna_item',
+    'UPDATE_90DAY_PLAN': 'update_90day_plan',
+
+    # DELETE actions
+    'DELETE_FAILURE': 'delete_failure',
+    'DELETE_MAINTENANCE': 'delete_maintenance',
+    'DELETE_EQUIPMENT': 'delete_equipment',
+    'DELETE_DAILY_WORK': 'delete_daily_work',
+
+    # RESOLVED FAILURE actions
+    'UPDATE_RESOLVED_FAILURE': 'update_resolved_failure',
+}
+
+ACTION_TAG_START = re.compile(r'\[((?:ADD|UPDATE|DELETE)_\w+):')
+ACTION_LIST_PARAMS = {'main_topics', 'insights', 'decisions', 'gaps_identified', 'goals', 'concrete_actions', 'success_metrics'}
+ACTION_INT_PARAMS = {'duration_minutes', 'yahel_energy_level', 'clarity_level', 'week_number', 'frequency_days', 'urgency'}
+ACTION_FLOAT_PARAMS = {'estimated_hours', 'current_hours'}
+ACTION_QUOTES = '"\''
+
+def _convert_action_param(key: str, value: str):
+    """Convert a raw parameter value to the type expected by execute_ai_actions"""
+    if key in ACTION_LIST_PARAMS:
+        if ',' in value:
+            return [item.strip() for item in value.split(',')]
+        return [value]
+    if key in ACTION_INT_PARAMS:
+        return int(value) if value.isdecimal() else 1
+    if key in ACTION_FLOAT_PARAMS:
+        try:
+            return float(value) if value.replace('.', '').isdecimal() else 0.0
+        except ValueError:
+            return 0.0
+    return value
+
+def _scan_action_params(text: str, pos: int):
+    """Scan key=value parameters from pos up to the tag's closing ']'.
+
+    Quoted values may contain commas, brackets and other quote characters; a
+    quote only closes the value when followed by ',' or ']'. Returns
+    (params, end) where end is the index of the closing ']', or (None, -1)
+    if the tag is never closed.
+    """
+    params = {}
+    length = len(text)
+    while pos < length:
+        # Skip separators between parameters
+        while pos < length and (text[pos].isspace() or text[pos] == ','):
+            pos += 1
+        if pos >= length:
+            break
+        if text[pos] == ']':
+            return params, pos
+
+        # Key, up to '='
+        key_end = pos
+        while key_end < length and text[key_end] not in '=,]':
+            key_end += 1
+        if key_end >= length:
+            break
+        if text[key_end] != '=':
+            pos = key_end  # Parameter without a value - ignored
+            continue
+        key = text[pos:key_end].strip()
+        pos = key_end + 1
+        while pos < length and text[pos] in ' \t':
+            pos += 1
+
+        if pos < length and text[pos] in ACTION_QUOTES:
+            quote = text[pos]
+            value_start = pos + 1
+            search = value_start
+            value_end = -1
+            while True:
+                closing = text.find(quote, search)
+                if closing == -1:
+                    break
+                after = closing + 1
+                while after < length and text[after] in ' \t':
+                    after += 1
+                if after >= length or text[after] in ',]':
+                    value_end = closing
+                    break
+                search = closing + 1
+            if value_end == -1:
+                return None, -1
+            value = text[value_start:value_end].strip()
+            pos = value_end + 1
+        else:
+            value_end = pos
+            while value_end < length and text[value_end] not in ',]':
+                value_end += 1
+            value = text[pos:value_end].strip().strip(ACTION_QUOTES)
+            pos = value_end
+
+        if key:
+            params[key] = _convert_action_param(key, value)
+    return None, -1
+
+def tokenize_ai_actions(ai_response: str):
+    """Find all action tags in a single scan.
+
+    Returns (actions, clean_text): actions as (action_type, params) tuples in
+    the order they appear, and the response with every ADD_/UPDATE_/DELETE_
+    tag removed. Unknown tag names are removed from the text but not executed.
+    """
+    actions = []
+    clean_parts = []
+    pos = 0
+    while True:
+        match = ACTION_TAG_START.search(ai_response, pos)
+        if not match:
+            break
+        params, end = _scan_action_params(ai_response, match.end())
+        if params is None:
+            # Unterminated tag - keep it as plain text
+            clean_parts.append(ai_response[pos:match.end()])
+            pos = match.end()
+            continue
+        clean_parts.append(ai_response[pos:match.start()])
+        action_type = ACTION_TYPES.get(match.group(1))
+        if action_type:
+            actions.append((action_type, params))
+        pos = end + 1
+    clean_parts.append(ai_response[pos:])
+    return actions, "".join(clean_parts)
+
 def parse_ai_actions(ai_response: str):
     """Parse AI response for database actions"""
-    actions = []
+    return tokenize_ai_actions(ai_response)[0]
+
+RESOLVED_FAILURE_STATUSES = ['הושלם', 'נסגר', 'טופל']
+
+# Actions that reference an existing document: action type -> target collection key
+AI_ACTION_REFERENCES = {
+    'update_failure': 'failures',
+    'delete_failure': 'failures',
+    'update_resolved_failure': 'resolved_failures',
+    'update_maintenance': 'maintenance',
+    'delete_maintenance': 'maintenance',
+    'update_equipment': 'equipment',
+    'delete_equipment': 'equipment',
+    'update_daily_work': 'daily_work',
+    'delete_daily_work': 'daily_work',
+}
+
+# Collections written by AI actions, in write order. Resolved failures are written
+# before active failures so a failed move never deletes the active failure.
+AI_ACTION_COLLECTIONS = [
+    ('resolved_failures', resolved_failures_collection),
+    ('failures', active_failures_collection),
+    ('maintenance', pending_maintenance_collection),
+    ('equipment', equipment_hours_collection),
+    ('daily_work', daily_work_collection),
+    ('conversations', conversations_collection),
+    ('dna_tracker', dna_tracker_collection),
+    ('ninety_day_plan', ninety_day_plan_collection),
+]
+
+def _ai_action_ref(action_type: str, params: dict) -> Optional[str]:
+    """Get the id (or failure number) an action refers to"""
+    if AI_ACTION_REFERENCES.get(action_type) in ('failures', 'resolved_failures'):
+        return params.get('id') or params.get('failure_number')
+    return params.get('id')
+
+def _ai_ref_field(key: str, ref: str) -> tuple:
+    """Failure references starting with F are failure numbers, anything else is an id"""
+    if key in ('failures', 'resolved_failures') and ref.startswith('F'):
+        return ('failure_number', ref)
+    return ('id', ref)
+
+def _prefetch_ai_action_targets(actions, user_id: str) -> Dict[str, dict]:
+    """Load every document referenced by the actions with one $in query per collection.
+    Returns collection key -> {(field, value): document}"""
+    refs = {}
+    for action_type, params in actions:
+        key = AI_ACTION_REFERENCES.get(action_type)
+        ref = _ai_action_ref(action_type, params)
+        if key and ref:
+            field, value = _ai_ref_field(key, str(ref))
+            refs.setdefault(key, {}).setdefault(field, set()).add(value)
     
-    # Look for action patterns in AI response
-    import re
-    
-    # ADD patterns
-    add_failure_pattern = r'\[ADD_FAILURE:(.*?)\]'
-    add_maintenance_pattern = r'\[ADD_MAINTENANCE:(.*?)\]'
-    add_equipment_pattern = r'\[ADD_EQUIPMENT:(.*?)\]'
-    add_daily_work_pattern = r'\[ADD_DAILY_WORK:(.*?)\]'
-    add_conversation_pattern = r'\[ADD_CONVERSATION:(.*?)\]'
-    add_dna_item_pattern = r'\[ADD_DNA_ITEM:(.*?)\]'
-    add_90day_plan_pattern = r'\[ADD_90DAY_PLAN:(.*?)\]'
-    
-    # UPDATE patterns - NEW!
-    update_failure_pattern = r'\[UPDATE_FAILURE:(.*?)\]'
-    update_maintenance_pattern = r'\[UPDATE_MAINTENANCE:(.*?)\]'
-    update_equipment_pattern = r'\[UPDATE_EQUIPMENT:(.*?)\]'
-    update_daily_work_pattern = r'\[UPDATE_DAILY_WORK:(.*?)\]'
-    update_conversation_pattern = r'\[UPDATE_CONVERSATION:(.*?)\]'
-    update_dna_item_pattern = r'\[UPDATE_DNA_ITEM:(.*?)\]'
-    update_90day_plan_pattern = r'\[UPDATE_90DAY_PLAN:(.*?)\]'
-    
-    # DELETE patterns - NEW!
-    delete_failure_pattern = r'\[DELETE_FAILURE:(.*?)\]'
-    delete_maintenance_pattern = r'\[DELETE_MAINTENANCE:(.*?)\]'
-    delete_equipment_pattern = r'\[DELETE_EQUIPMENT:(.*?)\]'
-    delete_daily_work_pattern = r'\[DELETE_DAILY_WORK:(.*?)\]'
-    
-    # RESOLVED FAILURE patterns - NEW!
-    update_resolved_failure_pattern = r'\[UPDATE_RESOLVED_FAILURE:(.*?)\]'
-    
-    patterns = [
-        # ADD patterns
-        (add_failure_pattern, 'add_failure'),
-        (add_maintenance_pattern, 'add_maintenance'),
-        (add_equipment_pattern, 'add_equipment'),
-        (add_daily_work_pattern, 'add_daily_work'),
-        (add_conversation_pattern, 'add_conversation'),
-        (add_dna_item_pattern, 'add_dna_item'),
-        (add_90day_plan_pattern, 'add_90day_plan'),
-        
-        # UPDATE patterns
-        (update_failure_pattern, 'update_failure'),
-        (update_maintenance_pattern, 'update_maintenance'),
-        (update_equipment_pattern, 'update_equipment'),
-        (update_daily_work_pattern, 'update_daily_work'),
-        (update_conversation_pattern, 'update_conversation'),
-        (update_dna_item_pattern, 'update_dna_item'),
-        (update_90day_plan_pattern, 'update_90day_plan'),
-        
-        # DELETE patterns
-        (delete_failure_pattern, 'delete_failure'),
-        (delete_maintenance_pattern, 'delete_maintenance'),
-        (delete_equipment_pattern, 'delete_equipment'),
-        (delete_daily_work_pattern, 'delete_daily_work'),
-        
-        # RESOLVED FAILURE patterns
-        (update_resolved_failure_pattern, 'update_resolved_failure'),
-    ]
-    
-    for pattern, action_type in patterns:
-        for match in re.finditer(pattern, ai_response, re.DOTALL):
-            try:
-                action_data = match.group(1).strip()
-                # Parse the parameters
-                params = {}
-                for param in action_data.split(','):
-                    if '=' in param:
-                        key, value = param.strip().split('=', 1)
-                        key = key.strip()
-                        value = value.strip().strip('"\'')
-                        # Handle list parameters
-                        if key in ['main_topics', 'insights', 'decisions', 'gaps_identified', 'goals', 'concrete_actions', 'success_metrics']:
-                            if ',' in value:
-                                params[key] = [item.strip() for item in value.split(',')]
-                            else:
-                                params[key] = [value]
-                        elif key in ['duration_minutes', 'yahel_energy_level', 'clarity_level', 'week_number', 'frequency_days', 'urgency']:
-                            params[key] = int(value) if value.isdigit() else 1
-                        elif key in ['estimated_hours', 'current_hours']:
-                            params[key] = float(value) if value.replace('.', '').isdigit() else 0.0
-                        else:
-                            params[key] = value
-                
-                actions.append((action_type, params))
-            except Exception as e:
-                print(f"Error parsing action {action_type}: {e}")
+    collections = dict(AI_ACTION_COLLECTIONS)
+    targets = {key: {} for key, _ in AI_ACTION_COLLECTIONS}
+    for key, fields in refs.items():
+        conditions = [{field: {'$in': list(values)}} for field, values in fields.items()]
+        query = {'user_id': user_id, '$or': conditions} if len(conditions) > 1 else {'user_id': user_id, **conditions[0]}
+        for doc in collections[key].find(query, {'_id': 0}):
+            for field in fields:
+                if doc.get(field) is not None:
+                    targets[key].setdefault((field, doc[field]), doc)
+    return targets
+
+def _forget_ai_target(targets: dict, key: str, doc: dict):
+    """Remove a deleted document from the prefetched targets"""
+    for field in ('id', 'failure_number'):
+        if doc.get(field) is not None and targets[key].get((field, doc[field])) is doc:
+            del targets[key][(field, doc[field])]
+
+def _remember_ai_target(targets: dict, key: str, doc: dict):
+    """Make a document inserted earlier in the batch visible to later actions"""
+    for field in ('id', 'failure_number'):
+        if doc.get(field) is not None:
+            targets[key][(field, doc[field])] = doc
+
+def _plan_ai_action(action_type: str, params: dict, user_id: str, targets: dict, result: dict, readings: list):
+    """Turn one action into (collection key, write op) pairs, updating the prefetched targets
+    so later actions in the same batch see its effect"""
+    ops = []
+    key = AI_ACTION_REFERENCES.get(action_type)
+    doc = None
+    if key:
+        ref = _ai_action_ref(action_type, params)
+        if not ref:
+            print(f"Error: No ID provided for {action_type}")
+            result['status'] = 'invalid'
+            return ops
+        ref = str(ref)
+        result['ref'] = ref
+        doc = targets[key].get(_ai_ref_field(key, ref))
+        if not doc:
+            print(f"{action_type}: {ref} not found")
+            result['status'] = 'not_found'
+            return ops
+        doc_filter = {'id': doc['id'], 'user_id': user_id}
+
+    if action_type == 'add_failure':
+        # Create failure
+        failure_data = {
+            'id': str(uuid.uuid4()),
+            'user_id': user_id,  # Add user_id
+            'failure_number': params.get('failure_number', f'F{datetime.now().strftime("%m%d%H%M")}'),
+            'date': params.get('date', datetime.now().isoformat()[:10]),
+            'system': params.get('system', ''),
+            'description': params.get('description', ''),
+            'urgency': int(params.get('urgency', 3)),
+            'assignee': params.get('assignee', ''),
+            'estimated_hours': float(params.get('estimated_hours', 2)),
+            'status': 'פעיל',
+            'created_at': datetime.now().isoformat()
+        }
+        ops.append(('failures', InsertOne(dict(failure_data))))
+        _remember_ai_target(targets, 'failures', failure_data)
+        result['ref'] = failure_data['failure_number']
+        result['tables'] = ['תקלות פעילות']
+        
+    elif action_type == 'update_failure':
+        update_data = {}
+        if 'status' in params:
+            update_data['status'] = params['status']
+        if 'urgency' in params:
+            update_data['urgency'] = int(params['urgency'])
+        if 'assignee' in params:
+            update_data['assignee'] = params['assignee']
+        if 'description' in params:
+            update_data['description'] = params['description']
+        if 'estimated_hours' in params:
+            update_data['estimated_hours'] = float(params['estimated_hours'])
+        
+        # Check if failure is being resolved
+        if update_data.get('status') in RESOLVED_FAILURE_STATUSES:
+            resolution_info = {
+                'actual_hours': params.get('actual_hours'),
+                'resolution_method': params.get('resolution_method', ''),
+                'resolved_by': params.get('resolved_by', doc['assignee']),
+                'lessons_learned': params.get('lessons_learned', '')
+            }
+            resolved_failure = build_resolved_failure({**doc, **update_data}, resolution_info)
+            ops.append(('resolved_failures', InsertOne(dict(resolved_failure))))
+            ops.append(('failures', DeleteOne(doc_filter)))
+            _forget_ai_target(targets, 'failures', doc)
+            _remember_ai_target(targets, 'resolved_failures', resolved_failure)
+            result['resolved'] = True
+            result['resolved_failure'] = resolved_failure
+            result['failure'] = {k: doc.get(k) for k in ('failure_number', 'system', 'description')}
+            result['needs_resolution_details'] = not resolution_info['resolution_method']
+            result['tables'] = ['תקלות פעילות', 'תקלות שטופלו']
+        elif update_data:
+            ops.append(('failures', UpdateOne(doc_filter, {'$set': update_data})))
+            doc.update(update_data)
+            result['tables'] = ['תקלות פעילות']
+        else:
+            result['status'] = 'no_changes'
+        
+    elif action_type == 'delete_failure':
+        ops.append(('failures', DeleteOne(doc_filter)))
+        _forget_ai_target(targets, 'failures', doc)
+        result['tables'] = ['תקלות פעילות']
+        
+    elif action_type == 'update_resolved_failure':
+        update_data = {}
+        if 'resolution_method' in params:
+            update_data['resolution_method'] = params['resolution_method']
+        if 'actual_hours' in params:
+            update_data['actual_hours'] = float(params['actual_hours'])
+        if 'lessons_learned' in params:
+            update_data['lessons_learned'] = params['lessons_learned']
+        if 'resolved_by' in params:
+            update_data['resolved_by'] = params['resolved_by']
+        if update_data:
+            ops.append(('resolved_failures', UpdateOne(doc_filter, {'$set': update_data})))
+            doc.update(update_data)
+            result['tables'] = ['תקלות שטופלו']
+        else:
+            result['status'] = 'no_changes'
+        
+    elif action_type == 'add_maintenance':
+        # Create maintenance
+        maintenance_data = {
+            'id': str(uuid.uuid4()),
+            'user_id': user_id,
+            'maintenance_type': params.get('maintenance_type', ''),
+            'system': params.get('system', ''),
+            'frequency_days': int(params.get('frequency_days', 30)),
+            'last_performed': params.get('last_performed', datetime.now().isoformat()[:10]),
+            'status': 'ממתין',
+            'created_at': datetime.now().isoformat()
+        }
+        maintenance_data = calculate_maintenance_dates(maintenance_data)
+        ops.append(('maintenance', InsertOne(dict(maintenance_data))))
+        _remember_ai_target(targets, 'maintenance', maintenance_data)
+        result['ref'] = maintenance_data['id']
+        result['tables'] = ['אחזקות ממתינות']
+        
+    elif action_type == 'update_maintenance':
+        update_data = {}
+        if 'status' in params:
+            update_data['status'] = params['status']
+        if 'last_performed' in params:
+            update_data['last_performed'] = params['last_performed']
+        if 'frequency_days' in params:
+            update_data['frequency_days'] = int(params['frequency_days'])
+        
+        # Recalculate dates if needed
+        if 'last_performed' in update_data or 'frequency_days' in update_data:
+            dates = calculate_maintenance_dates({**doc, **update_data})
+            for field in ('next_due', 'days_until_due', 'due_status'):
+                if field in dates:
+                    update_data[field] = dates[field]
+        if update_data:
+            ops.append(('maintenance', UpdateOne(doc_filter, {'$set': update_data})))
+            doc.update(update_data)
+            result['tables'] = ['אחזקות ממתינות']
+        else:
+            result['status'] = 'no_changes'
+        
+    elif action_type == 'add_equipment':
+        # Create equipment
+        equipment_data = {
+            'id': str(uuid.uuid4()),
+            'user_id': user_id,
+            'system': params.get('system', ''),
+            'system_type': params.get('system_type', 'מנועים'),
+            'current_hours': float(params.get('current_hours', 0)),
+            'last_service_date': params.get('last_service_date', ''),
+            'created_at': datetime.now().isoformat()
+        }
+        equipment_data['last_reading_at'] = equipment_data['created_at']
+        equipment_data = calculate_service_hours(equipment_data)
+        ops.append(('equipment', InsertOne(dict(equipment_data))))
+        _remember_ai_target(targets, 'equipment', equipment_data)
+        readings.append((result['index'], (equipment_data['id'], equipment_data['current_hours'], datetime.now())))
+        result['ref'] = equipment_data['id']
+        result['tables'] = ['שעות מכלולים']
+        
+    elif action_type == 'update_equipment':
+        update_data = {}
+        # A reading is only recorded when the meter value actually changed
+        hours_changed = 'current_hours' in params and float(params['current_hours']) != doc.get('current_hours')
+        if 'current_hours' in params:
+            update_data['current_hours'] = float(params['current_hours'])
+        if hours_changed:
+            update_data['last_reading_at'] = datetime.now().isoformat()
+        if 'last_service_date' in params:
+            update_data['last_service_date'] = params['last_service_date']
+        
+        # Recalculate service hours
+        if update_data:
+            updated = calculate_service_hours({**doc, **update_data})
+            update_data = {k: v for k, v in updated.items() if k not in ('id', 'user_id')}
+            ops.append(('equipment', UpdateOne(doc_filter, {'$set': update_data})))
+            doc.update(update_data)
+            if hours_changed:
+                readings.append((result['index'], (doc['id'], float(params['current_hours']), datetime.now())))
+            result['tables'] = ['שעות מכלולים']
+        else:
+            result['status'] = 'no_changes'
+        
+    elif action_type in ('delete_maintenance', 'delete_equipment', 'delete_daily_work'):
+        ops.append((key, DeleteOne(doc_filter)))
+        _forget_ai_target(targets, key, doc)
+        result['tables'] = [{'maintenance': 'אחזקות ממתינות', 'equipment': 'שעות מכלולים', 'daily_work': 'תכנון יומי'}[key]]
+        
+    elif action_type == 'add_daily_work':
+        # Create daily work
+        work_data = {
+            'id': str(uuid.uuid4()),
+            'user_id': user_id,
+            'date': params.get('date', datetime.now().isoformat()[:10]),
+            'task': params.get('task', ''),
+            'source': params.get('source', 'אחר'),
+            'source_id': params.get('source_id', ''),
+            'assignee': params.get('assignee', ''),
+            'estimated_hours': float(params.get('estimated_hours', 2)),
+            'status': 'מתוכנן',
+            'notes': params.get('notes', ''),
+            'created_at': datetime.now().isoformat()
+        }
+        ops.append(('daily_work', InsertOne(dict(work_data))))
+        _remember_ai_target(targets, 'daily_work', work_data)
+        result['ref'] = work_data['id']
+        result['tables'] = ['תכנון יומי']
+        
+    elif action_type == 'update_daily_work':
+        update_data = {}
+        if 'status' in params:
+            update_data['status'] = params['status']
+        if 'notes' in params:
+            update_data['notes'] = params['notes']
+        if 'assignee' in params:
+            update_data['assignee'] = params['assignee']
+        if update_data:
+            ops.append(('daily_work', UpdateOne(doc_filter, {'$set': update_data})))
+            doc.update(update_data)
+            result['tables'] = ['תכנון יומי']
+        else:
+            result['status'] = 'no_changes'
+        
+    elif action_type == 'add_conversation':
+        # Create leadership conversation
+        conversation_data = {
+            'id': str(uuid.uuid4()),
+            'user_id': user_id,
+            'meeting_number': int(params.get('meeting_number', 1)),
+            'date': params.get('date', datetime.now().isoformat()[:10]),
+            'duration_minutes': int(params.get('duration_minutes', 30)),
+            'main_topics': params.get('main_topics', []),
+            'insights': params.get('insights', []),
+            'decisions': params.get('decisions', []),
+            'next_step': params.get('next_step', ''),
+            'yahel_energy_level': int(params.get('yahel_energy_level', 5)),
+            'created_at': datetime.now().isoformat()
+        }
+        ops.append(('conversations', InsertOne(conversation_data)))
+        result['tables'] = ['מעקב שיחות']
+        
+    elif action_type == 'add_dna_item':
+        # Create or update DNA tracker item (one per component name)
+        dna_data = {
+            'component_name': params.get('component_name', ''),
+            'current_definition': params.get('current_definition', ''),
+            'clarity_level': int(params.get('clarity_level', 5)),
+            'gaps_identified': params.get('gaps_identified', []),
+            'development_plan': params.get('development_plan', ''),
+            'last_updated': datetime.now().isoformat()[:10]
+        }
+        ops.append(('dna_tracker', UpdateOne(
+            {'component_name': dna_data['component_name'], 'user_id': user_id},
+            {'$set': dna_data, '$setOnInsert': {'id': str(uuid.uuid4()), 'created_at': datetime.now().isoformat()}},
+            upsert=True
+        )))
+        result['tables'] = ['DNA Tracker']
+        
+    elif action_type == 'add_90day_plan':
+        # Create or update 90-day plan item (one per week)
+        plan_data = {
+            'week_number': int(params.get('week_number', 1)),
+            'goals': params.get('goals', []),
+            'concrete_actions': params.get('concrete_actions', []),
+            'success_metrics': params.get('success_metrics', []),
+            'status': params.get('status', 'מתוכנן'),
+            'reflection': params.get('reflection', '')
+        }
+        ops.append(('ninety_day_plan', UpdateOne(
+            {'week_number': plan_data['week_number'], 'user_id': user_id},
+            {'$set': plan_data, '$setOnInsert': {'id': str(uuid.uuid4()), 'created_at': datetime.now().isoformat()}},
+            upsert=True
+        )))
+        result['tables'] = ['תכנית 90 יום']
+        
+    else:
+        print(f"Unsupported AI action: {action_type}")
+        result['status'] = 'unsupported'
     
-    return actions
-
-async def execute_ai_actions(actions, user_id: str):
-    """Execute database actions from AI"""
-    updated_tables = []
+    return ops
+
+def run_ai_actions(actions, user_id: str) -> List[dict]:
+    """Execute database actions from AI in batches.
+
+    Referenced documents are prefetched with one $in query per collection and
+    the writes are grouped into one ordered bulk_write per collection. Returns
+    one result per action, in order, with status ok / not_found / invalid /
+    no_changes / unsupported / error and the tables it changed.
+    """
+    results = [{'index': index, 'action': action_type, 'status': 'ok', 'tables': []}
+               for index, (action_type, _) in enumerate(actions)]
+    ops_by_collection = {}
+    readings = []
     
-    for action_type, params in actions:
+    try:
+        targets = _prefetch_ai_action_targets(actions, user_id)
+    except Exception as e:
+        print(f"Error loading AI action targets: {e}")
+        for result in results:
+            result['status'] = 'error'
+        return results
+    
+    for (action_type, params), result in zip(actions, results):
         try:
-            if action_type == 'add_failure':
-                # Create failure
-                failure_data = {
-                    'id': str(uuid.uuid4()),
-                    'user_id': user_id,  # Add user_id
-                    'failure_number': params.get('failure_number', f'F{datetime.now().strftime("%m%d%H%M")}'),
-                    'date': params.get('date', datetime.now().isoformat()[:10]),
-                    'system': params.get('system', ''),
-                    'description': params.get('description', ''),
-                    'urgency': int(params.get('urgency', 3)),
-                    'assignee': params.get('assignee', ''),
-                    'estimated_hours': float(params.get('estimated_hours', 2)),
-                    'status': 'פעיל',
-                    'created_at': datetime.now().isoformat()
-                }
-                active_failures_collection.insert_one(failure_data)
-                updated_tables.append('תקלות פעילות')
-                
-            elif action_type == 'update_failure':
-                # Update existing failure
-                failure_id = params.get('id') or params.get('failure_number')
-                if not failure_id:
-                    print("Error: No ID provided for failure update")
-                    continue
-                    
-                # Get current failure data before update
-                query = {'id': failure_id} if failure_id.startswith('F') == False else {'failure_number': failure_id}
-                current_failure = active_failures_collection.find_one(query)
-                
-                if not current_failure:
-                    print(f"Failure {failure_id} not found for update")
-                    continue
-                
-                update_data = {}
-                if 'status' in params:
-                    update_data['status'] = params['status']
-                if 'urgency' in params:
-                    update_data['urgency'] = int(params['urgency'])
-                if 'assignee' in params:
-                    update_data['assignee'] = params['assignee']
-                if 'description' in params:
-                    update_data['description'] = params['description']
-                if 'estimated_hours' in params:
-                    update_data['estimated_hours'] = float(params['estimated_hours'])
-                
-                # Check if failure is being resolved
-                if update_data.get('status') in ['הושלם', 'נסגר', 'טופל']:
-                    # Get resolution details if provided
-                    resolution_info = {
-                        'actual_hours': params.get('actual_hours'),
-                        'resolution_method': params.get('resolution_method', ''),
-                        'resolved_by': params.get('resolved_by', current_failure['assignee']),
-                        'lessons_learned': params.get('lessons_learned', '')
-                    }
-                    
-                    # Move to resolved failures
-                    moved = await move_failure_to_resolved(current_failure, resolution_info)
-                    if moved:
-                        updated_tables.append('תקלות פעילות')
-                        updated_tables.append('תקלות שטופלו')
-                        print(f"Moved resolved failure {failure_id} to resolved table")
-                        
-                        # Store the failure number for Jessica to ask about resolution
-                        # This will trigger Jessica to ask follow-up questions
-                        if not resolution_info.get('resolution_method'):
-                            # Store in session that we need to ask about this failure
-                            resolved_failure_info = {
-                                'failure_number': current_failure['failure_number'],
-                                'system': current_failure['system'],
-                                'description': current_failure['description'],
-                                'needs_resolution_details': True
-                            }
-                            # Store in a way Jessica can access it
-                            print(f"Need to ask about resolution for {current_failure['failure_number']}")
-                else:
-                    # Regular update
-                    result = active_failures_collection.update_one(query, {'$set': update_data})
-                    
-                    if result.matched_count > 0:
-                        updated_tables.append('תקלות פעילות')
-                        print(f"Updated failure {failure_id}: {update_data}")
-                    else:
-                        print(f"Failure {failure_id} not found for update")
-                    
-            elif action_type == 'delete_failure':
-                # Delete failure
-                failure_id = params.get('id') or params.get('failure_number')
-                if not failure_id:
-                    print("Error: No ID provided for failure deletion")
-                    continue
-                    
-                query = {'id': failure_id} if failure_id.startswith('F') == False else {'failure_number': failure_id}
-                result = active_failures_collection.delete_one(query)
-                
-                if result.deleted_count > 0:
-                    updated_tables.append('תקלות פעילות')
-                    print(f"Deleted failure {failure_id}")
-                else:
-                    print(f"Failure {failure_id} not found for deletion")
-                
-            elif action_type == 'add_maintenance':
-                # Create maintenance
-                maintenance_data = {
-                    'id': str(uuid.uuid4()),
-                    'maintenance_type': params.get('maintenance_type', ''),
-                    'system': params.get('system', ''),
-                    'frequency_days': int(params.get('frequency_days', 30)),
-                    'last_performed': params.get('last_performed', datetime.now().isoformat()[:10]),
-                    'status': 'ממתין',
-                    'created_at': datetime.now().isoformat()
-                }
-                maintenance_data = calculate_maintenance_dates(maintenance_data)
-                pending_maintenance_collection.insert_one(maintenance_data)
-                updated_tables.append('אחזקות ממתינות')
-                
-            elif action_type == 'update_maintenance':
-                # Update maintenance
-                maintenance_id = params.get('id')
-                if not maintenance_id:
-                    print("Error: No ID provided for maintenance update")
-                    continue
-                    
-                update_data = {}
-                if 'status' in params:
-                    update_data['status'] = params['status']
-                if 'last_performed' in params:
-                    update_data['last_performed'] = params['last_performed']
-                if 'frequency_days' in params:
-                    update_data['frequency_days'] = int(params['frequency_days'])
-                
-                # Recalculate dates if needed
-                if 'last_performed' in update_data or 'frequency_days' in update_data:
-                    update_data = calculate_maintenance_dates(update_data)
-                
-                result = pending_maintenance_collection.update_one({'id': maintenance_id}, {'$set': update_data})
-                if result.matched_count > 0:
-                    updated_tables.append('אחזקות ממתינות')
-                    print(f"Updated maintenance {maintenance_id}")
-                else:
-                    print(f"Maintenance {maintenance_id} not found for update")
-                
-            elif action_type == 'add_equipment':
-                # Create equipment
-                equipment_data = {
-                    'id': str(uuid.uuid4()),
-                    'system': params.get('system', ''),
-                    'system_type': params.get('system_type', 'מנועים'),
-                    'current_hours': float(params.get('current_hours', 0)),
-                    'last_service_date': params.get('last_service_date', ''),
-                    'created_at': datetime.now().isoformat()
-                }
-                equipment_data = calculate_service_hours(equipment_data)
-                equipment_hours_collection.insert_one(equipment_data)
-                updated_tables.append('שעות מכלולים')
-                
-            elif action_type == 'update_equipment':
-                # Update equipment
-                equipment_id = params.get('id')
-                if not equipment_id:
-                    print("Error: No ID provided for equipment update")
-                    continue
-                    
-                update_data = {}
-                if 'current_hours' in params:
-                    update_data['current_hours'] = float(params['current_hours'])
-                if 'last_service_date' in params:
-                    update_data['last_service_date'] = params['last_service_date']
-                
-                # Recalculate service hours
-                if update_data:
-                    existing_equipment = equipment_hours_collection.find_one({'id': equipment_id})
-                    if existing_equipment:
-                        existing_equipment.update(update_data)
-                        update_data = calculate_service_hours(existing_equipment)
-                
-                result = equipment_hours_collection.update_one({'id': equipment_id}, {'$set': update_data})
-                if result.matched_count > 0:
-                    updated_tables.append('שעות מכלולים')
-                    print(f"Updated equipment {equipment_id}")
-                else:
-                    print(f"Equipment {equipment_id} not found for update")
-                
-            elif action_type == 'add_daily_work':
-                # Create daily work
-                work_data = {
-                    'id': str(uuid.uuid4()),
-                    'date': params.get('date', datetime.now().isoformat()[:10]),
-                    'task': params.get('task', ''),
-                    'source': params.get('source', 'אחר'),
-                    'source_id': params.get('source_id', ''),
-                    'assignee': params.get('assignee', ''),
-                    'estimated_hours': float(params.get('estimated_hours', 2)),
-                    'status': 'מתוכנן',
-                    'notes': params.get('notes', ''),
-                    'created_at': datetime.now().isoformat()
-                }
-                daily_work_collection.insert_one(work_data)
-                updated_tables.append('תכנון יומי')
-                
-            elif action_type == 'update_daily_work':
-                # Update daily work
-                work_id = params.get('id')
-                if not work_id:
-                    print("Error: No ID provided for daily work update")
-                    continue
-                    
-                update_data = {}
-                if 'status' in params:
-                    update_data['status'] = params['status']
-                if 'notes' in params:
-                    update_data['notes'] = params['notes']
-                if 'assignee' in params:
-                    update_data['assignee'] = params['assignee']
-                
-                result = daily_work_collection.update_one({'id': work_id}, {'$set': update_data})
-                if result.matched_count > 0:
-                    updated_tables.append('תכנון יומי')
-                    print(f"Updated daily work {work_id}")
-                else:
-                    print(f"Daily work {work_id} not found for update")
-                
-            elif action_type == 'add_conversation':
-                # Create leadership conversation
-                conversation_data = {
-                    'id': str(uuid.uuid4()),
-                    'meeting_number': int(params.get('meeting_number', 1)),
-                    'date': params.get('date', datetime.now().isoformat()[:10]),
-                    'duration_minutes': int(params.get('duration_minutes', 30)),
-                    'main_topics': params.get('main_topics', []),
-                    'insights': params.get('insights', []),
-                    'decisions': params.get('decisions', []),
-                    'next_step': params.get('next_step', ''),
-                    'yahel_energy_level': int(params.get('yahel_energy_level', 5)),
-                    'created_at': datetime.now().isoformat()
-                }
-                conversations_collection.insert_one(conversation_data)
-                updated_tables.append('מעקב שיחות')
-                
-            elif action_type == 'add_dna_item':
-                # Create or update DNA tracker item
-                dna_data = {
-                    'id': str(uuid.uuid4()),
-                    'component_name': params.get('component_name', ''),
-                    'current_definition': params.get('current_definition', ''),
-                    'clarity_level': int(params.get('clarity_level', 5)),
-                    'gaps_identified': params.get('gaps_identified', []),
-                    'development_plan': params.get('development_plan', ''),
-                    'last_updated': datetime.now().isoformat()[:10],
-                    'created_at': datetime.now().isoformat()
-                }
-                
-                # Check if DNA component already exists
-                existing = dna_tracker_collection.find_one({'component_name': dna_data['component_name']})
-                if existing:
-                    # Update existing
-                    dna_tracker_collection.update_one(
-                        {'component_name': dna_data['component_name']},
-                        {'$set': dna_data}
-                    )
-                else:
-                    # Create new
-                    dna_tracker_collection.insert_one(dna_data)
-                
-                updated_tables.append('DNA Tracker')
-                
-            elif action_type == 'add_90day_plan':
-                # Create 90-day plan item
-                plan_data = {
-                    'id': str(uuid.uuid4()),
-                    'week_number': int(params.get('week_number', 1)),
-                    'goals': params.get('goals', []),
-                    'concrete_actions': params.get('concrete_actions', []),
-                    'success_metrics': params.get('success_metrics', []),
-                    'status': params.get('status', 'מתוכנן'),
-                    'reflection': params.get('reflection', ''),
-                    'created_at': datetime.now().isoformat()
-                }
-                
-                # Check if week already exists
-                existing = ninety_day_plan_collection.find_one({'week_number': plan_data['week_number']})
-                if existing:
-                    # Update existing
-                    ninety_day_plan_collection.update_one(
-                        {'week_number': plan_data['week_number']},
-                        {'$set': plan_data}
-                    )
-                else:
-                    # Create new
-                    ninety_day_plan_collection.insert_one(plan_data)
-                
-                updated_tables.append('תכנית 90 יום')
-                
-            elif action_type == 'update_resolved_failure':
-                # Update resolved failure details
-                failure_id = params.get('id') or params.get('failure_number')
-                if not failure_id:
-                    print("Error: No ID provided for resolved failure update")
-                    continue
-                
-                update_data = {}
-                if 'resolution_method' in params:
-                    update_data['resolution_method'] = params['resolution_method']
-                if 'actual_hours' in params:
-                    update_data['actual_hours'] = float(params['actual_hours'])
-                if 'lessons_learned' in params:
-                    update_data['lessons_learned'] = params['lessons_learned']
-                if 'resolved_by' in params:
-                    update_data['resolved_by'] = params['resolved_by']
-                
-                query = {'id': failure_id} if failure_id.startswith('F') == False else {'failure_number': failure_id}
-                result = resolved_failures_collection.update_one(query, {'$set': update_data})
-                
-                if result.matched_count > 0:
-                    updated_tables.append('תקלות שטופלו')
-                    print(f"Updated resolved failure {failure_id}: {update_data}")
-                else:
-                    print(f"Resolved failure {failure_id} not found for update")
-                
+            for key, op in _plan_ai_action(action_type, params, user_id, targets, result, readings):
+                ops_by_collection.setdefault(key, []).append((result['index'], op))
         except Exception as e:
             print(f"Error executing action {action_type}: {e}")
+            result['status'] = 'error'
     
+    for key, collection in AI_ACTION_COLLECTIONS:
+        # Skip writes of actions that already failed in an earlier collection
+        ops = [(index, op) for index, op in ops_by_collection.get(key, []) if results[index]['status'] == 'ok']
+        if not ops:
+            continue
+        try:
+            collection.bulk_write([op for _, op in ops], ordered=True)
+        except BulkWriteError as e:
+            write_errors = e.details.get('writeErrors') or [{'index': 0}]
+            failed_from = write_errors[0]['index']
+            print(f"Error writing AI actions to {key}: {write_errors[0].get('errmsg', e)}")
+            for index, _ in ops[failed_from:]:
+                results[index]['status'] = 'error'
+        except Exception as e:
+            print(f"Error writing AI actions to {key}: {e}")
+            for index, _ in ops:
+                results[index]['status'] = 'error'
+    
+    for result in results:
+        if result['status'] != 'ok':
+            result['tables'] = []
+            continue
+        if result.get('resolved'):
+            resolved_failure_index.add(user_id, result['resolved_failure'])
+        if result.get('needs_resolution_details'):
+            print(f"Need to ask about resolution for {result['failure']['failure_number']}")
+    
+    equipment_readings = [reading for index, reading in readings if results[index]['status'] == 'ok']
+    if equipment_readings:
+        store_hour_readings(user_id, equipment_readings, "ai")
+    return results
+
+def apply_ai_action_results(results: List[dict], user_id: str) -> List[str]:
+    """Bump data versions for the executed actions and return the names of the updated tables"""
+    executed = sum(1 for result in results if result['status'] == 'ok')
+    print(f"Executed {executed}/{len(results)} AI actions")
+    
+    # Unique table names, in the order they were first updated
+    updated_tables = list(dict.fromkeys(table for result in results for table in result['tables']))
+    bump_data_version(user_id, *[TABLE_VERSION_KEYS[table] for table in updated_tables if table in TABLE_VERSION_KEYS])
     return updated_tables
 
-async def create_yahel_ai_agent(user_message: str, session_id: str = None, chat_history: List[dict] = None, current_user: dict = None) -> ChatResponse:
-    """Create AI agent for Yahel with department and leadership context"""
+def closed_failure_numbers(results: List[dict]) -> List[str]:
+    """Failure numbers moved to resolved failures by the executed actions"""
+    return [result['failure']['failure_number'] for result in results if result['status'] == 'ok' and result.get('resolved')]
+
+async def execute_ai_actions(actions, user_id: str):
+    """Execute database actions from AI, returning the names of the updated tables"""
+    return apply_ai_action_results(run_ai_actions(actions, user_id), user_id)
+
+# Background AI Action Executor
+# Actions from an AI reply are queued as one job per action, keyed by chat record id
+# plus action index, and executed after the reply text was returned. The chat record
+# id is derived from the client's message id, so a retried message finds the same
+# record and jobs instead of executing its actions again.
+AI_CHAT_RECORD_NAMESPACE = uuid.UUID('6f1c7d52-3b9e-4a51-9a8e-2d4f0c1b7e13')
+AI_ACTION_WAIT_SECONDS = 30  # How long the event stream waits for action results
+AI_ACTION_PENDING_RETRY_SECONDS = 60  # Pending jobs older than this were never picked up and are run by the recovery job
+AI_ACTION_STALE_SECONDS = 300  # Running jobs older than this are marked interrupted, never re-run
+AI_ACTION_RECOVERY_INTERVAL_SECONDS = 60
+
+ai_action_tasks = {}  # chat_id -> future of the executor running in this process
+
+def chat_record_id(user_id: Optional[str], client_message_id: Optional[str] = None) -> str:
+    """Chat record id: stable per client message id, random without one"""
+    if not client_message_id:
+        return str(uuid.uuid4())
+    return str(uuid.uuid5(AI_CHAT_RECORD_NAMESPACE, f"{user_id}:{client_message_id}"))
+
+def ai_action_summary(updated_tables: List[str]) -> str:
+    return f"\n\n✅ עדכנתי: {', '.join(updated_tables)}" if updated_tables else ""
+
+def queue_ai_actions(chat_id: str, user_id: str, actions) -> int:
+    """Store one pending job per action. Jobs that already exist are left alone"""
+    now = datetime.now().isoformat()
+    jobs = [{
+        "id": f"{chat_id}:{index}",
+        "chat_id": chat_id,
+        "index": index,
+        "user_id": user_id,
+        "action": action_type,
+        "params": params,
+        "status": "pending",
+        "tables": [],
+        "created_at": now
+    } for index, (action_type, params) in enumerate(actions)]
     try:
-        user_id = current_user['id'] if current_user else None
-        
-        # Get all context
-        dept_data = get_department_summary(user_id) if user_id else {}
-        leadership_data = get_leadership_context(user_id) if user_id else {}
-        
-        # Build conversation history context
-        conversation_context = ""
-        if chat_history and len(chat_history) > 1:
-            conversation_context = "\n\n📝 **היסטוריית השיחה הנוכחית:**\n"
-            for msg in chat_history[-6:]:  # Last 6 messages for context
-                if msg.get('type') == 'user':
-                    conversation_context += f"יהל: {msg.get('content', '')}\n"
-                elif msg.get('type') == 'ai':
-                    conversation_context += f"ג'סיקה: {msg.get('content', '')[:200]}...\n"
-        
-        # Get user's preferred name from chat history or ask for it
-        user_name = None
-        if chat_history:
-            # Look for stored name in previous conversations
-            for msg in chat_history:
-                if msg.get('role') == 'assistant' and 'אני אקרא לך:' in msg.get('content', ''):
-                    import re
-                    match = re.search(r'אני אקרא לך:\s*([^\s,.\n]+)', msg.get('content', ''))
-                    if match:
-                        user_name = match.group(1)
-                        break
-        
-        # If no name found in history and this is the first interaction, ask for name
-        if not user_name and (not chat_history or len(chat_history) == 0):
-            system_message = f"""
-אתה ג'סיקה - האייג'נט AI של מערכת ניהול המחלקה הצבאית. 
-אתה מתמחה בניהול מחלקה וליווי מנהיגותי.
+        ai_action_jobs_collection.insert_many(jobs, ordered=False)
+    except BulkWriteError as e:
+        if any(error.get('code') != 11000 for error in e.details.get('writeErrors', [])):
+            raise
+        print(f"AI actions for chat {chat_id} were already queued")
+    return len(jobs)
+
+def _action_job_result(result: dict) -> dict:
+    """The parts of a run_ai_actions result worth keeping on the job"""
+    job_result = {"status": result['status'], "tables": result['tables']}
+    if result.get('ref'):
+        job_result['ref'] = result['ref']
+    if result.get('failure'):
+        job_result['failure_number'] = result['failure'].get('failure_number')
+    if result.get('resolved'):
+        job_result['resolved'] = True
+    if result.get('needs_resolution_details'):
+        job_result['needs_resolution_details'] = True
+    return job_result
+
+def _finish_chat_actions(chat_id: str):
+    """Once no job of the chat is left, record the outcome on the chat record (exactly once)"""
+    jobs = list(ai_action_jobs_collection.find({"chat_id": chat_id}, {"_id": 0, "status": 1, "tables": 1, "resolved": 1, "failure_number": 1}))
+    if any(job['status'] in ('pending', 'running') for job in jobs):
+        return
+    updated_tables = list(dict.fromkeys(table for job in jobs for table in job.get('tables', [])))
+    closed_failures = [job['failure_number'] for job in jobs if job['status'] == 'ok' and job.get('resolved')]
+    if chat_log_writer.pending(lambda record: record["id"] == chat_id):
+        chat_log_writer.flush()  # The record must be in the database before it is updated
+    record = ai_chat_history_collection.find_one({"id": chat_id}, {"_id": 0, "ai_response": 1})
+    if not record:
+        return
+    ai_chat_history_collection.update_one(
+        {"id": chat_id, "actions_status": "pending"},
+        {"$set": {
+            "actions_status": "interrupted" if any(job['status'] == 'interrupted' for job in jobs) else "done",
+            "ai_response": record['ai_response'] + ai_action_summary(updated_tables),
+            "updated_tables": updated_tables,
+            "closed_failures": closed_failures
+        }}
+    )
 
-🎯 **משימה ראשונה חשובה:**
-שאל את המשתמש: "איך אתה רוצה שאני אקרא לך?" 
-אל תמציא שמות ואל תקרא לו בשום שם עד שהוא יגיד לך במפורש.
+def execute_chat_actions(chat_id: str, user_id: str) -> dict:
+    """Claim the chat's pending action jobs, execute them in one batch and store the results"""
+    claim = str(uuid.uuid4())
+    ai_action_jobs_collection.update_many(
+        {"chat_id": chat_id, "user_id": user_id, "status": "pending"},
+        {"$set": {"status": "running", "claim": claim, "started_at": datetime.now().isoformat()}}
+    )
+    jobs = list(ai_action_jobs_collection.find({"chat_id": chat_id, "claim": claim}, {"_id": 0}).sort("index", 1))
+    if jobs:
+        try:
+            results = run_ai_actions([(job['action'], job['params']) for job in jobs], user_id)
+            apply_ai_action_results(results, user_id)
+        except Exception as e:
+            print(f"Error executing AI actions for chat {chat_id}: {e}")
+            results = [{'status': 'error', 'tables': []} for _ in jobs]
+        finished_at = datetime.now().isoformat()
+        ai_action_jobs_collection.bulk_write([
+            UpdateOne({"id": job['id']}, {"$set": {**_action_job_result(result), "finished_at": finished_at}})
+            for job, result in zip(jobs, results)
+        ], ordered=False)
+        _finish_chat_actions(chat_id)
+    return get_chat_action_status(chat_id, user_id)
+
+def schedule_chat_actions(chat_id: str, user_id: str, session_id: Optional[str] = None):
+    """Run the chat's action jobs in a worker thread; returns the future (None when run inline).
+    The next turn of the session waits for the future, see LlmConcurrencyLimiter.session"""
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        execute_chat_actions(chat_id, user_id)
+        return None
+    future = loop.run_in_executor(None, execute_chat_actions, chat_id, user_id)
+    ai_action_tasks[chat_id] = future
+    future.add_done_callback(lambda _: ai_action_tasks.pop(chat_id, None))
+    if session_id:
+        llm_limiter.track_actions(user_id, session_id, future)
+    return future
+
+async def wait_for_chat_actions(chat_id: str, user_id: str, timeout: float = AI_ACTION_WAIT_SECONDS) -> Optional[dict]:
+    future = ai_action_tasks.get(chat_id)
+    if future is not None:
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        except Exception as e:
+            print(f"Error waiting for AI actions of chat {chat_id}: {e}")
+    return get_chat_action_status(chat_id, user_id)
 
-אחרי שתקבל את השם, השב: "נחמד להכיר אותך! אני אקרא לך: [השם שהמשתמש נתן]"
-מכיון ועד זה, זכור את השם הזה לכל השיחות הבאות והשתמש בו.
+def get_chat_action_status(chat_id: str, user_id: str) -> Optional[dict]:
+    """Action results of a chat turn: pending while any job is queued or running"""
+    record = find_chat_record(chat_id, user_id)
+    if not record:
+        return None
+    jobs = list(ai_action_jobs_collection.find(
+        {"chat_id": chat_id, "user_id": user_id},
+        {"_id": 0, "params": 0, "claim": 0, "user_id": 0, "chat_id": 0}
+    ).sort("index", 1))
+    pending = sum(1 for job in jobs if job['status'] in ('pending', 'running'))
+    return {
+        "chat_id": chat_id,
+        "status": "pending" if pending else record.get("actions_status", "none"),
+        "pending_actions": pending,
+        "response": record['ai_response'],
+        "updated_tables": record.get("updated_tables", []),
+        "actions": jobs
+    }
 
-**🚫 חובה - אל תמציא מידע:**
-- אם חסר לך מידע ספציפי - אמור במפורש "אין לי מידע על זה" או "לא מצאתי פרטים" 
-- אם אתה לא בטוח - אמור "אני לא בטוח" ובקש הבהרה
-- אם צריך מידע נוסף - שאל שאלות ברורות ומפורטות
+def recover_ai_action_jobs() -> dict:
+    """Run pending jobs whose executor never started (e.g. after a restart) and mark
+    jobs stuck in running as interrupted - their writes may have landed, so they are not re-run"""
+    pending_before = (datetime.now() - timedelta(seconds=AI_ACTION_PENDING_RETRY_SECONDS)).isoformat()
+    stale_before = (datetime.now() - timedelta(seconds=AI_ACTION_STALE_SECONDS)).isoformat()
+
+    stale_chats = ai_action_jobs_collection.distinct("chat_id", {"status": "running", "started_at": {"$lt": stale_before}})
+    if stale_chats:
+        ai_action_jobs_collection.update_many(
+            {"status": "running", "started_at": {"$lt": stale_before}},
+            {"$set": {"status": "interrupted", "finished_at": datetime.now().isoformat()}}
+        )
+        for chat_id in stale_chats:
+            _finish_chat_actions(chat_id)
 
-השב בעברית בצורה חמה ומקצועית.
-"""
-        else:
-            # Use the stored name or default behavior
-            display_name = user_name if user_name else "המשתמש"
-            system_message = f"""
-אתה ג'סיקה - האייג'נט AI של {display_name}, מנהל מחלקה בחיל הים הישראלי. 
+    pending_chats = {
+        (job['chat_id'], job['user_id'])
+        for job in ai_action_jobs_collection.find(
+            {"status": "pending", "created_at": {"$lt": pending_before}}, {"_id": 0, "chat_id": 1, "user_id": 1}
+        )
+    }
+    for chat_id, user_id in pending_chats:
+        execute_chat_actions(chat_id, user_id)
+    return {"recovered_chats": len(pending_chats), "interrupted_chats": len(stale_chats)}
+
+def find_chat_record(chat_id: str, user_id: str) -> Optional[dict]:
+    """A chat record by id, also while it is still in the chat log buffer"""
+    buffered = chat_log_writer.pending(lambda record: record["id"] == chat_id and record["user_id"] == user_id)
+    if buffered:
+        return buffered[0]
+    return ai_chat_history_collection.find_one({"id": chat_id, "user_id": user_id}, {"_id": 0})
+
+def replay_chat_response(chat_id: str, user_id: str) -> Optional[ChatResponse]:
+    """The stored reply for a message that was already answered (a client retry)"""
+    record = find_chat_record(chat_id, user_id)
+    if not record:
+        return None
+    pending = ai_action_jobs_collection.count_documents({"chat_id": chat_id, "status": {"$in": ["pending", "running"]}})
+    if pending and chat_id not in ai_action_tasks:
+        schedule_chat_actions(chat_id, user_id, record.get('session_id'))
+    print(f"↩️ Replaying chat {chat_id} for a retried message")
+    return ChatResponse(
+        response=record['ai_response'],
+        updated_tables=record.get('updated_tables', []),
+        context_tokens=record.get('context_tokens', 0),
+        intent=record.get('fast_path'),
+        chat_id=chat_id,
+        pending_actions=pending
+    )
+
+# Jessica System Prompt
+# The static part (role, action grammar, examples) comes first and is byte-identical
+# for every user and request, so the provider can cache it as a prompt prefix.
+# Per-user and per-request sections are appended after it - never put anything
+# dynamic in here.
+JESSICA_STATIC_PROMPT = """
+אתה ג'סיקה - האייג'נט AI של מנהל מחלקה בחיל הים הישראלי. 
 אתה משלב שלושה תפקידים מרכזיים:
 
 1. **מערכת ניהול מחלקה מתקדמת** 
@@ -1319,24 +3201,17 @@ async def create_yahel_ai_agent(user_message: str, session_id: str = None, chat_
 3. **מאמן אישי** לפיתוח מנהיגות צבאית-אישית
 
 🧬 **עקרונות המארג הקוונטי שאתה מיישם:**
-- **עקרון אי-ההשוואה™**: עזור ל{display_name} לבנות זהות מנהיגותית ייחודית
-- **נאמנות ל-DNA™**: כל החלטה עקבית עם הזהות והערכים של {display_name}
+- **עקרון אי-ההשוואה™**: עזור למשתמש לבנות זהות מנהיגותית ייחודית
+- **נאמנות ל-DNA™**: כל החלטה עקבית עם הזהות והערכים של המשתמש
 - **זמן קוונטי ומהירות אקספוננציאלית™**: תוצאות פי 10, לא פלוס 10%
-- **בריאה עצמית אוטונומית™**: {display_name} מפתח בעצמו את היכולות הנדרשות
+- **בריאה עצמית אוטונומית™**: המשתמש מפתח בעצמו את היכולות הנדרשות
 
 **🚫 חובה - אל תמציא מידע:**
 - אם חסר לך מידע ספציפי (מספרי תקלה, שמות, זמנים, תאריכים) - אמור במפורש "אין לי מידע על זה" או "לא מצאתי פרטים על זה במערכת"
-- אם לא בטוח במידע - אמור "אני לא בטוח בפרט הזה" ובקש הבהרה מ{display_name}
+- אם לא בטוח במידע - אמור "אני לא בטוח בפרט הזה" ובקש הבהרה מהמשתמש
 - אם צריך להזין ערך ואין לך מידע - השאר ריק או תזין "לא צוין"
-- כשמבקש מ{display_name} מידע חסר - שאל שאלות ברורות ומפורטות: "איזה תאריך?", "איזה טכנאי?", "כמה זמן בדיוק?"
-
-📊 **נתוני המחלקה הנוכחיים:**
-{json.dumps(dept_data, ensure_ascii=False, indent=2)}
+- כשמבקש מהמשתמש מידע חסר - שאל שאלות ברורות ומפורטות: "איזה תאריך?", "איזה טכנאי?", "כמה זמן בדיוק?"
 
-🎯 **נתוני הליווי המנהיגותי:**
-{json.dumps(leadership_data, ensure_ascii=False, indent=2)}
-
-{conversation_context}
 
 💪 **יכולות עדכון טבלאות מלא:**
 אתה יכול להוסיף, לעדכן ולמחוק פריטים בכל הטבלאות. השתמש בפורמטים הבאים:
@@ -1364,7 +3239,7 @@ async def create_yahel_ai_agent(user_message: str, session_id: str = None, chat_
 [DELETE_DAILY_WORK: id="work_id"]
 
 **טבלאות ליווי מנהיגותי:**
-[ADD_CONVERSATION: meeting_number="5", date="2025-08-14", duration_minutes="45", main_topics="פיתוח מנהיגות,תכנון קריירה", insights="{display_name} מראה התקדמות בביטחון עצמי", decisions="להתמקד בפיתוח כישורי תקשורת", next_step="תרגול מתן פידבק לצוות", energy_level="8"]
+[ADD_CONVERSATION: meeting_number="5", date="2025-08-14", duration_minutes="45", main_topics="פיתוח מנהיגות,תכנון קריירה", insights="המשתמש מראה התקדמות בביטחון עצמי", decisions="להתמקד בפיתוח כישורי תקשורת", next_step="תרגול מתן פידבק לצוות", energy_level="8"]
 
 [ADD_DNA_ITEM: component_name="זהות ותפקיד", current_definition="צ'יף מנוסה עם חזון לשיפור המחלקה", clarity_level="7", gaps_identified="צריך להגדיר טוב יותר את הסגנון המנהיגותי הייחודי", development_plan="שיחות עומק על ערכים אישיים ומקצועיים"]
 
@@ -1443,89 +3318,1571 @@ async def create_yahel_ai_agent(user_message: str, session_id: str = None, chat_
 
 השב בעברית, בצורה ישירה ומעשית, כמי שמכיר את המשתמש באופן אישי ויודע את ההיסטוריה שלכם.
 
-📊 **נתוני המחלקה הנוכחיים:**
-{json.dumps(dept_data, ensure_ascii=False, indent=2)}
+פרטי המשתמש, נתוני המחלקה העדכניים והיסטוריית השיחה מופיעים בהמשך.
+"""
+JESSICA_STATIC_PROMPT_TOKENS = estimate_tokens(JESSICA_STATIC_PROMPT)
+JESSICA_STATIC_PROMPT_VERSION = hashlib.sha256(JESSICA_STATIC_PROMPT.encode('utf-8')).hexdigest()[:12]
+
+def build_user_prompt_section(user_name: Optional[str], first_interaction: bool) -> str:
+    """Per-user part of the system prompt"""
+    if first_interaction:
+        return """
+👤 **המשתמש:**
+שם המשתמש עדיין לא ידוע.
 
-🎯 **נתוני הליווי המנהיגותי:**
-{json.dumps(leadership_data, ensure_ascii=False, indent=2)}
+🎯 **משימה ראשונה חשובה:**
+שאל את המשתמש: "איך אתה רוצה שאני אקרא לך?" 
+אל תמציא שמות ואל תקרא לו בשום שם עד שהוא יגיד לך במפורש.
 
+אחרי שתקבל את השם, השב: "נחמד להכיר אותך! אני אקרא לך: [השם שהמשתמש נתן]"
+מכיון ועד זה, זכור את השם הזה לכל השיחות הבאות והשתמש בו.
+"""
+    if user_name:
+        return f"""
+👤 **המשתמש:**
+{user_name}, מנהל מחלקה בחיל הים הישראלי. פנה אליו בשם {user_name}.
+"""
+    return """
+👤 **המשתמש:**
+מנהל מחלקה בחיל הים הישראלי. שמו לא נרשם - אל תמציא לו שם.
+"""
+
+def build_request_prompt_section(ai_context: dict, conversation_context: str, similar_failures: str = "") -> str:
+    """Per-request part of the system prompt: live data, similar past failures and the current conversation"""
+    return f"""
+📊 **נתוני המחלקה והליווי המנהיגותי** (מסודרים לפי רלוונטיות, עמודות מופרדות ב-|):
+{ai_context['text']}
+{similar_failures}
 {conversation_context}
-        """
-        
-        # Create session ID if not provided
-        if not session_id:
-            session_id = f"yahel_chat_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+"""
+
+def record_prompt_usage(usage: dict) -> dict:
+    """Pull prompt / cached / completion token counts out of a provider usage block"""
+    if not usage:
+        return {}
+    return {
+        "prompt_tokens": usage.get("prompt_tokens"),
+        "cached_tokens": (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0),
+        "completion_tokens": usage.get("completion_tokens")
+    }
+
+def estimate_prompt_usage(chat_request: dict, response: str) -> dict:
+    """Token counts for providers that don't report usage (LlmChat), from the local tokenizer"""
+    return {
+        "prompt_tokens": chat_request["system_prompt_tokens"] + estimate_tokens(chat_request["user_message"]),
+        "cached_tokens": 0,
+        "completion_tokens": estimate_tokens(response),
+        "usage_estimated": True
+    }
+
+# Usage Metering
+def record_llm_usage(user_id: Optional[str], tier: str, prompt_usage: dict, context_tokens: int, latency_ms: float):
+    """Add one LLM call to the user's daily usage rollup"""
+    prompt_tokens = prompt_usage.get("prompt_tokens") or 0
+    completion_tokens = prompt_usage.get("completion_tokens") or 0
+    try:
+        llm_usage_daily_collection.update_one(
+            {"date": datetime.now().isoformat()[:10], "user_id": user_id},
+            {
+                "$inc": {
+                    "calls": 1,
+                    f"tiers.{tier}": 1,
+                    "prompt_tokens": prompt_tokens,
+                    "cached_tokens": prompt_usage.get("cached_tokens") or 0,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                    "context_tokens": context_tokens,
+                    "latency_ms": latency_ms
+                },
+                "$max": {"max_latency_ms": latency_ms, "max_prompt_tokens": prompt_tokens},
+                "$set": {"updated_at": datetime.now().isoformat()}
+            },
+            upsert=True
+        )
+    except Exception as e:
+        print(f"Error recording LLM usage: {e}")
+
+def get_llm_usage_top(days: int = 7, limit: int = 10, user_id: Optional[str] = None) -> dict:
+    """Heaviest users (from the daily rollup) and heaviest prompts (from chat records) over the last N days.
+    With user_id only that user's usage is included. Prompts are listed by size and shape, never by text"""
+    since = (datetime.now() - timedelta(days=days)).isoformat()[:10]
+    scope = {"user_id": user_id} if user_id else {}
+    users = list(llm_usage_daily_collection.aggregate([
+        {"$match": {"date": {"$gte": since}, **scope}},
+        {"$group": {
+            "_id": "$user_id",
+            "calls": {"$sum": "$calls"},
+            "prompt_tokens": {"$sum": "$prompt_tokens"},
+            "cached_tokens": {"$sum": "$cached_tokens"},
+            "completion_tokens": {"$sum": "$completion_tokens"},
+            "total_tokens": {"$sum": "$total_tokens"},
+            "context_tokens": {"$sum": "$context_tokens"},
+            "latency_ms": {"$sum": "$latency_ms"},
+            "max_latency_ms": {"$max": "$max_latency_ms"}
+        }},
+        {"$sort": {"total_tokens": -1}},
+        {"$limit": limit}
+    ]))
+    names = {
+        user['id']: user.get('name')
+        for user in authenticated_users_collection.find(
+            {"id": {"$in": [row['_id'] for row in users if row['_id']]}}, {"_id": 0, "id": 1, "name": 1}
+        )
+    }
+    heaviest_users = []
+    for row in users:
+        calls = row['calls'] or 1
+        heaviest_users.append({
+            "user_id": row['_id'],
+            "name": names.get(row['_id']),
+            "calls": row['calls'],
+            "prompt_tokens": row['prompt_tokens'],
+            "cached_tokens": row['cached_tokens'],
+            "completion_tokens": row['completion_tokens'],
+            "total_tokens": row['total_tokens'],
+            "avg_prompt_tokens": round(row['prompt_tokens'] / calls),
+            "avg_context_tokens": round(row['context_tokens'] / calls),
+            "avg_latency_ms": round(row['latency_ms'] / calls, 1),
+            "max_latency_ms": row['max_latency_ms']
+        })
+
+    heaviest_prompts = list(ai_chat_history_collection.find(
+        {"timestamp": {"$gte": since}, "prompt_tokens": {"$gt": 0}, **scope},
+        {"_id": 0, "id": 1, "user_id": 1, "session_id": 1, "timestamp": 1, "tier": 1, "model": 1,
+         "prompt_tokens": 1, "completion_tokens": 1, "context_tokens": 1, "system_prompt_tokens": 1,
+         "context_sections": 1, "latency_ms": 1}
+    ).sort("prompt_tokens", -1).limit(limit))
+
+    return {"days": days, "heaviest_users": heaviest_users, "heaviest_prompts": heaviest_prompts}
+
+# Chat History
+CHAT_HISTORY_RECENT_TURNS = 3  # Turns kept verbatim in the prompt
+CHAT_SUMMARY_MAX_LINES = 12  # Older turns kept as one summary line each, oldest dropped first
+CHAT_SUMMARY_LINE_CHARS = 140
+USER_NAME_PATTERN = re.compile(r'אני אקרא לך:\s*([^\s,.\n]+)')
+
+def load_chat_history(user_id: str, session_id: str) -> dict:
+    """Load the session's rolling summary and its last turns from the database
+    (plus turns still waiting in the chat log buffer)"""
+    stored = list(ai_chat_history_collection.find(
+        {"session_id": session_id, "user_id": user_id},
+        {"_id": 0, "user_message": 1, "ai_response": 1, "timestamp": 1}
+    ).sort("timestamp", -1).limit(CHAT_HISTORY_RECENT_TURNS))
+    buffered = chat_log_writer.pending(lambda record: record["session_id"] == session_id and record["user_id"] == user_id)
+    recent = sorted(stored + [
+        {"user_message": record["user_message"], "ai_response": record["ai_response"], "timestamp": record["timestamp"]}
+        for record in buffered
+    ], key=lambda record: record["timestamp"])[-CHAT_HISTORY_RECENT_TURNS:]
+    summary = chat_session_summaries_collection.find_one({"session_id": session_id, "user_id": user_id}, {"_id": 0}) or {}
+    return {
+        "summary": summary.get("summary_lines", []),
+        "recent": recent,
+        "turns": max(summary.get("turns", 0), len(recent))
+    }
+
+def build_conversation_context(history: dict) -> str:
+    """Conversation section of the prompt: summary of older turns, then the recent turns"""
+    if not history["summary"] and not history["recent"]:
+        return ""
+    conversation_context = "\n\n📝 **היסטוריית השיחה הנוכחית:**\n"
+    if history["summary"]:
+        conversation_context += "סיכום החלק המוקדם של השיחה:\n" + "\n".join(f"- {line}" for line in history["summary"]) + "\n\n"
+    for record in history["recent"]:
+        conversation_context += f"יהל: {record.get('user_message', '')}\n"
+        conversation_context += f"ג'סיקה: {record.get('ai_response', '')[:200]}...\n"
+    return conversation_context
+
+def _first_sentence(text: str, limit: int) -> str:
+    """First sentence or line of a message, cut to the given length"""
+    sentence = re.split(r'(?<=[.!?])\s|\n', text.strip(), maxsplit=1)[0]
+    return sentence if len(sentence) <= limit else sentence[:limit - 1] + "…"
+
+def summarize_chat_turn(record: dict) -> str:
+    """One extractive summary line for a chat turn: what was asked and what changed"""
+    line = f"יהל: {_first_sentence(record.get('user_message', ''), CHAT_SUMMARY_LINE_CHARS // 2)}"
+    if record.get("closed_failures"):
+        line += f" | נסגרו: {', '.join(record['closed_failures'])}"
+    if record.get("updated_tables"):
+        line += f" | עודכן: {', '.join(record['updated_tables'])}"
+    else:
+        line += f" | ג'סיקה: {_first_sentence(record.get('ai_response', ''), CHAT_SUMMARY_LINE_CHARS // 2)}"
+    return line
+
+def update_session_summary(user_id: str, session_id: str):
+    """Fold turns that left the recent window into the session's rolling summary"""
+    try:
+        summary = chat_session_summaries_collection.find_one({"session_id": session_id, "user_id": user_id}) or {}
+        summarized_until = summary.get("summarized_until", "")
+        records = list(ai_chat_history_collection.find(
+            {"session_id": session_id, "user_id": user_id, "timestamp": {"$gt": summarized_until}},
+            {"_id": 0}
+        ).sort("timestamp", 1))
+        if not records:
+            return
+        
+        to_summarize = records[:-CHAT_HISTORY_RECENT_TURNS]
+        lines = summary.get("summary_lines", []) + [summarize_chat_turn(record) for record in to_summarize]
+        summarized_turns = summary.get("summarized_turns", 0)
+        update = {
+            "summary_lines": lines[-CHAT_SUMMARY_MAX_LINES:],
+            "summarized_until": to_summarize[-1]["timestamp"] if to_summarize else summarized_until,
+            "summarized_turns": summarized_turns + len(to_summarize),
+            "turns": summarized_turns + len(records),
+            "updated_at": datetime.now().isoformat()
+        }
         
-        # Initialize chat with OpenAI
+        # Only apply if no other update moved the summary forward in the meantime
+        chat_session_summaries_collection.update_one(
+            {"session_id": session_id, "user_id": user_id, "summarized_until": summarized_until},
+            {"$set": update},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        pass  # A concurrent update won - the next turn catches up
+    except Exception as e:
+        print(f"Error updating chat summary for session {session_id}: {e}")
+
+def update_flushed_session_summaries(records: List[dict]):
+    """Update the rolling summaries of the sessions whose chat records were just written"""
+    for user_id, session_id in dict.fromkeys((record.get("user_id"), record.get("session_id")) for record in records):
+        if user_id:
+            update_session_summary(user_id, session_id)
+
+def get_preferred_name(current_user: dict = None) -> Optional[str]:
+    """The user's preferred name from their profile.
+
+    Users who told Jessica their name before it was stored on the profile get it
+    backfilled from the last "אני אקרא לך:" reply in their chat history. The
+    history is searched once per user; preferred_name_checked on the profile
+    records that it was, whether a name was found or not.
+    """
+    if not current_user:
+        return None
+    if current_user.get('preferred_name'):
+        return current_user['preferred_name']
+    if current_user.get('preferred_name_checked'):
+        return None
+    record = ai_chat_history_collection.find_one(
+        {"user_id": current_user['id'], "ai_response": {"$regex": "אני אקרא לך:"}},
+        {"_id": 0, "ai_response": 1},
+        sort=[("timestamp", -1)]
+    )
+    match = USER_NAME_PATTERN.search(record["ai_response"]) if record else None
+    if not match:
+        authenticated_users_collection.update_one({"id": current_user['id']}, {"$set": {"preferred_name_checked": True}})
+        user_cache.invalidate(current_user['id'])
+        current_user['preferred_name_checked'] = True
+        return None
+    set_preferred_name(current_user['id'], match.group(1))
+    return match.group(1)
+
+def user_has_chat_history(user_id: str) -> bool:
+    return (bool(chat_log_writer.pending(lambda record: record["user_id"] == user_id))
+            or ai_chat_history_collection.find_one({"user_id": user_id}, {"_id": 1}) is not None)
+
+def new_chat_session_id() -> str:
+    """Session ID for a chat started without one"""
+    return f"yahel_chat_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+
+# Chat Model Routing
+# Each message is classified into a tier with its own model and context budget:
+# acknowledgements get no data context, commands and data questions get the
+# department tables, coaching conversations get everything including leadership.
+AI_CHAT_MODEL_LIGHT = os.environ.get('AI_CHAT_MODEL_LIGHT', AI_CHAT_MODEL)
+AI_CHAT_MODEL_COACHING = os.environ.get('AI_CHAT_MODEL_COACHING', AI_CHAT_MODEL)
+
+CHAT_TIERS = {
+    "ack": {
+        "model": AI_CHAT_MODEL_LIGHT,
+        "context_budget": 0,
+        "sections": ()
+    },
+    "command": {
+        "model": AI_CHAT_MODEL,
+        "context_budget": int(os.environ.get('AI_CONTEXT_BUDGET_COMMAND', '1500')),
+        "sections": None  # Commands may target any table
+    },
+    "data": {
+        "model": AI_CHAT_MODEL,
+        "context_budget": int(os.environ.get('AI_CONTEXT_BUDGET_DATA', '2500')),
+        "sections": DEPARTMENT_CONTEXT_SECTIONS
+    },
+    "coaching": {
+        "model": AI_CHAT_MODEL_COACHING,
+        "context_budget": AI_CONTEXT_TOKEN_BUDGET,
+        "sections": None
+    }
+}
+
+CHAT_ACK_MAX_WORDS = 4
+# No "כן" / "לא": a bare yes or no often confirms an action Jessica proposed
+CHAT_ACK_WORDS = {'תודה', 'רבה', 'תודות', 'אוקיי', 'אוקי', 'אוק', 'ok', 'סבבה', 'מעולה', 'יופי', 'אחלה', 'בסדר',
+                  'מצוין', 'קיבלתי', 'הבנתי', 'נהדר', 'טוב', 'שלום', 'היי', 'הי', 'בוקר', 'ערב', 'לילה',
+                  'ג\'סיקה', 'ממש', 'מאוד', 'על', 'הכל', 'העזרה', 'תותחית', 'אלופה', 'ביי', 'להתראות', '👍', '🙏'}
+CHAT_COMMAND_PATTERN = re.compile(
+    r'\b(?:ת?הוסיפ?[יו]?|תוסיפ[יו]|תוסיף|להוסיף|ת?רשמ?[יו]?|תרשום|לרשום|ת?עדכנ?[יו]?|תעדכן|לעדכן|ת?מחק[יו]?|תמחוק|למחוק|'
+    r'ת?סגו?ר[יו]?|לסגור|ת?קבע[יו]?|לקבוע|ת?שנ[יו]|לשנות|תקלה\s+חדשה|נפתחה\s+תקלה|יש\s+תקלה)\b'
+)
+CHAT_COACHING_PATTERN = re.compile(
+    r'(?:צוות|מנהיג|הנעה|מוטיבציה|משוב|פידבק|שיחה|שיחת|פגישה|חניכה|אימון|DNA|90\s*יום|יעד|חזון|ערכים|'
+    r'לחץ|עומס|קונפליקט|סכסוך|אמון|להאציל|האצלה|עצה|מרגיש|מתלבט|למה|איך\s+(?:אני|לדבר|להתמודד|לשפר))'
+)
+
+def classify_chat_message(user_message: str) -> str:
+    """Route a message to a tier: ack, command, data or coaching.
+    Anything that is not clearly one of the cheaper tiers is treated as coaching."""
+    text = _normalize_chat_query(user_message).lower()
+    words = text.split()
+    if words and len(words) <= CHAT_ACK_MAX_WORDS and all(word in CHAT_ACK_WORDS for word in words):
+        return "ack"
+    if CHAT_COACHING_PATTERN.search(text):
+        return "coaching"
+    if CHAT_COMMAND_PATTERN.search(text):
+        return "command"
+    if CHAT_QUERY_START.match(text):
+        return "data"
+    return "coaching"
+
+class ChatTierMetrics:
+    """In-process latency and token counters per routing tier"""
+
+    def __init__(self, window: int = 500):
+        self.window = window
+        self._tiers = {}
+
+    def record(self, tier: str, latency_ms: float, context_tokens: int, prompt_usage: dict):
+        stats = self._tiers.setdefault(tier, {
+            "calls": 0, "context_tokens": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0,
+            "latencies": deque(maxlen=self.window)
+        })
+        stats["calls"] += 1
+        stats["context_tokens"] += context_tokens
+        for field in ("prompt_tokens", "cached_tokens", "completion_tokens"):
+            stats[field] += prompt_usage.get(field) or 0
+        stats["latencies"].append(latency_ms)
+
+    def snapshot(self) -> dict:
+        result = {}
+        for tier, stats in self._tiers.items():
+            latencies = np.array(stats["latencies"])
+            calls = stats["calls"]
+            result[tier] = {
+                "model": CHAT_TIERS[tier]["model"],
+                "context_budget": CHAT_TIERS[tier]["context_budget"],
+                "calls": calls,
+                "latency_ms_p50": round(float(np.percentile(latencies, 50)), 1),
+                "latency_ms_p95": round(float(np.percentile(latencies, 95)), 1),
+                "avg_context_tokens": round(stats["context_tokens"] / calls),
+                "avg_prompt_tokens": round(stats["prompt_tokens"] / calls),
+                "avg_cached_tokens": round(stats["cached_tokens"] / calls),
+                "avg_completion_tokens": round(stats["completion_tokens"] / calls)
+            }
+        return result
+
+chat_tier_metrics = ChatTierMetrics()
+
+def build_ai_chat_request(user_message: str, session_id: str = None, chat_history: List[dict] = None, current_user: dict = None,
+                          chat_id: str = None) -> dict:
+    """Build the system prompt and data context for an AI chat turn"""
+    started_at = time.perf_counter()
+    user_id = current_user['id'] if current_user else None
+    tier = classify_chat_message(user_message)
+    tier_config = CHAT_TIERS[tier]
+    
+    # Get the tier's context (cached per user until the underlying data changes)
+    if user_id and tier_config["context_budget"] > 0:
+        context_entry = get_cached_ai_context(user_id, tier_config["context_budget"], tier_config["sections"])
+    else:
+        context_entry = {
+            "context": build_ai_context({}, {}, tier_config["context_budget"]),
+            "summary": {},
+            "leadership_context": 0,
+            "cached": False
+        }
+    ai_context = context_entry["context"]
+    
+    # Create session ID if not provided
+    if not session_id:
+        session_id = new_chat_session_id()
+    
+    # Past resolved failures similar to the message (not for acknowledgements)
+    similar = []
+    if user_id and tier != "ack":
+        versions = context_entry.get("versions") or get_data_versions(user_id)
+        similar = resolved_failure_index.search(user_id, user_message, versions["resolved_failures"])
+    
+    # Conversation history is loaded server-side: rolling summary + last turns
+    history = load_chat_history(user_id, session_id) if user_id else {"summary": [], "recent": [], "turns": 0}
+    conversation_context = build_conversation_context(history)
+    user_name = get_preferred_name(current_user)
+    
+    # Static prefix first, then the per-user and per-request sections.
+    # The name question only runs for users who have never chatted.
+    first_interaction = not user_name and (not user_id or not user_has_chat_history(user_id))
+    system_message = "\n".join([
+        JESSICA_STATIC_PROMPT,
+        build_user_prompt_section(user_name, first_interaction),
+        build_request_prompt_section(ai_context, conversation_context, build_similar_failures_section(similar))
+    ])
+    
+    system_prompt_tokens = estimate_tokens(system_message)
+    print(f"AI context for user {user_id} ({tier}): {ai_context['tokens']} context tokens, {system_prompt_tokens} system prompt tokens "
+          f"({JESSICA_STATIC_PROMPT_TOKENS} static, cached: {context_entry['cached']})")
+
+    return {
+        "chat_id": chat_id or str(uuid.uuid4()),
+        "user_id": user_id,
+        "session_id": session_id,
+        "user_message": user_message,
+        "history_turns": history["turns"],
+        "user_name": user_name,
+        "system_message": system_message,
+        "system_prompt_tokens": system_prompt_tokens,
+        "context_entry": context_entry,
+        "ai_context": ai_context,
+        "tier": tier,
+        "model": tier_config["model"],
+        "similar_failures": [doc.get("failure_number") for doc in similar],
+        "started_at": started_at,
+        "usage": {}  # Filled with the provider's token usage when it reports one
+    }
+
+async def complete_ai_chat(chat_request: dict, response: str) -> ChatResponse:
+    """Store the chat record, queue actions from the AI response for the background executor and build the reply"""
+    raw_response = response
+    user_id = chat_request["user_id"]
+    context_entry = chat_request["context_entry"]
+    ai_context = chat_request["ai_context"]
+
+    # Parse database actions; they run after the reply is returned
+    actions, clean_response = tokenize_ai_actions(response)
+    if clean_response != response:
+        # Remove action tags from response
+        response = clean_response.strip()
+    if not user_id:
+        actions = []
+    
+    # Remember the name once Jessica confirms it
+    name_match = USER_NAME_PATTERN.search(response)
+    if name_match and user_id and name_match.group(1) != chat_request["user_name"]:
+        set_preferred_name(user_id, name_match.group(1))
+    elif not actions:
+        store_cached_response(chat_request, response)
+    
+    prompt_usage = record_prompt_usage(chat_request["usage"])
+    if prompt_usage:
+        print(f"Prompt cache: {prompt_usage['cached_tokens']}/{prompt_usage['prompt_tokens']} prompt tokens cached")
+    else:
+        prompt_usage = estimate_prompt_usage(chat_request, raw_response)
+    latency_ms = round((time.perf_counter() - chat_request["started_at"]) * 1000, 1)
+    chat_tier_metrics.record(chat_request["tier"], latency_ms, ai_context["tokens"], prompt_usage)
+    record_llm_usage(user_id, chat_request["tier"], prompt_usage, ai_context["tokens"], latency_ms)
+    
+    # Store chat history in database
+    chat_id = chat_request["chat_id"]
+    chat_record = {
+        "id": chat_id,
+        "session_id": chat_request["session_id"],
+        "user_id": user_id,  # Add user_id
+        "user_message": chat_request["user_message"],
+        "ai_response": response,
+        "timestamp": datetime.now().isoformat(),
+        "department_context": context_entry["summary"],
+        "leadership_context": context_entry["leadership_context"],
+        "context_cached": context_entry["cached"],
+        "context_tokens": ai_context["tokens"],
+        "context_sections": ai_context["sections"],
+        "system_prompt_tokens": chat_request["system_prompt_tokens"],
+        "static_prompt_tokens": JESSICA_STATIC_PROMPT_TOKENS,
+        "prompt_prefix_version": JESSICA_STATIC_PROMPT_VERSION,
+        "tier": chat_request["tier"],
+        "model": chat_request["model"],
+        "similar_failures": chat_request["similar_failures"],
+        "latency_ms": latency_ms,
+        **prompt_usage,
+        "updated_tables": [],  # Filled in by the action executor
+        "closed_failures": [],
+        "actions_status": "pending" if actions else "none",
+        "history_turns": chat_request["history_turns"]
+    }
+    chat_log_writer.add(chat_record)
+    if actions:
+        queue_ai_actions(chat_id, user_id, actions)
+        schedule_chat_actions(chat_id, user_id, chat_request["session_id"])
+    
+    return ChatResponse(
+        response=response,
+        updated_tables=[],
+        context_tokens=ai_context["tokens"],
+        chat_id=chat_id,
+        pending_actions=len(actions)
+    )
+
+def ai_error_response(error_msg: str) -> ChatResponse:
+    """Friendly error reply for failed AI calls"""
+    if "AuthenticationError" in error_msg or "API key" in error_msg:
+        return ChatResponse(
+            response="מצטער, יש בעיה זמנית בחיבור למערכת הAI. אנא נסה שוב מאוחר יותר.",
+            success=False,
+            updated_tables=[]
+        )
+    return ChatResponse(
+        response="מצטער, אירעה שגיאה. אנא נסה שוב או פנה למנהל המערכת.",
+        success=False,
+        updated_tables=[]
+    )
+
+# Chat Command Fast Path
+# Plain commands the system prompt already maps to a single action are executed
+# directly, without an LLM call. Only whole-message matches are handled; anything
+# else goes to the model.
+FAILURE_NUMBER = r'(?P<failure_number>[Ff]\d+)'
+FAILURE_WORD = r'(?:את\s+)?(?:ה)?תקלה\s+(?:מספר\s+)?'
+COMMAND_POLITE = r'(?:(?:בבקשה|נא)\s+)?'
+COMMAND_END = r'(?:\s+בבקשה)?\s*[.!]*\s*'
+
+CLOSE_FAILURE_COMMANDS = [
+    # סגרי את התקלה F123
+    re.compile(COMMAND_POLITE + r'(?:ת?סגו?ר[יו]?|לסגור)\s+' + FAILURE_WORD + FAILURE_NUMBER + COMMAND_END),
+    # התקלה F123 טופלה
+    re.compile(r'(?:ה)?תקלה\s+(?:מספר\s+)?' + FAILURE_NUMBER + r'\s+(?:טופלה|נסגרה|הושלמה|תוקנה|סודרה)' + COMMAND_END),
+    # סיימנו עם התקלה F123
+    re.compile(r'סיימנו\s+(?:עם\s+)?' + FAILURE_WORD + FAILURE_NUMBER + COMMAND_END),
+]
+
+# Labels of the resolution details follow-up, e.g. "זמן: 3 שעות, מי: רונן, מניעה: בדיקה חודשית"
+RESOLUTION_DETAIL_LABELS = {
+    'איך': 'resolution_method',
+    'פתרון': 'resolution_method',
+    'זמן': 'actual_hours',
+    'מי': 'resolved_by',
+    'מניעה': 'lessons_learned',
+    'לקחים': 'lessons_learned',
+}
+RESOLUTION_DETAIL_LABEL = re.compile(r'(?:^|(?<=[\s,;]))(' + '|'.join(RESOLUTION_DETAIL_LABELS) + r')\s*:\s*')
+RESOLUTION_HOURS = re.compile(r'\d+(?:\.\d+)?')
+
+def match_close_failure_command(user_message: str) -> Optional[str]:
+    """Return the failure number if the message is a plain close-failure command"""
+    text = user_message.strip()
+    for pattern in CLOSE_FAILURE_COMMANDS:
+        match = pattern.fullmatch(text)
+        if match:
+            return match.group('failure_number').upper()
+    return None
+
+def parse_resolution_details(user_message: str) -> Optional[dict]:
+    """Parse a labelled resolution details message into UPDATE_RESOLVED_FAILURE params.
+    The message must start with a label; returns None otherwise"""
+    text = user_message.strip()
+    labels = list(RESOLUTION_DETAIL_LABEL.finditer(text))
+    if not labels or labels[0].start() != 0:
+        return None
+    params = {}
+    for label, next_label in zip(labels, labels[1:] + [None]):
+        value = text[label.end():next_label.start() if next_label else len(text)].strip(' \t\n,;.')
+        field = RESOLUTION_DETAIL_LABELS[label.group(1)]
+        if field == 'actual_hours':
+            hours = RESOLUTION_HOURS.search(value)
+            if not hours:
+                continue
+            value = hours.group(0)
+        if value:
+            params[field] = value
+    return params or None
+
+def last_closed_failure(user_id: str, session_id: str) -> Optional[str]:
+    """Failure number most recently closed in this chat session"""
+    buffered = chat_log_writer.pending(
+        lambda record: record["session_id"] == session_id and record["user_id"] == user_id and record.get("closed_failures")
+    )
+    if buffered:
+        return buffered[-1]["closed_failures"][-1]
+    record = ai_chat_history_collection.find_one(
+        {"session_id": session_id, "user_id": user_id, "closed_failures": {"$exists": True, "$ne": []}},
+        {"_id": 0, "closed_failures": 1},
+        sort=[("timestamp", -1)]
+    )
+    return record["closed_failures"][-1] if record else None
+
+def handle_chat_command(user_message: str, session_id: str = None, chat_history: List[dict] = None, current_user: dict = None,
+                        chat_id: str = None) -> Optional[ChatResponse]:
+    """Answer plain commands without the LLM. Returns None when the message needs the model"""
+    if not current_user:
+        return None
+    user_id = current_user['id']
+    if not session_id:
+        session_id = new_chat_session_id()
+    
+    failure_number = match_close_failure_command(user_message)
+    if failure_number:
+        intent = "close_failure"
+        actions = [('update_failure', {'failure_number': failure_number, 'status': 'נסגר'})]
+    else:
+        details = parse_resolution_details(user_message)
+        failure_number = last_closed_failure(user_id, session_id) if details else None
+        if not failure_number:
+            return None
+        intent = "resolution_details"
+        actions = [('update_resolved_failure', {'failure_number': failure_number, **details})]
+    
+    results = run_ai_actions(actions, user_id)
+    updated_tables = apply_ai_action_results(results, user_id)
+    closed_failures = closed_failure_numbers(results)
+    result = results[0]
+    
+    if result['status'] == 'not_found':
+        if intent == "close_failure":
+            response = f"לא מצאתי תקלה פעילה מספר {failure_number}. כדאי לבדוק את המספר בטבלת התקלות הפעילות."
+        else:
+            response = f"לא מצאתי את התקלה {failure_number} בתקלות שטופלו, ולכן לא עדכנתי את פרטי הטיפול."
+    elif result['status'] != 'ok':
+        response = "מצטער, לא הצלחתי לעדכן את התקלה. אנא נסה שוב."
+    elif intent == "close_failure":
+        system = result['failure'].get('system')
+        response = (
+            f"סגרתי את התקלה {failure_number}{f' ({system})' if system else ''} והעברתי אותה לתקלות שטופלו.\n\n"
+            "כדי לתעד את הטיפול, ספר לי בקצרה:\n"
+            "איך: מה היה הפתרון?\n"
+            "זמן: כמה שעות זה לקח?\n"
+            "מי: מי טיפל?\n"
+            "מניעה: מה ימנע את התקלה בעתיד?"
+        )
+    else:
+        response = f"תודה! עדכנתי את פרטי הטיפול בתקלה {failure_number}."
+    
+    if updated_tables:
+        response += f"\n\n✅ עדכנתי: {', '.join(updated_tables)}"
+    
+    print(f"⚡ Chat command fast path: {intent} {failure_number} ({result['status']})")
+    chat_id = save_fast_path_chat(user_id, session_id, user_message, response, intent, chat_history, updated_tables, closed_failures, chat_id)
+    return ChatResponse(response=response, updated_tables=updated_tables, intent=intent, chat_id=chat_id)
+
+def save_fast_path_chat(user_id: str, session_id: str, user_message: str, response: str, intent: str,
+                        chat_history: List[dict] = None, updated_tables: List[str] = None, closed_failures: List[str] = None,
+                        chat_id: str = None) -> str:
+    """Store a chat turn answered without the LLM under the message's chat record id
+    (see chat_record_id), so a retried message is replayed instead of run again"""
+    chat_id = chat_id or chat_record_id(user_id)
+    chat_log_writer.add({
+        "id": chat_id,
+        "session_id": session_id,
+        "user_id": user_id,
+        "user_message": user_message,
+        "ai_response": response,
+        "timestamp": datetime.now().isoformat(),
+        "fast_path": intent,
+        "updated_tables": updated_tables or [],
+        "closed_failures": closed_failures or [],
+        "chat_history_length": len(chat_history) if chat_history else 0
+    })
+    return chat_id
+
+# Chat Query Intents
+# Read-only questions answered straight from the database. Only short questions
+# that are not coaching, without action or reasoning words, are considered. Each
+# intent pattern must reach the end of the question, so a list-style question
+# matches but the same words inside a longer free-form message do not. The
+# first matching intent wins.
+CHAT_QUERY_MAX_LENGTH = 80
+CHAT_QUERY_LEAD = r'^(?:(?:היי|הי|שלום) )?(?:ג\'סיקה )?(?:(?:תגידי|תראי)(?: לי)? )?'
+CHAT_QUERY_START = re.compile(CHAT_QUERY_LEAD + r'(?:כמה|מה|מהן|מהם|אילו|איזה|איזו|אלו|יש|רשימת)\b')
+CHAT_QUERY_EXCLUDE = re.compile(
+    r'\b(?:למה|איך|כדאי|ממליצה|תמליצי|דעתך|חושבת|בעיה|בעיות|עזרה|לטפל|להתמודד|לשפר|כדי|אם|'
+    r'הוסיפי|תוסיפי|להוסיף|סגרי|תסגרי|לסגור|עדכני|תעדכני|לעדכן|מחקי|תמחקי|למחוק|רשמי|תרשמי|לרשום|תכנני|תתכנני)\b'
+)
+CHAT_QUERY_LIST_LIMIT = 5
+
+def _normalize_chat_query(user_message: str) -> str:
+    """Drop punctuation and extra whitespace from a chat question"""
+    text = re.sub(r'[?!.,:;״"]', ' ', user_message)
+    return re.sub(r'\s+', ' ', text).strip()
+
+def _failure_line(failure: dict) -> str:
+    return f"• {failure.get('failure_number', '')} – {failure.get('system', '')}: {failure.get('description', '')} (דחיפות {failure.get('urgency', '')})"
+
+def _due_item_line(item: dict) -> str:
+    if item['type'] == 'maintenance':
+        days = item['days_until_due']
+        when = f"באיחור של {-days} ימים" if days < 0 else ("היום" if days == 0 else f"בעוד {days} ימים")
+        return f"• {item['title']} – {item['system']} ({when}, {item['next_due']})"
+    hours = item['hours_until_service']
+    when = f"עבר את הטיפול ב-{-hours:g} שעות" if hours < 0 else f"עוד {hours:g} שעות לטיפול"
+    return f"• {item['system']} – {item['title']} ({when})"
+
+def _more_line(total: int) -> str:
+    return f"\n...ועוד {total - CHAT_QUERY_LIST_LIMIT}" if total > CHAT_QUERY_LIST_LIMIT else ""
+
+def answer_urgent_failures(user_id: str, match) -> str:
+    query = {"user_id": user_id, "urgency": {"$gte": 4}}
+    total = active_failures_collection.count_documents(query)
+    if not total:
+        return "אין כרגע תקלות דחופות פתוחות 👍"
+    failures = active_failures_collection.find(query, {"_id": 0}).sort("urgency", -1).limit(CHAT_QUERY_LIST_LIMIT)
+    lines = "\n".join(_failure_line(failure) for failure in failures)
+    return f"יש {total} תקלות דחופות פתוחות (דחיפות 4 ומעלה):\n{lines}{_more_line(total)}"
+
+def answer_open_failures(user_id: str, match) -> str:
+    total = active_failures_collection.count_documents({"user_id": user_id})
+    if not total:
+        return "אין כרגע תקלות פתוחות 👍"
+    urgent = active_failures_collection.count_documents({"user_id": user_id, "urgency": {"$gte": 4}})
+    failures = active_failures_collection.find({"user_id": user_id}, {"_id": 0}).sort("urgency", -1).limit(CHAT_QUERY_LIST_LIMIT)
+    lines = "\n".join(_failure_line(failure) for failure in failures)
+    return f"יש {total} תקלות פתוחות, מתוכן {urgent} דחופות:\n{lines}{_more_line(total)}"
+
+def answer_failure_status(user_id: str, match) -> str:
+    failure_number = match.group('failure_number').upper()
+    failure = active_failures_collection.find_one({"user_id": user_id, "failure_number": failure_number}, {"_id": 0})
+    if failure:
+        return (f"התקלה {failure_number} פתוחה ({failure.get('status', 'פעיל')}).\n"
+                f"{_failure_line(failure)}\nאחראי: {failure.get('assignee') or 'לא צוין'}")
+    resolved = resolved_failures_collection.find_one({"user_id": user_id, "failure_number": failure_number}, {"_id": 0})
+    if resolved:
+        return (f"התקלה {failure_number} ({resolved.get('system', '')}) טופלה ב-{resolved.get('resolved_date', '')}"
+                f" על ידי {resolved.get('resolved_by') or 'לא צוין'}.\n"
+                f"פתרון: {resolved.get('resolution_method') or 'לא תועד'}")
+    return f"לא מצאתי במערכת תקלה מספר {failure_number}."
+
+def answer_overdue_maintenance(user_id: str, match) -> str:
+    # Due today or earlier / at or past the service hours
+    items = get_due_items(user_id, within_days=0, within_hours=0)
+    if not items:
+        return "אין אחזקות או טיפולים באיחור 👍"
+    lines = "\n".join(_due_item_line(item) for item in items[:CHAT_QUERY_LIST_LIMIT])
+    return f"יש {len(items)} פריטים באיחור:\n{lines}{_more_line(len(items))}"
+
+def answer_due_this_week(user_id: str, match) -> str:
+    items = get_due_items(user_id, within_days=7)
+    today = datetime.now().date()
+    week_end = (today + timedelta(days=7)).isoformat()
+    work_query = {"user_id": user_id, "date": {"$gte": today.isoformat(), "$lte": week_end}, "status": {"$ne": "הושלם"}}
+    work_total = daily_work_collection.count_documents(work_query)
+    if not items and not work_total:
+        return "אין אחזקות, טיפולים או משימות מתוכננות לשבוע הקרוב 👍"
+    parts = []
+    if items:
+        lines = "\n".join(_due_item_line(item) for item in items[:CHAT_QUERY_LIST_LIMIT])
+        parts.append(f"אחזקות וטיפולים לשבוע הקרוב ({len(items)}):\n{lines}{_more_line(len(items))}")
+    if work_total:
+        parts.append(f"בנוסף מתוכננות {work_total} משימות בתכנון היומי עד {week_end}.")
+    return "\n\n".join(parts)
+
+def answer_today_work(user_id: str, match) -> str:
+    today = datetime.now().isoformat()[:10]
+    query = {"user_id": user_id, "date": today}
+    total = daily_work_collection.count_documents(query)
+    if not total:
+        return "אין משימות בתכנון היומי להיום."
+    done = daily_work_collection.count_documents({**query, "status": "הושלם"})
+    tasks = daily_work_collection.find(query, {"_id": 0}).limit(CHAT_QUERY_LIST_LIMIT)
+    lines = "\n".join(f"• {task.get('task', '')} – {task.get('assignee') or 'ללא אחראי'} ({task.get('status', '')})" for task in tasks)
+    return f"להיום מתוכננות {total} משימות ({done} הושלמו):\n{lines}{_more_line(total)}"
+
+def answer_equipment_service(user_id: str, match) -> str:
+    items = [item for item in get_due_items(user_id, within_days=0, within_hours=50) if item['type'] == 'equipment']
+    if not items:
+        return "אין מכלולים שמתקרבים לטיפול (פחות מ-50 שעות) 👍"
+    lines = "\n".join(_due_item_line(item) for item in items[:CHAT_QUERY_LIST_LIMIT])
+    return f"{len(items)} מכלולים מתקרבים לטיפול:\n{lines}{_more_line(len(items))}"
+
+# (intent, pattern searched in the normalized question, handler) - patterns end at the end of the question
+CHAT_QUERY_INTENTS = [
+    ('failure_status', re.compile(
+        CHAT_QUERY_LEAD + r'(?:מה |איפה )?(?:(?:ה)?(?:סטטוס|מצב)(?: של| עם| לגבי)? |קורה עם |עם |עומדת |יש עדכון (?:על|לגבי) )?'
+        r'(?:ה)?תקלה (?:מספר )?(?P<failure_number>[Ff]\d+)$'), answer_failure_status),
+    ('urgent_failures', re.compile(r'(?:תקלות (?:ה)?(?:דחופות|קריטיות)|תקלות (?:ב)?דחיפות גבוהה)(?: \S+){0,2}$'), answer_urgent_failures),
+    ('overdue_maintenance', re.compile(r'(?:באיחור|(?:עבר|עברו) (?:ה)?(?:תאריך|מועד))(?: \S+){0,2}$'), answer_overdue_maintenance),
+    ('equipment_service', re.compile(r'(?:מכלולים|ציוד|מנועים|גנרטורים|מדחסים)(?: \S+){0,3} (?:ל)?(?:טיפול|טיפולים|שירות)$'), answer_equipment_service),
+    ('today_work', re.compile(r'(?:משימות|עבודות|לעשות|יש|מתוכנן|מתוכננות|תכנון)(?: \S+){0,2} (?:היום|להיום)$|(?:היום|להיום) (?:\S+ ){0,1}(?:משימות|מתוכנן|מתוכננות)$'), answer_today_work),
+    ('due_this_week', re.compile(
+        r'(?:אחזקות|טיפולים|משימות|מתוכנן|מתוכננות|יש|לעשות)(?: \S+){0,2} (?:השבוע|בשבוע הקרוב)$|'
+        r'(?:אחזקות|טיפולים) (?:ה)?(?:קרובים|קרובות|מתקרבים|מתקרבות|ממתינות)$|^(?:מה|אילו \S+) מתקרב(?:ים|ות)?$'), answer_due_this_week),
+    ('open_failures', re.compile(r'תקלות (?:ה)?(?:פתוחות|פעילות)(?: \S+){0,2}$|' + CHAT_QUERY_LEAD + r'כמה תקלות(?: \S+){0,2}$'), answer_open_failures),
+]
+
+def match_chat_query(user_message: str):
+    """Return (intent, match, handler) for a recognized read-only question, or None"""
+    if len(user_message) > CHAT_QUERY_MAX_LENGTH:
+        return None
+    text = _normalize_chat_query(user_message)
+    if not CHAT_QUERY_START.search(text) or CHAT_QUERY_EXCLUDE.search(text):
+        return None
+    if classify_chat_message(user_message) == "coaching":
+        return None
+    for intent, pattern, handler in CHAT_QUERY_INTENTS:
+        match = pattern.search(text)
+        if match:
+            return intent, match, handler
+    return None
+
+def handle_chat_query(user_message: str, session_id: str = None, chat_history: List[dict] = None, current_user: dict = None,
+                      chat_id: str = None) -> Optional[ChatResponse]:
+    """Answer recognized read-only questions from the database. Returns None when the message needs the model"""
+    if not current_user:
+        return None
+    query = match_chat_query(user_message)
+    if not query:
+        return None
+    intent, match, handler = query
+    user_id = current_user['id']
+    response = handler(user_id, match)
+    print(f"⚡ Chat query fast path: {intent}")
+    chat_id = save_fast_path_chat(user_id, session_id or new_chat_session_id(), user_message, response, intent, chat_history, chat_id=chat_id)
+    return ChatResponse(response=response, updated_tables=[], intent=intent, chat_id=chat_id)
+
+def record_chat_intent(intent: str):
+    """Count a chat message per day and intent ('llm' when the model answered)"""
+    try:
+        chat_intent_stats_collection.update_one(
+            {"date": datetime.now().isoformat()[:10], "intent": intent},
+            {"$inc": {"count": 1}},
+            upsert=True
+        )
+    except Exception as e:
+        print(f"Error recording chat intent: {e}")
+
+def answer_without_llm(user_message: str, session_id: str = None, chat_history: List[dict] = None, current_user: dict = None,
+                       use_cache: bool = True, chat_id: str = None) -> Optional[ChatResponse]:
+    """Try the command and query fast paths and the response cache before the LLM, counting which one answered"""
+    response = handle_chat_command(user_message, session_id, chat_history, current_user, chat_id)
+    if not response:
+        response = handle_chat_query(user_message, session_id, chat_history, current_user, chat_id)
+    if not response and use_cache:
+        response = handle_cached_response(user_message, session_id, chat_history, current_user, chat_id)
+    record_chat_intent(response.intent if response else "llm")
+    return response
+
+def get_chat_intent_stats(days: int = 30) -> dict:
+    """Fast path hit rate over the last N days, overall and per intent"""
+    since = (datetime.now() - timedelta(days=days)).isoformat()[:10]
+    intents = {}
+    for row in chat_intent_stats_collection.find({"date": {"$gte": since}}, {"_id": 0}):
+        intents[row['intent']] = intents.get(row['intent'], 0) + row.get('count', 0)
+    total = sum(intents.values())
+    answered = total - intents.get("llm", 0)
+    return {
+        "days": days,
+        "total_messages": total,
+        "answered_without_llm": answered,
+        "hit_rate": round(answered / total, 3) if total else 0.0,
+        "intents": dict(sorted(intents.items(), key=lambda x: x[1], reverse=True))
+    }
+
+# Chat Response Cache
+# Opt-in (AI_RESPONSE_CACHE_ENABLED). Repeated analytical questions are answered
+# from the last reply while none of the user's tables changed. Only replies without
+# action tags are stored; requests with the X-Bypass-Cache header skip the lookup
+# and refresh the entry.
+AI_RESPONSE_CACHE_ENABLED = os.environ.get('AI_RESPONSE_CACHE_ENABLED', 'false').lower() == 'true'
+AI_RESPONSE_CACHE_SECONDS = int(os.environ.get('AI_RESPONSE_CACHE_SECONDS', '900'))
+AI_RESPONSE_CACHE_SIZE = int(os.environ.get('AI_RESPONSE_CACHE_SIZE', '500'))
+AI_RESPONSE_CACHE_TIERS = ("data", "coaching")
+RESPONSE_CACHE_BYPASS_HEADER = "X-Bypass-Cache"
+
+class ResponseCache:
+    """TTL + LRU cache of chat replies, keyed by user, normalized message and data versions"""
+
+    def __init__(self, ttl_seconds: int = AI_RESPONSE_CACHE_SECONDS, max_size: int = AI_RESPONSE_CACHE_SIZE):
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is not None and (datetime.now() - entry[0]).total_seconds() >= self.ttl_seconds:
+            del self._entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: tuple, response: str):
+        self._entries[key] = (datetime.now(), response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: str = None):
+        if user_id is None:
+            self._entries.clear()
+        else:
+            for key in [key for key in self._entries if key[0] == user_id]:
+                del self._entries[key]
+
+response_cache = ResponseCache()
+
+def response_cache_key(user_id: str, user_message: str, versions: Dict[str, int]) -> tuple:
+    """Key on everything that shapes the reply: the question, the user's data and the prompt.
+    Today's date is included because the context is relative to it."""
+    tier = classify_chat_message(user_message)
+    return (
+        user_id,
+        _normalize_chat_query(user_message).lower(),
+        tuple(sorted(versions.items())),
+        CHAT_TIERS[tier]["model"],
+        JESSICA_STATIC_PROMPT_VERSION,
+        datetime.now().isoformat()[:10]
+    )
+
+def is_response_cacheable(user_message: str, current_user: dict = None) -> bool:
+    return (AI_RESPONSE_CACHE_ENABLED and current_user is not None
+            and classify_chat_message(user_message) in AI_RESPONSE_CACHE_TIERS)
+
+def handle_cached_response(user_message: str, session_id: str = None, chat_history: List[dict] = None, current_user: dict = None,
+                           chat_id: str = None) -> Optional[ChatResponse]:
+    """Answer a repeated question from the response cache. Returns None on a miss"""
+    if not is_response_cacheable(user_message, current_user):
+        return None
+    user_id = current_user['id']
+    response = response_cache.get(response_cache_key(user_id, user_message, get_data_versions(user_id)))
+    if response is None:
+        return None
+    print("⚡ Chat response cache hit")
+    chat_id = save_fast_path_chat(user_id, session_id or new_chat_session_id(), user_message, response, "response_cache", chat_history, chat_id=chat_id)
+    return ChatResponse(response=response, updated_tables=[], intent="response_cache", chat_id=chat_id)
+
+def store_cached_response(chat_request: dict, response: str):
+    """Remember a reply that emitted no actions, under the data versions its context was built from"""
+    user_id = chat_request["user_id"]
+    if not chat_request["user_name"] or not is_response_cacheable(chat_request["user_message"], {"id": user_id} if user_id else None):
+        return  # First interaction replies ask for the name
+    versions = chat_request["context_entry"].get("versions") or get_data_versions(user_id)
+    response_cache.set(response_cache_key(user_id, chat_request["user_message"], versions), response)
+
+# LLM Concurrency
+LLM_MAX_CONCURRENCY = int(os.environ.get('LLM_MAX_CONCURRENCY', '8'))  # LLM calls in flight at once
+LLM_MAX_QUEUE = int(os.environ.get('LLM_MAX_QUEUE', '32'))  # Calls allowed to wait for a slot
+LLM_QUEUE_TIMEOUT_SECONDS = float(os.environ.get('LLM_QUEUE_TIMEOUT_SECONDS', '30'))
+LLM_MAX_SESSION_PENDING = 2  # Running + waiting messages per user and session
+LLM_RETRY_AFTER_SECONDS = int(os.environ.get('LLM_RETRY_AFTER_SECONDS', '5'))
+LLM_BUSY_MESSAGE = "יש כרגע עומס על המערכת. אנא נסה שוב בעוד כמה שניות."
+
+class LlmQueueFull(Exception):
+    """Raised when an AI chat message can't be queued; reported as 429 with Retry-After"""
+
+    def __init__(self, retry_after: int = LLM_RETRY_AFTER_SECONDS):
+        super().__init__("LLM queue is full")
+        self.retry_after = retry_after
+
+class LlmConcurrencyLimiter:
+    """Global cap on concurrent LLM calls with a bounded wait queue,
+    plus serialization of chat turns per user and session"""
+
+    def __init__(self, max_concurrency: int = LLM_MAX_CONCURRENCY, max_queue: int = LLM_MAX_QUEUE,
+                 queue_timeout: float = LLM_QUEUE_TIMEOUT_SECONDS, max_session_pending: int = LLM_MAX_SESSION_PENDING):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.max_session_pending = max_session_pending
+        self._semaphore = None  # Created on first use, inside the running event loop
+        self._sessions = {}  # (user_id, session_id) -> [asyncio.Lock, pending turns]
+        self._session_actions = {}  # (user_id, session_id) -> futures of background action jobs still running
+        self.active = 0
+        self.waiting = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def _reject(self):
+        self.rejected += 1
+        raise LlmQueueFull()
+
+    def _full(self) -> bool:
+        # Counted synchronously - the semaphore itself is acquired asynchronously
+        return self.active + self.waiting >= self.max_concurrency + self.max_queue
+
+    def check_capacity(self, user_id: str, session_id: str):
+        """Reject right away when the queue is full or the session already has a message waiting"""
+        if self._full():
+            self._reject()
+        entry = self._sessions.get((user_id, session_id))
+        if entry and entry[1] >= self.max_session_pending:
+            self._reject()
+
+    def track_actions(self, user_id: str, session_id: str, future):
+        """Keep the session busy until a reply's background actions finished"""
+        key = (user_id, session_id)
+        futures = self._session_actions.setdefault(key, set())
+        futures.add(future)
+
+        def done(_):
+            futures.discard(future)
+            if not futures and self._session_actions.get(key) is futures:
+                self._session_actions.pop(key, None)
+        future.add_done_callback(done)
+
+    @asynccontextmanager
+    async def session(self, user_id: str, session_id: str):
+        """Run one chat turn at a time per user and session, so actions of overlapping sends can't interleave.
+        A turn also waits (up to AI_ACTION_WAIT_SECONDS) for the background actions of the turns before it"""
+        key = (user_id, session_id)
+        entry = self._sessions.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                actions = self._session_actions.get(key)
+                if actions:
+                    await asyncio.wait(list(actions), timeout=AI_ACTION_WAIT_SECONDS)
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                self._sessions.pop(key, None)
+
+    @asynccontextmanager
+    async def slot(self):
+        """Hold one of the global LLM call slots, waiting in the bounded queue if all are taken"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        if self._full():
+            self._reject()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._reject()
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self.completed += 1
+            self._semaphore.release()
+
+    def metrics(self) -> dict:
+        return {
+            "active": self.active,
+            "queue_depth": max(0, self.waiting - (self.max_concurrency - self.active)),
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "sessions_in_progress": len(self._sessions),
+            "completed": self.completed,
+            "rejected": self.rejected
+        }
+
+llm_limiter = LlmConcurrencyLimiter()
+
+def llm_busy_exception(error: LlmQueueFull) -> HTTPException:
+    return HTTPException(status_code=429, detail=LLM_BUSY_MESSAGE, headers={"Retry-After": str(error.retry_after)})
+
+# LLM Resilience
+LLM_REQUEST_TIMEOUT_SECONDS = float(os.environ.get('LLM_REQUEST_TIMEOUT_SECONDS', '45'))  # Deadline for the whole call, retries included
+LLM_ATTEMPT_TIMEOUT_SECONDS = float(os.environ.get('LLM_ATTEMPT_TIMEOUT_SECONDS', '20'))  # Per attempt / between streamed tokens
+LLM_MAX_RETRIES = int(os.environ.get('LLM_MAX_RETRIES', '2'))
+LLM_RETRY_BASE_SECONDS = 0.5
+LLM_CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('LLM_CIRCUIT_FAILURE_THRESHOLD', '5'))
+LLM_CIRCUIT_RESET_SECONDS = float(os.environ.get('LLM_CIRCUIT_RESET_SECONDS', '30'))
+LLM_UNAVAILABLE_MESSAGE = "מערכת ה-AI אינה זמינה כרגע. אנא נסה שוב בעוד כדקה."
+
+# Provider errors worth retrying: timeouts, dropped connections, rate limits and 5xx.
+# Matched by class name so both httpx and the LlmChat client's exceptions are covered;
+# bad requests and auth errors are not retried
+RETRYABLE_LLM_ERROR_NAMES = ('Timeout', 'Connection', 'ConnectError', 'ReadError', 'RemoteProtocol',
+                             'RateLimit', 'ServiceUnavailable', 'InternalServer', 'BadGateway')
+RETRYABLE_LLM_STATUS = re.compile(r'\b(?:429|500|502|503|504)\b')
+
+class LlmUnavailable(Exception):
+    """Raised without calling the provider while the circuit breaker is open"""
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker: closed -> open after N failures,
+    half_open after the reset timeout (one trial call), closed again on success"""
+
+    def __init__(self, name: str, failure_threshold: int = LLM_CIRCUIT_FAILURE_THRESHOLD, reset_seconds: float = LLM_CIRCUIT_RESET_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = None
+        self.last_failure = None
+        self._trial_in_flight = False
+
+    def before_call(self) -> bool:
+        """Fail fast while open; let a single trial call through once the reset timeout passed.
+        Returns True for the trial call, which must end in record_success, record_failure or release"""
+        if self.state == "open":
+            if (datetime.now() - self.opened_at).total_seconds() < self.reset_seconds:
+                raise LlmUnavailable(f"{self.name} circuit is open")
+            self.state = "half_open"
+            self._trial_in_flight = False
+        if self.state == "half_open":
+            if self._trial_in_flight:
+                raise LlmUnavailable(f"{self.name} circuit is half open")
+            self._trial_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+
+    def record_failure(self, error: Exception):
+        self.failures += 1
+        self.last_failure = f"{type(error).__name__}: {str(error)[:200]}"
+        self._trial_in_flight = False
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            if self.state != "open":
+                print(f"⚠️ {self.name} circuit opened after {self.failures} failures: {self.last_failure}")
+            self.state = "open"
+            self.opened_at = datetime.now()
+
+    def release(self, trial: bool):
+        """End a call that neither succeeded nor failed on the provider side (a
+        non-retryable error, cancellation, a stream closed by its consumer), so
+        the next call can be the trial"""
+        if trial:
+            self._trial_in_flight = False
+
+    def status(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "opened_at": self.opened_at.isoformat() if self.opened_at else None,
+            "last_failure": self.last_failure
+        }
+
+llm_circuit = CircuitBreaker("llm")
+
+def is_retryable_llm_error(error: Exception) -> bool:
+    if isinstance(error, (asyncio.TimeoutError, httpx.TransportError)):
+        return True
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code == 429 or error.response.status_code >= 500
+    if any(name in klass.__name__ for klass in type(error).__mro__ for name in RETRYABLE_LLM_ERROR_NAMES):
+        return True
+    return bool(RETRYABLE_LLM_STATUS.search(str(error)))
+
+def _llm_retry_delay(attempt: int) -> float:
+    """Exponential backoff with full jitter"""
+    return random.uniform(0, LLM_RETRY_BASE_SECONDS * (2 ** attempt))
+
+async def call_llm(send, deadline_seconds: float = LLM_REQUEST_TIMEOUT_SECONDS):
+    """Run one LLM completion with a deadline, jittered retries for retryable
+    errors and the circuit breaker. send is a no-argument coroutine function"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + deadline_seconds
+    attempt = 0
+    while True:
+        trial = llm_circuit.before_call()
+        recorded = False
+        try:
+            remaining = deadline - loop.time()
+            result = await asyncio.wait_for(send(), timeout=min(remaining, LLM_ATTEMPT_TIMEOUT_SECONDS))
+            llm_circuit.record_success()
+            recorded = True
+            return result
+        except Exception as e:
+            if not is_retryable_llm_error(e):
+                raise
+            llm_circuit.record_failure(e)
+            recorded = True
+            delay = _llm_retry_delay(attempt)
+            if attempt >= LLM_MAX_RETRIES or loop.time() + delay >= deadline:
+                raise
+            attempt += 1
+            print(f"LLM call failed ({type(e).__name__}), retry {attempt}/{LLM_MAX_RETRIES} in {delay:.2f}s")
+        finally:
+            # Also reached on CancelledError, which is not an Exception
+            if not recorded:
+                llm_circuit.release(trial)
+        await asyncio.sleep(delay)
+
+async def stream_llm(open_stream, deadline_seconds: float = LLM_REQUEST_TIMEOUT_SECONDS):
+    """Streaming variant of call_llm. Retries only happen before the first token
+    was yielded; afterwards a failure is raised to the caller"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + deadline_seconds
+    attempt = 0
+    while True:
+        trial = llm_circuit.before_call()
+        recorded = False
+        stream = open_stream()
+        emitted = False
+        try:
+            while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError("LLM request deadline exceeded")
+                try:
+                    token = await asyncio.wait_for(stream.__anext__(), timeout=min(remaining, LLM_ATTEMPT_TIMEOUT_SECONDS))
+                except StopAsyncIteration:
+                    llm_circuit.record_success()
+                    recorded = True
+                    return
+                emitted = True
+                yield token
+        except Exception as e:
+            if not is_retryable_llm_error(e):
+                raise
+            llm_circuit.record_failure(e)
+            recorded = True
+            delay = _llm_retry_delay(attempt)
+            if emitted or attempt >= LLM_MAX_RETRIES or loop.time() + delay >= deadline:
+                raise
+            attempt += 1
+            print(f"LLM stream failed ({type(e).__name__}), retry {attempt}/{LLM_MAX_RETRIES} in {delay:.2f}s")
+        finally:
+            # Also reached on CancelledError and on GeneratorExit when the consumer closes the stream
+            if not recorded:
+                llm_circuit.release(trial)
+            await stream.aclose()
+        await asyncio.sleep(delay)
+
+# LLM Providers
+# The chat pipeline talks to the model only through llm_provider. LLM_PROVIDER=stub
+# swaps in a local deterministic backend for load tests without network access.
+LLM_PROVIDER = os.environ.get('LLM_PROVIDER', 'openai').lower()
+LLM_STUB_LATENCY_MS = float(os.environ.get('LLM_STUB_LATENCY_MS', '300'))  # Time to the first token
+LLM_STUB_TOKEN_DELAY_MS = float(os.environ.get('LLM_STUB_TOKEN_DELAY_MS', '5'))  # Between streamed chunks
+
+class LlmProvider(ABC):
+    """Model backend used by the AI chat. complete() returns the whole reply,
+    stream() yields reply chunks; both fill the optional usage dict in the
+    chat completions format (prompt_tokens, completion_tokens, prompt_tokens_details).
+    A provider missing either of them fails when it is instantiated"""
+
+    name = "base"
+
+    def check_configured(self):
+        """Raise before building a request the provider cannot serve"""
+
+    @abstractmethod
+    async def complete(self, system_message: str, user_message: str, session_id: str, model: str = AI_CHAT_MODEL, usage: dict = None) -> str:
+        ...
+
+    @abstractmethod
+    def stream(self, system_message: str, user_message: str, model: str = AI_CHAT_MODEL, usage: dict = None):
+        ...
+
+class OpenAiLlmProvider(LlmProvider):
+    """OpenAI models: LlmChat for whole replies, the chat completions API for streaming"""
+
+    name = "openai"
+
+    def check_configured(self):
         if not OPENAI_API_KEY:
             raise HTTPException(status_code=500, detail="OpenAI API key not configured")
-            
+
+    async def complete(self, system_message: str, user_message: str, session_id: str, model: str = AI_CHAT_MODEL, usage: dict = None) -> str:
         chat = LlmChat(
             api_key=OPENAI_API_KEY,
             session_id=session_id,
             system_message=system_message
-        ).with_model("openai", "gpt-4o-mini")
-        
-        # Send message
-        user_msg = UserMessage(text=user_message)
-        response = await chat.send_message(user_msg)
-        
-        # Parse and execute any database actions
-        actions = parse_ai_actions(response)
-        updated_tables = []
-        
-        if actions and user_id:
-            updated_tables = await execute_ai_actions(actions, user_id)
-            # Remove action tags from response
-            import re
-            clean_response = re.sub(r'\[ADD_\w+:.*?\]', '', response, flags=re.DOTALL)
-            clean_response = re.sub(r'\[UPDATE_\w+:.*?\]', '', clean_response, flags=re.DOTALL)
-            clean_response = re.sub(r'\[DELETE_\w+:.*?\]', '', clean_response, flags=re.DOTALL)
-            response = clean_response.strip()
+        ).with_model("openai", model)
+        return await chat.send_message(UserMessage(text=user_message))
+
+    def stream(self, system_message: str, user_message: str, model: str = AI_CHAT_MODEL, usage: dict = None):
+        return stream_openai_chat(system_message, user_message, model=model, usage=usage)
+
+class StubLlmProvider(LlmProvider):
+    """Local deterministic backend. Replies are scripted from keywords in the
+    message and include the same action tags the real model emits, so the
+    parsing and execution path runs as in production"""
+
+    name = "stub"
+
+    def __init__(self, latency_ms: float = LLM_STUB_LATENCY_MS, token_delay_ms: float = LLM_STUB_TOKEN_DELAY_MS):
+        self.latency_ms = latency_ms
+        self.token_delay_ms = token_delay_ms
+
+    @staticmethod
+    def _tag_value(text: str, limit: int = 60) -> str:
+        """Strip characters that would end an action tag parameter"""
+        return re.sub(r'["\[\],=\n]', ' ', text)[:limit].strip()
+
+    def script(self, user_message: str) -> str:
+        """Scripted reply for a message; the same message always gets the same reply"""
+        digest = hashlib.sha1(user_message.encode('utf-8')).hexdigest()
+        today = datetime.now().isoformat()[:10]
+        text = self._tag_value(user_message)
+        if 'תקלה' in user_message:
+            return (f'רשמתי את התקלה ואני על זה. '
+                    f'[ADD_FAILURE: failure_number="S{digest[:6].upper()}", date="{today}", system="מערכת בדיקה", '
+                    f'description="{text}", urgency="{int(digest[6], 16) % 5 + 1}", assignee="צוות", estimated_hours="2"]')
+        if 'תחזוקה' in user_message:
+            return (f'קבעתי תחזוקה חוזרת. '
+                    f'[ADD_MAINTENANCE: maintenance_type="{text}", system="מערכת בדיקה", frequency_days="30", last_performed="{today}"]')
+        if 'משימה' in user_message or 'עבודה' in user_message:
+            return (f'הוספתי לתכנון היומי. '
+                    f'[ADD_DAILY_WORK: date="{today}", task="{text}", source="אחר", assignee="צוות", estimated_hours="1"]')
+        return f'קיבלתי: "{text}". תגיד לי אם תרצה שארשום משהו.'
+
+    def _fill_usage(self, usage: dict, system_message: str, user_message: str, reply: str):
+        if usage is None:
+            return
+        # Rough character estimate: the stub should not spend time in a tokenizer
+        cached = JESSICA_STATIC_PROMPT_TOKENS if system_message.startswith(JESSICA_STATIC_PROMPT) else 0
+        usage.update({
+            "prompt_tokens": math.ceil((len(system_message) + len(user_message)) / 3),
+            "completion_tokens": math.ceil(len(reply) / 3),
+            "prompt_tokens_details": {"cached_tokens": cached}
+        })
+
+    async def complete(self, system_message: str, user_message: str, session_id: str, model: str = AI_CHAT_MODEL, usage: dict = None) -> str:
+        reply = self.script(user_message)
+        await asyncio.sleep(self.latency_ms / 1000)
+        self._fill_usage(usage, system_message, user_message, reply)
+        return reply
+
+    async def stream(self, system_message: str, user_message: str, model: str = AI_CHAT_MODEL, usage: dict = None):
+        reply = self.script(user_message)
+        await asyncio.sleep(self.latency_ms / 1000)
+        for start in range(0, len(reply), 8):
+            if start and self.token_delay_ms:
+                await asyncio.sleep(self.token_delay_ms / 1000)
+            yield reply[start:start + 8]
+        self._fill_usage(usage, system_message, user_message, reply)
+
+LLM_PROVIDERS = {
+    "openai": OpenAiLlmProvider,
+    "stub": StubLlmProvider
+}
+
+def create_llm_provider(name: str) -> LlmProvider:
+    if name not in LLM_PROVIDERS:
+        raise ValueError(f"Unknown LLM_PROVIDER '{name}', expected one of: {', '.join(LLM_PROVIDERS)}")
+    return LLM_PROVIDERS[name]()
+
+llm_provider = create_llm_provider(LLM_PROVIDER)
+print(f"LLM provider: {llm_provider.name}")
+
+async def create_yahel_ai_agent(user_message: str, session_id: str = None, chat_history: List[dict] = None, current_user: dict = None,
+                                use_cache: bool = True, client_message_id: str = None) -> ChatResponse:
+    """Create AI agent for Yahel with department and leadership context.
+    Actions in the reply are executed in the background; see get_chat_action_status."""
+    if not session_id:
+        session_id = new_chat_session_id()
+    user_id = current_user['id'] if current_user else None
+    chat_id = chat_record_id(user_id, client_message_id)
+    try:
+        async with llm_limiter.session(user_id, session_id):
+            replayed = replay_chat_response(chat_id, user_id) if client_message_id and user_id else None
+            if replayed:
+                return replayed
             
-            # Add confirmation of actions taken
-            if updated_tables:
-                action_summary = f"\n\n✅ עדכנתי: {', '.join(updated_tables)}"
-                response += action_summary
-        
-        # Store chat history in database
-        chat_record = {
-            "id": str(uuid.uuid4()),
-            "session_id": session_id,
-            "user_id": user_id,  # Add user_id
-            "user_message": user_message,
-            "ai_response": response,
-            "timestamp": datetime.now().isoformat(),
-            "department_context": dept_data.get("summary", {}),
-            "leadership_context": len(leadership_data.get("recent_conversations", [])),
-            "updated_tables": updated_tables,
-            "chat_history_length": len(chat_history) if chat_history else 0
-        }
-        ai_chat_history_collection.insert_one(chat_record)
-        
-        return ChatResponse(
-            response=response,
-            updated_tables=updated_tables,
-            recommendations=[]
-        )
+            command_response = answer_without_llm(user_message, session_id, chat_history, current_user, use_cache, chat_id)
+            if command_response:
+                return command_response
+            
+            llm_provider.check_configured()
+            chat_request = build_ai_chat_request(user_message, session_id, chat_history, current_user, chat_id)
+            
+            # Send message
+            async with llm_limiter.slot():
+                response = await call_llm(lambda: llm_provider.complete(
+                    chat_request["system_message"], user_message, chat_request["session_id"],
+                    model=chat_request["model"], usage=chat_request["usage"]
+                ))
+            
+            return await complete_ai_chat(chat_request, response)
         
+    except LlmQueueFull:
+        raise
+    except LlmUnavailable:
+        return ChatResponse(response=LLM_UNAVAILABLE_MESSAGE, success=False, updated_tables=[])
     except Exception as e:
         error_msg = str(e)
         print(f"Error in AI agent: {error_msg}")
         
         # Return a friendly error message instead of crashing
-        if "AuthenticationError" in error_msg or "API key" in error_msg:
-            return ChatResponse(
-                response="מצטער, יש בעיה זמנית בחיבור למערכת הAI. אנא נסה שוב מאוחר יותר.",
-                success=False,
-                updated_tables=[]
-            )
-        else:
-            return ChatResponse(
-                response="מצטער, אירעה שגיאה. אנא נסה שוב או פנה למנהל המערכת.",
-                success=False,
-                updated_tables=[]
-            )
+        return ai_error_response(error_msg)
+
+# AI Chat Streaming
+class ActionTagStreamFilter:
+    """Hides [ADD_/UPDATE_/DELETE_...: ...] action tags from streamed text as it arrives,
+    using the same parameter scanner as tokenize_ai_actions"""
+
+    TAG_PREFIXES = ("ADD_", "UPDATE_", "DELETE_")
+
+    def __init__(self):
+        self.buffer = ""
+
+    def _could_be_tag(self, head: str) -> bool:
+        """Whether the text after '[' may still grow into an action tag head"""
+        for prefix in self.TAG_PREFIXES:
+            if prefix.startswith(head):
+                return True
+            if head.startswith(prefix) and re.fullmatch(r'\w*', head[len(prefix):]):
+                return True
+        return False
+
+    def feed(self, text: str) -> str:
+        """Add streamed text, return the part that is safe to show"""
+        self.buffer += text
+        visible = []
+        while self.buffer:
+            start = self.buffer.find('[')
+            if start == -1:
+                visible.append(self.buffer)
+                self.buffer = ""
+                break
+            visible.append(self.buffer[:start])
+            self.buffer = self.buffer[start:]
+
+            head = self.buffer[1:]
+            match = ACTION_TAG_START.match(self.buffer)
+            if match:
+                _, end = _scan_action_params(self.buffer, match.end())
+                if end == -1:
+                    break  # Wait for the rest of the tag
+                self.buffer = self.buffer[end + 1:]
+                continue
+            if self._could_be_tag(head):
+                break  # Not enough text yet to decide
+            visible.append('[')
+            self.buffer = self.buffer[1:]
+        return "".join(visible)
+
+    def flush(self) -> str:
+        """Return any held-back text once the stream ends (e.g. an unterminated tag)"""
+        rest = self.buffer
+        self.buffer = ""
+        return rest
+
+async def stream_openai_chat(system_message: str, user_message: str, model: str = AI_CHAT_MODEL, usage: dict = None):
+    """Stream completion tokens from the OpenAI-compatible chat completions API.
+    If a usage dict is given it is filled with the token usage from the final chunk"""
+    payload = {
+        "model": model,
+        "stream": True,
+        "stream_options": {"include_usage": True},
+        "messages": [
+            {"role": "system", "content": system_message},
+            {"role": "user", "content": user_message}
+        ]
+    }
+    headers = {"Authorization": f"Bearer {OPENAI_API_KEY}"}
+    async with httpx.AsyncClient(timeout=httpx.Timeout(60.0, connect=10.0)) as client:
+        async with client.stream("POST", f"{OPENAI_BASE_URL}/chat/completions", json=payload, headers=headers) as response:
+            if response.status_code == 401:
+                raise Exception("AuthenticationError: invalid API key")
+            if response.status_code >= 400:
+                body = await response.aread()
+                raise Exception(f"LLM provider error {response.status_code}: {body[:200]!r}")
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                chunk = json.loads(data)
+                if chunk.get("usage") and usage is not None:
+                    usage.update(chunk["usage"])
+                for choice in chunk.get("choices", []):
+                    token = (choice.get("delta") or {}).get("content")
+                    if token:
+                        yield token
+
+def sse_event(data: dict) -> str:
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+async def stream_chat_action_results(result: ChatResponse, user_id: str):
+    """Yield the actions event once the background executor finished the reply's actions"""
+    if not result.pending_actions:
+        return
+    status = await wait_for_chat_actions(result.chat_id, user_id)
+    if status:
+        yield sse_event({"type": "actions", **status})
+
+async def stream_yahel_ai_agent(user_message: str, session_id: str = None, chat_history: List[dict] = None, current_user: dict = None,
+                                use_cache: bool = True, client_message_id: str = None):
+    """Streaming variant of create_yahel_ai_agent, yielding server-sent events.
+
+    Events: start, token (visible text with action tags removed), done with the
+    final text as soon as the model finished, then actions with the action results
+    and updated_tables if the reply contained actions - or error.
+    """
+    if not session_id:
+        session_id = new_chat_session_id()
+    user_id = current_user['id'] if current_user else None
+    chat_id = chat_record_id(user_id, client_message_id)
+    try:
+        async with llm_limiter.session(user_id, session_id):
+            replayed = replay_chat_response(chat_id, user_id) if client_message_id and user_id else None
+            command_response = replayed or answer_without_llm(user_message, session_id, chat_history, current_user, use_cache, chat_id)
+            if command_response:
+                yield sse_event({"type": "start", "session_id": session_id})
+                yield sse_event({"type": "token", "text": command_response.response})
+                yield sse_event({
+                    "type": "done",
+                    "response": command_response.response,
+                    "updated_tables": command_response.updated_tables,
+                    "context_tokens": 0,
+                    "chat_id": command_response.chat_id,
+                    "pending_actions": command_response.pending_actions
+                })
+                async for event in stream_chat_action_results(command_response, user_id):
+                    yield event
+                return
+
+            llm_provider.check_configured()
+            chat_request = build_ai_chat_request(user_message, session_id, chat_history, current_user, chat_id)
+
+            yield sse_event({"type": "start", "session_id": chat_request["session_id"]})
+
+            tag_filter = ActionTagStreamFilter()
+            chunks = []
+            async with llm_limiter.slot():
+                async for token in stream_llm(lambda: llm_provider.stream(chat_request["system_message"], user_message, model=chat_request["model"], usage=chat_request["usage"])):
+                    chunks.append(token)
+                    visible = tag_filter.feed(token)
+                    if visible:
+                        yield sse_event({"type": "token", "text": visible})
+            rest = tag_filter.flush()
+            if rest:
+                yield sse_event({"type": "token", "text": rest})
+
+            result = await complete_ai_chat(chat_request, "".join(chunks))
+            yield sse_event({
+                "type": "done",
+                "response": result.response,
+                "updated_tables": result.updated_tables,
+                "context_tokens": result.context_tokens,
+                "chat_id": result.chat_id,
+                "pending_actions": result.pending_actions
+            })
+            async for event in stream_chat_action_results(result, user_id):
+                yield event
+
+    except LlmQueueFull as e:
+        yield sse_event({"type": "error", "response": LLM_BUSY_MESSAGE, "retry_after": e.retry_after})
+    except LlmUnavailable:
+        yield sse_event({"type": "error", "response": LLM_UNAVAILABLE_MESSAGE})
+    except Exception as e:
+        error_msg = str(e)
+        print(f"Error in AI agent stream: {error_msg}")
+        yield sse_event({"type": "error", "response": ai_error_response(error_msg).response})
+
+# Background Jobs Lifecycle
+scheduler.add_job("recompute_derived_fields", recompute_derived_fields, ALERT_RECOMPUTE_INTERVAL_SECONDS)
+scheduler.add_job("deliver_alert_events", push_service.deliver_alert_events, ALERT_EVENTS_DELIVERY_INTERVAL_SECONDS)
+scheduler.add_job("recover_ai_action_jobs", recover_ai_action_jobs, AI_ACTION_RECOVERY_INTERVAL_SECONDS)
+
+@app.on_event("startup")
+async def startup_event():
+    ensure_indexes()
+    ensure_hour_readings_collection()
+    asyncio.get_running_loop().run_in_executor(None, get_token_encoder)  # Warm up without blocking startup
+    for writer in buffered_writers:
+        writer.start()
+    if SCHEDULER_ENABLED:
+        scheduler.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await scheduler.stop()
+    for writer in buffered_writers:
+        await writer.stop()
 
 # API Routes
 
@@ -1533,6 +4890,35 @@ async def create_yahel_ai_agent(user_message: str, session_id: str = None, chat_
 async def root():
     return {"message": "יהל Naval Department Management System API", "status": "running"}
 
+@app.get("/api/health")
+async def health_check():
+    """Liveness plus dependency state: database and the LLM circuit breaker"""
+    try:
+        client.admin.command('ping')
+        database = "ok"
+    except Exception as e:
+        print(f"Health check database error: {e}")
+        database = "error"
+    llm = llm_circuit.status()
+    healthy = database == "ok" and llm["state"] == "closed"
+    return {"status": "ok" if healthy else "degraded", "database": database, "llm": llm}
+
+@app.get("/api/metrics")
+async def get_metrics():
+    """Operational metrics: LLM call queue, cache hit counts and per-tier chat latency / tokens"""
+    return {
+        "llm": llm_limiter.metrics(),
+        "ai_context_cache": {"hits": ai_context_cache.hits, "misses": ai_context_cache.misses},
+        "chat_tiers": chat_tier_metrics.snapshot(),
+        "log_buffers": {writer.name: writer.metrics() for writer in buffered_writers},
+        "response_cache": {
+            "enabled": AI_RESPONSE_CACHE_ENABLED,
+            "hits": response_cache.hits,
+            "misses": response_cache.misses,
+            "entries": len(response_cache._entries)
+        }
+    }
+
 # AI Chat Route
 @app.get("/api/ai-chat/history/{session_id}")
 async def get_session_chat_history(session_id: str, current_user = Depends(get_current_user)):
@@ -1542,6 +4928,9 @@ async def get_session_chat_history(session_id: str, current_user = Depends(get_c
             {"session_id": session_id, "user_id": current_user['id']}, 
             {"_id": 0}
         ).sort("timestamp", 1))
+        chat_records += chat_log_writer.pending(
+            lambda record: record["session_id"] == session_id and record["user_id"] == current_user['id']
+        )
         
         # Convert to chat format
         history = []
@@ -1565,23 +4954,96 @@ async def get_session_chat_history(session_id: str, current_user = Depends(get_c
 async def clear_session_chat_history(session_id: str, current_user = Depends(get_current_user)):
     """Clear chat history for specific session"""
     try:
+        await asyncio.to_thread(chat_log_writer.flush)  # Buffered turns would be written after the delete
         result = ai_chat_history_collection.delete_many({"session_id": session_id, "user_id": current_user['id']})
+        chat_session_summaries_collection.delete_one({"session_id": session_id, "user_id": current_user['id']})
         return {"message": f"Cleared {result.deleted_count} chat records"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error clearing chat history: {str(e)}")
 
+def bypass_response_cache(request: Request) -> bool:
+    return request.headers.get(RESPONSE_CACHE_BYPASS_HEADER, '').lower() in ('1', 'true', 'yes')
+
 @app.post("/api/ai-chat")
-async def ai_chat(message: ChatMessage, current_user = Depends(get_current_user)):
+async def ai_chat(message: ChatMessage, request: Request, current_user = Depends(get_current_user)):
     # Add user context to the message
     message.user_id = current_user['id']
-    response = await create_yahel_ai_agent(
-        message.user_message, 
-        message.session_id, 
-        message.chat_history,
-        current_user
-    )
+    try:
+        llm_limiter.check_capacity(current_user['id'], message.session_id)
+        response = await create_yahel_ai_agent(
+            message.user_message, 
+            message.session_id, 
+            message.chat_history,
+            current_user,
+            use_cache=not bypass_response_cache(request),
+            client_message_id=message.client_message_id
+        )
+    except LlmQueueFull as e:
+        raise llm_busy_exception(e)
     return response
 
+@app.post("/api/ai-chat/stream")
+async def ai_chat_stream(message: ChatMessage, request: Request, current_user = Depends(get_current_user)):
+    """Stream the AI reply as server-sent events"""
+    message.user_id = current_user['id']
+    try:
+        llm_limiter.check_capacity(current_user['id'], message.session_id)
+    except LlmQueueFull as e:
+        raise llm_busy_exception(e)
+    return StreamingResponse(
+        stream_yahel_ai_agent(
+            message.user_message,
+            message.session_id,
+            message.chat_history,
+            current_user,
+            use_cache=not bypass_response_cache(request),
+            client_message_id=message.client_message_id
+        ),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/api/ai-chat/actions/{chat_id}")
+async def ai_chat_action_status(chat_id: str, current_user = Depends(get_current_user)):
+    """Status and results of the actions from one AI reply"""
+    status = get_chat_action_status(chat_id, current_user['id'])
+    if status is None:
+        raise HTTPException(status_code=404, detail="Chat message not found")
+    return status
+
+@app.get("/api/ai-usage/top")
+async def ai_usage_top(days: int = 7, limit: int = 10, current_user = Depends(get_current_user)):
+    """Heaviest LLM users and prompts, for tuning prompt size and context budgets.
+    Admins see every user; anyone else sees only their own usage"""
+    if days < 1 or limit < 1:
+        raise HTTPException(status_code=400, detail="days and limit must be positive")
+    user_id = None if is_admin_user(current_user) else current_user['id']
+    return get_llm_usage_top(days, min(limit, 100), user_id=user_id)
+
+@app.get("/api/ai-chat/intent-stats")
+async def ai_chat_intent_stats(days: int = 30, current_user = Depends(get_current_user)):
+    """How many chat messages were answered without the LLM, per intent"""
+    if days < 1:
+        raise HTTPException(status_code=400, detail="days must be positive")
+    return get_chat_intent_stats(days)
+
+# Search Route
+@app.get("/api/search")
+async def search(q: str, sources: Optional[str] = None, offset: int = 0, limit: int = 20,
+                 current_user = Depends(get_current_user)):
+    """Search failures, resolved failures, daily work and conversations.
+    sources is an optional comma-separated subset of the SEARCH_SOURCES keys."""
+    if offset < 0 or limit < 1:
+        raise HTTPException(status_code=400, detail="offset must be non-negative and limit positive")
+    selected = [source.strip() for source in sources.split(',') if source.strip()] if sources else None
+    unknown = [source for source in selected or [] if source not in SEARCH_SOURCES]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown search sources: {', '.join(unknown)}")
+    started_at = time.perf_counter()
+    versions = get_data_versions(current_user['id'])
+    result = await asyncio.to_thread(search_index.search, current_user['id'], q, versions, selected, offset, min(limit, 100))
+    return {"query": q, **result, "took_ms": round((time.perf_counter() - started_at) * 1000, 1)}
+
 # Active Failures Routes
 @app.post("/api/failures")
 async def create_failure(failure: ActiveFailure, current_user = Depends(get_current_user)):
@@ -1591,6 +5053,7 @@ async def create_failure(failure: ActiveFailure, current_user = Depends(get_curr
     failure_dict['created_at'] = datetime.now().isoformat()
     
     result = active_failures_collection.insert_one(failure_dict)
+    bump_data_version(current_user['id'], 'failures')
     return {"id": failure_dict['id'], "message": "Failure created successfully"}
 
 @app.get("/api/failures")
@@ -1638,6 +5101,7 @@ async def update_failure(failure_id: str, failure: ActiveFailure, current_user =
     
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Failure not found")
+    bump_data_version(current_user['id'], 'failures')
     return {"message": "Failure updated successfully"}
 
 @app.delete("/api/failures/{failure_id}")
@@ -1646,6 +5110,7 @@ async def delete_failure(failure_id: str, current_user = Depends(get_current_use
     result = active_failures_collection.delete_one({"id": failure_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Failure not found")
+    bump_data_version(current_user['id'], 'failures')
     return {"message": "Failure deleted successfully"}
 
 # Resolved Failures Routes
@@ -1662,6 +5127,7 @@ async def create_resolved_failure(resolved_failure: ResolvedFailure, current_use
     resolved_failure_dict['resolved_at'] = datetime.now().isoformat()
     
     result = resolved_failures_collection.insert_one(resolved_failure_dict)
+    bump_data_version(current_user['id'], 'resolved_failures')
     return {"id": resolved_failure_dict['id'], "message": "Resolved failure created successfully"}
 
 @app.put("/api/resolved-failures/{failure_id}")
@@ -1686,6 +5152,7 @@ async def update_resolved_failure(failure_id: str, updates: dict, current_user =
         if result.matched_count == 0:
             raise HTTPException(status_code=404, detail="Resolved failure not found")
         
+        bump_data_version(current_user['id'], 'resolved_failures')
         return {"message": "Resolved failure updated successfully"}
         
     except Exception as e:
@@ -1712,6 +5179,7 @@ async def delete_resolved_failure(failure_id: str, current_user = Depends(get_cu
         if result.deleted_count == 0:
             raise HTTPException(status_code=404, detail="Resolved failure not found")
         
+        bump_data_version(current_user['id'], 'resolved_failures')
         return {"message": "Resolved failure deleted successfully"}
         
     except Exception as e:
@@ -1729,6 +5197,7 @@ async def create_maintenance(maintenance: PendingMaintenance, current_user = Dep
     maintenance_dict = calculate_maintenance_dates(maintenance_dict)
     
     result = pending_maintenance_collection.insert_one(maintenance_dict)
+    bump_data_version(current_user['id'], 'maintenance')
     return {"id": maintenance_dict['id'], "message": "Maintenance created successfully"}
 
 @app.get("/api/maintenance")
@@ -1753,6 +5222,7 @@ async def update_maintenance(maintenance_id: str, maintenance: PendingMaintenanc
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Maintenance not found")
+    bump_data_version(current_user['id'], 'maintenance')
     return {"message": "Maintenance updated successfully"}
 
 @app.delete("/api/maintenance/{maintenance_id}")
@@ -1760,6 +5230,7 @@ async def delete_maintenance(maintenance_id: str, current_user = Depends(get_cur
     result = pending_maintenance_collection.delete_one({"id": maintenance_id, "user_id": current_user['id']})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Maintenance not found")
+    bump_data_version(current_user['id'], 'maintenance')
     return {"message": "Maintenance deleted successfully"}
 
 # Equipment Hours Routes
@@ -1769,19 +5240,20 @@ async def create_equipment(equipment: EquipmentHours, current_user = Depends(get
     equipment_dict['id'] = str(uuid.uuid4())
     equipment_dict['user_id'] = current_user['id']
     equipment_dict['created_at'] = datetime.now().isoformat()
+    equipment_dict['last_reading_at'] = equipment_dict['created_at']
     
     # Calculate service hours
     equipment_dict = calculate_service_hours(equipment_dict)
     
     result = equipment_hours_collection.insert_one(equipment_dict)
+    store_hour_readings(current_user['id'], [(equipment_dict['id'], equipment_dict['current_hours'], datetime.now())], "create")
     return {"id": equipment_dict['id'], "message": "Equipment created successfully"}
 
 @app.get("/api/equipment")
 async def get_equipment(current_user = Depends(get_current_user)):
     equipment_items = list(equipment_hours_collection.find({"user_id": current_user['id']}, {"_id": 0}))
-    # Recalculate service hours for each item
-    for item in equipment_items:
-        item = calculate_service_hours(item)
+    # Recalculate service hours for all items in one batch
+    calculate_service_hours_batch(equipment_items)
     # Sort by alert level priority and hours until service
     priority = {"אדום": 1, "כתום": 2, "ירוק": 3}
     equipment_items.sort(key=lambda x: (priority.get(x.get('alert_level', 'ירוק'), 3), x.get('hours_until_service', 999)))
@@ -1789,25 +5261,122 @@ async def get_equipment(current_user = Depends(get_current_user)):
 
 @app.put("/api/equipment/{equipment_id}")
 async def update_equipment(equipment_id: str, equipment: EquipmentHours, current_user = Depends(get_current_user)):
+    existing = equipment_hours_collection.find_one(
+        {"id": equipment_id, "user_id": current_user['id']},
+        {"_id": 0, "current_hours": 1, "last_reading_at": 1, "usage_rate_per_day": 1, "created_at": 1}
+    )
+    if existing is None:
+        raise HTTPException(status_code=404, detail="Equipment not found")
+
     equipment_dict = equipment.dict()
+    equipment_dict['id'] = equipment_id
     equipment_dict['user_id'] = current_user['id']
+    equipment_dict['created_at'] = existing.get('created_at')
+    # The usage rate is derived from readings, never taken from the client
+    equipment_dict['usage_rate_per_day'] = existing.get('usage_rate_per_day')
+    # Edits of other fields are not meter readings
+    hours_changed = equipment_dict['current_hours'] != existing.get('current_hours')
+    equipment_dict['last_reading_at'] = datetime.now().isoformat() if hours_changed else existing.get('last_reading_at')
     equipment_dict = calculate_service_hours(equipment_dict)
     
-    result = equipment_hours_collection.update_one(
+    equipment_hours_collection.update_one(
         {"id": equipment_id, "user_id": current_user['id']}, 
         {"$set": equipment_dict}
     )
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Equipment not found")
+    if hours_changed:
+        store_hour_readings(current_user['id'], [(equipment_id, equipment_dict['current_hours'], datetime.now())], "manual")
+    else:
+        bump_data_version(current_user['id'], 'equipment')
     return {"message": "Equipment updated successfully"}
 
+@app.post("/api/equipment/readings")
+async def add_hour_readings(batch: HourReadingsBatch, current_user = Depends(get_current_user)):
+    """Ingest a batch of hour meter readings"""
+    if not batch.readings:
+        raise HTTPException(status_code=400, detail="No readings provided")
+    result = ingest_hour_readings(current_user['id'], [reading.dict() for reading in batch.readings])
+    return {"message": f"Stored {result['accepted']} readings", **result}
+
+@app.get("/api/equipment/usage")
+async def get_all_equipment_usage(interval: str = "day", days: int = 30, current_user = Depends(get_current_user)):
+    """Get daily or weekly usage for all of the user's equipment"""
+    if interval not in ("day", "week"):
+        raise HTTPException(status_code=400, detail="interval must be 'day' or 'week'")
+    return {"interval": interval, "usage": get_equipment_usage(current_user['id'], interval=interval, days=days)}
+
+@app.get("/api/equipment/{equipment_id}/usage")
+async def get_single_equipment_usage(equipment_id: str, interval: str = "day", days: int = 30, current_user = Depends(get_current_user)):
+    """Get daily or weekly usage for one equipment item"""
+    if interval not in ("day", "week"):
+        raise HTTPException(status_code=400, detail="interval must be 'day' or 'week'")
+    usage = get_equipment_usage(current_user['id'], [equipment_id], interval=interval, days=days)
+    return {"equipment_id": equipment_id, "interval": interval, "usage": usage.get(equipment_id, [])}
+
 @app.delete("/api/equipment/{equipment_id}")
 async def delete_equipment(equipment_id: str, current_user = Depends(get_current_user)):
     result = equipment_hours_collection.delete_one({"id": equipment_id, "user_id": current_user['id']})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Equipment not found")
+    bump_data_version(current_user['id'], 'equipment')
     return {"message": "Equipment deleted successfully"}
 
+# Due Window Routes
+@app.get("/api/due")
+async def get_due(within_days: int = 7, within_hours: float = 50, current_user = Depends(get_current_user)):
+    """Get maintenance and equipment due within the given window, ranked by urgency"""
+    if within_days < 0 or within_hours < 0:
+        raise HTTPException(status_code=400, detail="within_days and within_hours must be non-negative")
+    items = get_due_items(current_user['id'], within_days, within_hours)
+    return {
+        "within_days": within_days,
+        "within_hours": within_hours,
+        "counts": {
+            "maintenance": len([item for item in items if item['type'] == 'maintenance']),
+            "equipment": len([item for item in items if item['type'] == 'equipment'])
+        },
+        "items": items
+    }
+
+# Alert Events Routes
+@app.get("/api/alert-events")
+async def get_alert_events(limit: int = 50, current_user = Depends(get_current_user)):
+    """Get recent alert level and due status transitions"""
+    events = list(alert_events_collection.find(
+        {"user_id": current_user['id']},
+        {"_id": 0}
+    ).sort("created_at", -1).limit(limit))
+    return {"events": events}
+
+# Service Interval Configuration Routes
+@app.get("/api/service-intervals")
+async def get_service_intervals(current_user = Depends(get_current_user)):
+    """Get service interval tables used for equipment calculations"""
+    return {
+        "intervals": service_interval_engine.get_tables(),
+        "fallback": FALLBACK_SERVICE_INTERVALS
+    }
+
+@app.put("/api/service-intervals")
+async def update_service_intervals(table: ServiceIntervalTable, current_user = Depends(get_current_admin)):
+    """Create or replace the service interval table for a system type (admins only - shared by all users)"""
+    intervals = sorted(table.intervals)
+    if not intervals or intervals[0] <= 0:
+        raise HTTPException(status_code=400, detail="Intervals must be positive numbers")
+
+    service_intervals_collection.update_one(
+        {"system_type": table.system_type.lower()},
+        {"$set": {
+            "system_type": table.system_type.lower(),
+            "intervals": intervals,
+            "updated_at": datetime.now().isoformat()
+        }},
+        upsert=True
+    )
+    bump_data_version(GLOBAL_VERSION_ID, 'service_intervals')
+    service_interval_engine.invalidate()
+    ai_context_cache.invalidate()
+    return {"message": "Service intervals updated successfully", "intervals": intervals}
+
 # Daily Work Plan Routes
 @app.post("/api/daily-work")
 async def create_daily_work(work: DailyWorkPlan, current_user = Depends(get_current_user)):
@@ -1817,6 +5386,7 @@ async def create_daily_work(work: DailyWorkPlan, current_user = Depends(get_curr
     work_dict['created_at'] = datetime.now().isoformat()
     
     result = daily_work_collection.insert_one(work_dict)
+    bump_data_version(current_user['id'], 'daily_work')
     return {"id": work_dict['id'], "message": "Daily work created successfully"}
 
 @app.get("/api/daily-work")
@@ -1845,6 +5415,7 @@ async def update_daily_work(work_id: str, work: DailyWorkPlan, current_user = De
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Work item not found")
+    bump_data_version(current_user['id'], 'daily_work')
     return {"message": "Daily work updated successfully"}
 
 @app.delete("/api/daily-work/{work_id}")
@@ -1852,6 +5423,7 @@ async def delete_daily_work(work_id: str, current_user = Depends(get_current_use
     result = daily_work_collection.delete_one({"id": work_id, "user_id": current_user['id']})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Work item not found")
+    bump_data_version(current_user['id'], 'daily_work')
     return {"message": "Daily work deleted successfully"}
 
 # Leadership Coaching Routes
@@ -1864,6 +5436,7 @@ async def create_conversation(conversation: Conversation, current_user = Depends
     conversation_dict['created_at'] = datetime.now().isoformat()
     
     result = conversations_collection.insert_one(conversation_dict)
+    bump_data_version(current_user['id'], 'conversations')
     return {"id": conversation_dict['id'], "message": "Conversation created successfully"}
 
 @app.get("/api/conversations")
@@ -1882,6 +5455,7 @@ async def update_conversation(conversation_id: str, conversation: Conversation,
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Conversation not found")
+    bump_data_version(current_user['id'], 'conversations')
     return {"message": "Conversation updated successfully"}
 
 @app.delete("/api/conversations/{conversation_id}")
@@ -1889,6 +5463,7 @@ async def delete_conversation(conversation_id: str, current_user = Depends(get_c
     result = conversations_collection.delete_one({"id": conversation_id, "user_id": current_user['id']})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Conversation not found")
+    bump_data_version(current_user['id'], 'conversations')
     return {"message": "Conversation deleted successfully"}
 
 @app.post("/api/dna-tracker")
@@ -1907,10 +5482,12 @@ async def create_dna_item(dna: DNATracker, current_user = Depends(get_current_us
             {'component_name': dna_dict['component_name'], 'user_id': current_user['id']},
             {'$set': dna_dict}
         )
+        bump_data_version(current_user['id'], 'dna_tracker')
         return {"id": existing['id'], "message": "DNA component updated successfully"}
     else:
         # Create new
         result = dna_tracker_collection.insert_one(dna_dict)
+        bump_data_version(current_user['id'], 'dna_tracker')
         return {"id": dna_dict['id'], "message": "DNA component created successfully"}
 
 @app.get("/api/dna-tracker")
@@ -1930,6 +5507,7 @@ async def update_dna_item(dna_id: str, dna: DNATracker, current_user = Depends(g
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="DNA item not found")
+    bump_data_version(current_user['id'], 'dna_tracker')
     return {"message": "DNA item updated successfully"}
 
 @app.delete("/api/dna-tracker/{dna_id}")
@@ -1937,6 +5515,7 @@ async def delete_dna_item(dna_id: str, current_user = Depends(get_current_user))
     result = dna_tracker_collection.delete_one({"id": dna_id, "user_id": current_user['id']})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="DNA item not found")
+    bump_data_version(current_user['id'], 'dna_tracker')
     return {"message": "DNA item deleted successfully"}
 
 @app.post("/api/ninety-day-plan")
@@ -1954,10 +5533,12 @@ async def create_plan_item(plan: NinetyDayPlan, current_user = Depends(get_curre
             {'week_number': plan_dict['week_number'], 'user_id': current_user['id']},
             {'$set': plan_dict}
         )
+        bump_data_version(current_user['id'], 'ninety_day_plan')
         return {"id": existing['id'], "message": f"Week {plan_dict['week_number']} plan updated successfully"}
     else:
         # Create new
         result = ninety_day_plan_collection.insert_one(plan_dict)
+        bump_data_version(current_user['id'], 'ninety_day_plan')
         return {"id": plan_dict['id'], "message": f"Week {plan_dict['week_number']} plan created successfully"}
 
 @app.get("/api/ninety-day-plan")
@@ -1975,6 +5556,7 @@ async def update_plan_item(plan_id: str, plan: NinetyDayPlan, current_user = Dep
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Plan item not found")
+    bump_data_version(current_user['id'], 'ninety_day_plan')
     return {"message": "Plan item updated successfully"}
 
 @app.delete("/api/ninety-day-plan/{plan_id}")
@@ -1982,6 +5564,7 @@ async def delete_plan_item(plan_id: str, current_user = Depends(get_current_user
     result = ninety_day_plan_collection.delete_one({"id": plan_id, "user_id": current_user['id']})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Plan item not found")
+    bump_data_version(current_user['id'], 'ninety_day_plan')
     return {"message": "Plan item deleted successfully"}
 
 # Advanced AI Routes for Leadership Coaching
@@ -2030,10 +5613,14 @@ async def ai_coaching_session(session_data: dict):
         session_type = session_data.get('type', 'general')  # general, reflection, planning
         
         # Call the main AI agent
-        response = await create_yahel_ai_agent(user_message)
+        try:
+            llm_limiter.check_capacity(None, None)
+            response = await create_yahel_ai_agent(user_message)
+        except LlmQueueFull as e:
+            raise llm_busy_exception(e)
         
         # If this was a coaching session, automatically create conversation record
-        if session_type == 'coaching' and response.updated_tables:
+        if session_type == 'coaching' and (response.updated_tables or response.pending_actions):
             conversation_data = {
                 'id': str(uuid.uuid4()),
                 'meeting_number': len(list(conversations_collection.find())) + 1,
@@ -2052,6 +5639,8 @@ async def ai_coaching_session(session_data: dict):
         
         return response
         
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error in coaching session: {e}")
         raise HTTPException(status_code=500, detail="Error processing coaching session")
@@ -2145,6 +5734,7 @@ async def google_callback(request: Request, code: str = None, state: str = None,
                 {"id": user["id"]},
                 {"$set": {"last_login": datetime.now().isoformat()}}
             )
+            user_cache.invalidate(user["id"])
         
         # Create JWT access token
         access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -2221,6 +5811,7 @@ async def test_login():
             {"$set": test_user_data},
             upsert=True
         )
+        user_cache.invalidate(test_user_data["id"])
         
         # Create JWT token
         jwt_token = create_access_token(data={
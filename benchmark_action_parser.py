@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+Benchmark and fuzz check for the AI action tokenizer.
+Compares the single-pass tokenizer against the original 19-pattern regex
+parser (plus its three re.sub cleanup passes), verifies both agree on the
+seed corpus, and runs randomly mutated responses through the tokenizer and
+the streaming tag filter.
+"""
+
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend'))
+
+import server  # noqa: E402
+
+ROUNDS = 5
+FUZZ_CASES = 5000
+
+# Realistic responses - none use commas inside quoted values, so the legacy parser handles them correctly
+SEED_CORPUS = [
+    'אין בעיה, אני בודקת את זה.',
+    'רשמתי! [ADD_FAILURE: failure_number="F001", date="2025-01-20", system="מנוע ראשי", description="רעש חריג", urgency="4", assignee="יוסי", estimated_hours="3"] אני על זה.',
+    'סגרתי את התקלה [UPDATE_FAILURE: failure_number="F123", status="הושלם"] כל הכבוד!',
+    '[ADD_MAINTENANCE: maintenance_type="החלפת שמן", system="גנרטור 2", frequency_days="30", last_performed="2025-01-01"]\nתזכורת נקבעה.',
+    'עדכנתי שעות: [UPDATE_EQUIPMENT: system="מדחס אוויר", current_hours="612.5"] ומחקתי [DELETE_DAILY_WORK: id="abc-123"]',
+    '[ADD_CONVERSATION: meeting_number="3", meeting_date="2025-01-22", duration_minutes="45", main_topics="תקציב", yahel_energy_level="4"]',
+    '[ADD_90DAY_PLAN: week_number="2", goals="למפות צוות", concrete_actions="שיחות אישיות"] [ADD_DNA_ITEM: component_name="ערכים", clarity_level="3"]',
+    '[UPDATE_RESOLVED_FAILURE: failure_number="F077", resolution_method="החלפת מסנן", lessons_learned="לבדוק כל חודש"]',
+    'תגית לא מוכרת [ADD_SOMETHING: x="1"] וסוגריים רגילים [הערה] נשארים.',
+    '[DELETE_FAILURE: failure_number="F9"][DELETE_MAINTENANCE: id="m-1"][DELETE_EQUIPMENT: id="e-1"]',
+]
+
+# Responses that the legacy parser gets wrong, with the expected actions
+QUOTED_CORPUS = [
+    ('[ADD_CONVERSATION: main_topics="תקציב, גיוס, הדרכה", insights="צריך יותר זמן"]',
+     [('add_conversation', {'main_topics': ['תקציב', 'גיוס', 'הדרכה'], 'insights': ['צריך יותר זמן']})]),
+    ('[ADD_FAILURE: failure_number="F5", description="נזילה, כנראה אטם", urgency="5"]',
+     [('add_failure', {'failure_number': 'F5', 'description': 'נזילה, כנראה אטם', 'urgency': 5})]),
+    ('[UPDATE_FAILURE: failure_number="F6", notes="לוח [B] בחדר מכונות"] סיימתי',
+     [('update_failure', {'failure_number': 'F6', 'notes': 'לוח [B] בחדר מכונות'})]),
+    ('[ADD_EQUIPMENT: system="מערכת צה"ל", system_type="מנועים", current_hours="10"]',
+     [('add_equipment', {'system': 'מערכת צה"ל', 'system_type': 'מנועים', 'current_hours': 10.0})]),
+]
+
+FUZZ_FRAGMENTS = ['[', ']', '"', "'", ',', '=', ':', '\n', ' ', 'ADD_', 'UPDATE_FAILURE:', '[DELETE_', 'x=', 'שלום', '²', '1.2.3']
+
+def legacy_parse_ai_actions(ai_response: str):
+    """Original implementation, kept here as the reference"""
+    actions = []
+    patterns = [
+        (r'\[ADD_FAILURE:(.*?)\]', 'add_failure'),
+        (r'\[ADD_MAINTENANCE:(.*?)\]', 'add_maintenance'),
+        (r'\[ADD_EQUIPMENT:(.*?)\]', 'add_equipment'),
+        (r'\[ADD_DAILY_WORK:(.*?)\]', 'add_daily_work'),
+        (r'\[ADD_CONVERSATION:(.*?)\]', 'add_conversation'),
+        (r'\[ADD_DNA_ITEM:(.*?)\]', 'add_dna_item'),
+        (r'\[ADD_90DAY_PLAN:(.*?)\]', 'add_90day_plan'),
+        (r'\[UPDATE_FAILURE:(.*?)\]', 'update_failure'),
+        (r'\[UPDATE_MAINTENANCE:(.*?)\]', 'update_maintenance'),
+        (r'\[UPDATE_EQUIPMENT:(.*?)\]', 'update_equipment'),
+        (r'\[UPDATE_DAILY_WORK:(.*?)\]', 'update_daily_work'),
+        (r'\[UPDATE_CONVERSATION:(.*?)\]', 'update_conversation'),
+        (r'\[UPDATE_DNA_ITEM:(.*?)\]', 'update_dna_item'),
+        (r'\[UPDATE_90DAY_PLAN:(.*?)\]', 'update_90day_plan'),
+        (r'\[DELETE_FAILURE:(.*?)\]', 'delete_failure'),
+        (r'\[DELETE_MAINTENANCE:(.*?)\]', 'delete_maintenance'),
+        (r'\[DELETE_EQUIPMENT:(.*?)\]', 'delete_equipment'),
+        (r'\[DELETE_DAILY_WORK:(.*?)\]', 'delete_daily_work'),
+        (r'\[UPDATE_RESOLVED_FAILURE:(.*?)\]', 'update_resolved_failure'),
+    ]
+    for pattern, action_type in patterns:
+        for match in re.finditer(pattern, ai_response, re.DOTALL):
+            try:
+                params = {}
+                for param in match.group(1).strip().split(','):
+                    if '=' in param:
+                        key, value = param.strip().split('=', 1)
+                        key = key.strip()
+                        value = value.strip().strip('"\'')
+                        if key in ['main_topics', 'insights', 'decisions', 'gaps_identified', 'goals', 'concrete_actions', 'success_metrics']:
+                            params[key] = [item.strip() for item in value.split(',')] if ',' in value else [value]
+                        elif key in ['duration_minutes', 'yahel_energy_level', 'clarity_level', 'week_number', 'frequency_days', 'urgency']:
+                            params[key] = int(value) if value.isdigit() else 1
+                        elif key in ['estimated_hours', 'current_hours']:
+                            params[key] = float(value) if value.replace('.', '').isdigit() else 0.0
+                        else:
+                            params[key] = value
+                actions.append((action_type, params))
+            except Exception:
+                pass
+    return actions
+
+def legacy_parse_and_clean(ai_response: str):
+    actions = legacy_parse_ai_actions(ai_response)
+    clean = re.sub(r'\[ADD_\w+:.*?\]', '', ai_response, flags=re.DOTALL)
+    clean = re.sub(r'\[UPDATE_\w+:.*?\]', '', clean, flags=re.DOTALL)
+    clean = re.sub(r'\[DELETE_\w+:.*?\]', '', clean, flags=re.DOTALL)
+    return actions, clean
+
+def mutate(text: str, rng: random.Random) -> str:
+    chars = list(text)
+    for _ in range(rng.randint(1, 6)):
+        op = rng.random()
+        pos = rng.randint(0, len(chars))
+        if op < 0.4:
+            chars[pos:pos] = list(rng.choice(FUZZ_FRAGMENTS))
+        elif op < 0.7 and chars:
+            del chars[min(pos, len(chars) - 1)]
+        else:
+            chars = chars[:pos]  # Truncated response
+    return "".join(chars)
+
+def stream_filter(text: str, rng: random.Random) -> str:
+    tag_filter = server.ActionTagStreamFilter()
+    shown = []
+    pos = 0
+    while pos < len(text):
+        step = rng.randint(1, 8)
+        shown.append(tag_filter.feed(text[pos:pos + step]))
+        pos += step
+    shown.append(tag_filter.flush())
+    return "".join(shown)
+
+def sort_actions(actions):
+    return sorted(actions, key=repr)
+
+def check_corpus():
+    failures = 0
+    for text in SEED_CORPUS:
+        actions, clean = server.tokenize_ai_actions(text)
+        legacy_actions, legacy_clean = legacy_parse_and_clean(text)
+        if sort_actions(actions) != sort_actions(legacy_actions) or clean != legacy_clean:
+            print(f"❌ Seed differs from legacy parser: {text!r}")
+            failures += 1
+    for text, expected in QUOTED_CORPUS:
+        actions, _ = server.tokenize_ai_actions(text)
+        if actions != expected:
+            print(f"❌ Quoted value parsed as {actions!r}, expected {expected!r}")
+            failures += 1
+    return failures
+
+def run_fuzz():
+    rng = random.Random(1234)
+    seeds = SEED_CORPUS + [text for text, _ in QUOTED_CORPUS]
+    failures = 0
+    for _ in range(FUZZ_CASES):
+        text = mutate(rng.choice(seeds), rng)
+        try:
+            actions, clean = server.tokenize_ai_actions(text)
+        except Exception as e:
+            print(f"❌ Tokenizer raised {e!r} on {text!r}")
+            failures += 1
+            continue
+        # The cleaned text is at most the original, and the streaming filter must agree with it
+        if len(clean) > len(text) or stream_filter(text, rng) != clean:
+            print(f"❌ Stream filter and tokenizer disagree on {text!r}")
+            failures += 1
+        if any(not isinstance(params, dict) for _, params in actions):
+            print(f"❌ Bad params on {text!r}")
+            failures += 1
+    return failures
+
+def main():
+    print("🏷️  AI Action Tokenizer Benchmark")
+    print("=" * 50)
+
+    corpus = SEED_CORPUS * 200
+    legacy_times = []
+    tokenizer_times = []
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        for text in corpus:
+            legacy_parse_and_clean(text)
+        legacy_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for text in corpus:
+            server.tokenize_ai_actions(text)
+        tokenizer_times.append(time.perf_counter() - start)
+
+    print(f"Responses: {len(corpus)}, rounds: {ROUNDS}")
+    print(f"Legacy regex parse + clean: {min(legacy_times) * 1000:.2f} ms")
+    print(f"Single-pass tokenizer:      {min(tokenizer_times) * 1000:.2f} ms")
+    print(f"Speedup: {min(legacy_times) / min(tokenizer_times):.1f}x")
+
+    failures = check_corpus()
+    failures += run_fuzz()
+    if failures:
+        print(f"❌ {failures} checks failed")
+        sys.exit(1)
+    print(f"✅ Corpus matches, {FUZZ_CASES} fuzz cases passed")
+
+if __name__ == "__main__":
+    main()
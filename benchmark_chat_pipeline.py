@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Load benchmark for the AI chat pipeline using the local stub LLM provider.
+Measures context building, action parsing and action execution per chat, then
+runs concurrent chats end to end (including their background actions) to get
+chats per minute. Needs a MongoDB at
+MONGO_URL; all data goes to a separate benchmark database that is dropped at
+the end.
+"""
+
+import asyncio
+import contextlib
+import io
+import os
+import sys
+import time
+
+os.environ['LLM_PROVIDER'] = 'stub'
+os.environ.setdefault('LLM_STUB_LATENCY_MS', '50')
+os.environ.setdefault('LLM_STUB_TOKEN_DELAY_MS', '0')
+os.environ.setdefault('DB_NAME', 'yahel_chat_benchmark_db')
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend'))
+
+import server  # noqa: E402
+
+USERS = 20
+STAGE_CHATS = 500
+LOAD_CHATS = 2000
+WORKERS = server.LLM_MAX_CONCURRENCY
+
+MESSAGES = [
+    'יש תקלה במשאבה {i}, נזילה מהאטם',
+    'תקלה חדשה: רעש חריג במנוע {i}',
+    'תוסיף תחזוקה של החלפת מסנן {i}',
+    'תוסיף משימה לבדוק את לוח החשמל {i}',
+    'מה דעתך על חלוקת העבודה בצוות השבוע {i}?',
+    'איך לשפר את התקשורת עם המשמרת {i}',
+]
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+def report(label, values):
+    print(f"{label:<22} avg {sum(values) / len(values) * 1000:7.2f} ms   p95 {percentile(values, 0.95) * 1000:7.2f} ms")
+
+def bench_user(i):
+    return {"id": f"bench-user-{i}", "name": f"משתמש {i}", "preferred_name": f"משתמש {i}"}
+
+async def run_stages():
+    """Time each stage of a chat turn separately, in one task"""
+    provider = server.llm_provider
+    context_times, parse_times, execute_times = [], [], []
+    for i in range(STAGE_CHATS):
+        user = bench_user(i % USERS)
+        message = MESSAGES[i % len(MESSAGES)].format(i=i)
+
+        start = time.perf_counter()
+        request = server.build_ai_chat_request(message, f"stage-{i % USERS}", None, user)
+        context_times.append(time.perf_counter() - start)
+
+        response = provider.script(message)
+
+        start = time.perf_counter()
+        actions, _ = server.tokenize_ai_actions(response)
+        parse_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        results = server.run_ai_actions(actions, request["user_id"])
+        server.apply_ai_action_results(results, request["user_id"])
+        execute_times.append(time.perf_counter() - start)
+
+    return context_times, parse_times, execute_times
+
+async def run_load():
+    """Run chats end to end through create_yahel_ai_agent with WORKERS in parallel"""
+    queue = asyncio.Queue()
+    for i in range(LOAD_CHATS):
+        queue.put_nowait(i)
+    latencies = []
+    failures = []
+    error_replies = {
+        server.ai_error_response("").response,
+        server.ai_error_response("API key").response,
+        server.LLM_UNAVAILABLE_MESSAGE
+    }
+
+    async def worker(worker_id):
+        while not queue.empty():
+            i = queue.get_nowait()
+            user = bench_user(i % USERS)
+            message = MESSAGES[i % len(MESSAGES)].format(i=i)
+            start = time.perf_counter()
+            result = await server.create_yahel_ai_agent(message, f"load-{worker_id}-{i % USERS}", None, user)
+            latencies.append(time.perf_counter() - start)
+            if result.response in error_replies:
+                failures.append(result.response)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(w) for w in range(WORKERS)))
+    # Actions run in the background after each reply; include them in the total
+    while server.ai_action_tasks:
+        await asyncio.gather(*list(server.ai_action_tasks.values()))
+    elapsed = time.perf_counter() - start
+
+    return latencies, elapsed, failures
+
+async def main():
+    print("💬 AI Chat Pipeline Benchmark")
+    print("=" * 50)
+    # Chat records go through the buffered log writer, as in the running app
+    for writer in server.buffered_writers:
+        writer.start()
+    try:
+        # The server logs every chat turn; keep the report readable
+        with contextlib.redirect_stdout(io.StringIO()):
+            context_times, parse_times, execute_times = await run_stages()
+            latencies, elapsed, failures = await run_load()
+            for writer in server.buffered_writers:
+                await writer.stop()
+    finally:
+        server.client.drop_database(server.DB_NAME)
+
+    print(f"Stages ({STAGE_CHATS} chats, {USERS} users):")
+    report("Context building", context_times)
+    report("Action parsing", parse_times)
+    report("Action execution", execute_times)
+    print(f"End to end ({LOAD_CHATS} chats, {WORKERS} workers, stub latency {server.llm_provider.latency_ms:.0f} ms):")
+    report("Chat turn", latencies)
+    print(f"Throughput: {LOAD_CHATS / elapsed * 60:.0f} chats/minute")
+
+    if failures:
+        print(f"❌ {len(failures)} chats failed, first: {failures[0]}")
+        sys.exit(1)
+    print("✅ All chats completed")
+
+if __name__ == "__main__":
+    if os.environ['DB_NAME'] == 'yahel_department_db':
+        sys.exit("Refusing to run against the main database, set DB_NAME to a benchmark database")
+    asyncio.run(main())
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Benchmark for the equipment service-interval engine.
+Compares the batched NumPy engine against the original per-item calculation
+on 10k equipment rows and verifies both produce identical results.
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend'))
+
+import server  # noqa: E402
+
+ROWS = 10000
+ROUNDS = 5
+
+def legacy_calculate_service_hours(equipment: dict):
+    """Original per-item implementation, kept here as the reference"""
+    system_type = equipment['system_type'].lower()
+    current_hours = equipment['current_hours']
+
+    intervals = {
+        'מנועים': [250, 500, 1500, 3000, 6000],
+        'תשלובות': [500, 1000, 6000],
+        'גנרטורים': [400, 2000, 6000, 18000],
+        'מדחסים': [200, 600, 6000]
+    }
+
+    service_intervals = intervals.get(system_type, [500, 1000, 5000])
+    next_service = None
+
+    for interval in service_intervals:
+        if current_hours < interval:
+            next_service = interval
+            break
+
+    if not next_service:
+        next_service = service_intervals[-1] + service_intervals[-1]
+
+    hours_until = next_service - current_hours
+
+    if hours_until <= 10:
+        alert_level = "אדום"
+    elif hours_until <= 50:
+        alert_level = "כתום"
+    else:
+        alert_level = "ירוק"
+
+    equipment['next_service_hours'] = next_service
+    equipment['hours_until_service'] = hours_until
+    equipment['alert_level'] = alert_level
+
+    return equipment
+
+def generate_equipment(rows: int):
+    random.seed(42)
+    system_types = list(server.DEFAULT_SERVICE_INTERVALS.keys()) + ['משאבות']
+    items = []
+    for i in range(rows):
+        hours = random.choice([
+            random.randint(0, 20000),
+            round(random.uniform(0, 20000), 1),
+            random.choice([200, 250, 500, 600, 6000, 18000])  # exact boundaries
+        ])
+        items.append({
+            "id": f"EQ-{i}",
+            "system": f"מכלול {i}",
+            "system_type": random.choice(system_types),
+            "current_hours": hours
+        })
+    return items
+
+def main():
+    print("⚙️  Service Interval Engine Benchmark")
+    print("=" * 50)
+
+    # Use the built-in tables only, so the reference implementation matches
+    server.service_interval_engine.collection = None
+    server.service_interval_engine.versions_collection = None
+    server.service_interval_engine.invalidate()
+    server.service_interval_engine.get_tables()
+
+    base_items = generate_equipment(ROWS)
+
+    legacy_times = []
+    batch_times = []
+    for _ in range(ROUNDS):
+        legacy_items = [dict(item) for item in base_items]
+        start = time.perf_counter()
+        for item in legacy_items:
+            legacy_calculate_service_hours(item)
+        legacy_times.append(time.perf_counter() - start)
+
+        batch_items = [dict(item) for item in base_items]
+        start = time.perf_counter()
+        server.calculate_service_hours_batch(batch_items)
+        batch_times.append(time.perf_counter() - start)
+
+    compared_fields = ('next_service_hours', 'hours_until_service', 'alert_level')
+    mismatches = [
+        (legacy, batch) for legacy, batch in zip(legacy_items, batch_items)
+        if any(legacy[field] != batch[field] or type(legacy[field]) is not type(batch[field]) for field in compared_fields)
+    ]
+
+    print(f"Rows: {ROWS}, rounds: {ROUNDS}")
+    print(f"Legacy per-item: {min(legacy_times) * 1000:.2f} ms")
+    print(f"Batched engine:  {min(batch_times) * 1000:.2f} ms")
+    print(f"Speedup: {min(legacy_times) / min(batch_times):.1f}x")
+
+    if mismatches:
+        print(f"❌ {len(mismatches)} rows differ, first: {mismatches[0]}")
+        sys.exit(1)
+    print("✅ Results identical to the original calculation")
+
+if __name__ == "__main__":
+    main()
@@ -70,6 +70,7 @@ function App() {
   const [currentMessage, setCurrentMessage] = useState('');
   const [chatHistory, setChatHistory] = useState([]);
   const [isLoading, setIsLoading] = useState(false);
+  const [isStreaming, setIsStreaming] = useState(false);
 
   // API calls
   const BACKEND_URL = process.env.REACT_APP_BACKEND_URL || 'https://yahel-leadership.preview.emergentagent.com';
@@ -750,32 +751,84 @@ function App() {
     setChatHistory(prev => [...prev, newUserMessage]);
     
     try {
-      const response = await axios.post(`${BACKEND_URL}/api/ai-chat`, {
-        user_message: userMessage,
-        session_id: sessionId,
-        chat_history: chatHistory
-      }, { headers: getAuthHeaders() });
+      const response = await fetch(`${BACKEND_URL}/api/ai-chat/stream`, {
+        method: 'POST',
+        headers: { ...getAuthHeaders(), 'Content-Type': 'application/json' },
+        body: JSON.stringify({
+          user_message: userMessage,
+          session_id: sessionId,
+          // Lets the server recognize a retried message instead of answering it twice
+          client_message_id: window.crypto?.randomUUID ? window.crypto.randomUUID() : `${Date.now()}-${Math.random()}`
+        })
+      });
       
-      // Add AI response to chat
-      const aiResponse = { role: 'assistant', content: response.data.response };
-      setChatHistory(prev => [...prev, aiResponse]);
+      if (response.status === 401) {
+        handleLogout();
+        return;
+      }
+      if (response.status === 429) {
+        // Server is busy - show its message instead of a generic error
+        const { detail } = await response.json();
+        setChatHistory(prev => [...prev, { role: 'assistant', content: detail }]);
+        return;
+      }
+      if (!response.ok || !response.body) {
+        throw new Error(`Chat request failed: ${response.status}`);
+      }
       
-      // Refresh data if tables were updated
-      if (response.data.updated_tables && response.data.updated_tables.length > 0) {
-        fetchData();
+      // Add an empty AI message and fill it as tokens arrive
+      const updateAiMessage = (content) => {
+        setChatHistory(prev => [...prev.slice(0, -1), { role: 'assistant', content }]);
+      };
+      setChatHistory(prev => [...prev, { role: 'assistant', content: '' }]);
+      setIsStreaming(true);
+      
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      let streamedText = '';
+      
+      while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        
+        buffer += decoder.decode(value, { stream: true });
+        const events = buffer.split('\n\n');
+        buffer = events.pop();
+        
+        for (const event of events) {
+          if (!event.startsWith('data: ')) continue;
+          const data = JSON.parse(event.slice(6));
+          
+          if (data.type === 'token') {
+            streamedText += data.text;
+            updateAiMessage(streamedText);
+          } else if (data.type === 'done') {
+            updateAiMessage(data.response);
+            // Refresh data if tables were updated
+            if (data.updated_tables && data.updated_tables.length > 0) {
+              fetchData();
+            }
+          } else if (data.type === 'actions') {
+            // Actions run after the reply text - show the confirmation and refresh the tables
+            updateAiMessage(data.response);
+            if (data.updated_tables && data.updated_tables.length > 0) {
+              fetchData();
+            }
+          } else if (data.type === 'error') {
+            updateAiMessage(data.response);
+          }
+        }
       }
       
     } catch (error) {
       console.error('Error sending message:', error);
       const errorMessage = { role: 'assistant', content: 'מצטער, יש בעיה בחיבור למערכת. נסה שוב מאוחר יותר.' };
       setChatHistory(prev => [...prev, errorMessage]);
-      
-      if (error.response && error.response.status === 401) {
-        handleLogout();
-      }
+    } finally {
+      setIsStreaming(false);
+      setIsLoading(false);
     }
-    
-    setIsLoading(false);
   };
 
   const clearChat = async () => {
@@ -1142,7 +1195,7 @@ function App() {
                         </div>
                       ))}
                       
-                      {isLoading && (
+                      {isLoading && !isStreaming && (
                         <div className="flex justify-start">
                           <div className="bg-white border shadow-sm p-3 rounded-lg">
                             <div className="flex space-x-1">
@@ -0,0 +1,69 @@
+"""
+Shared test setup: the backend module runs against an in-memory MongoDB
+(mongomock) and the local stub LLM provider, with the scheduler disabled.
+"""
+
+import os
+import sys
+import tempfile
+
+import mongomock
+import pymongo
+import pytest
+
+os.environ['DB_NAME'] = 'yahel_test_db'
+os.environ['LLM_PROVIDER'] = 'stub'
+os.environ['LLM_STUB_LATENCY_MS'] = '0'
+os.environ['LLM_STUB_TOKEN_DELAY_MS'] = '0'
+os.environ['SCHEDULER_ENABLED'] = 'false'
+os.environ.setdefault('OPENAI_API_KEY', '')
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend'))
+
+# server.py does "from pymongo import MongoClient" at import time
+pymongo.MongoClient = mongomock.MongoClient
+
+# The push notification service writes its VAPID key files to the working directory
+_cwd = os.getcwd()
+os.chdir(tempfile.mkdtemp())
+try:
+    import server as backend  # noqa: E402
+finally:
+    os.chdir(_cwd)
+
+backend.ensure_indexes()
+
+TEST_USER = {"id": "test-user", "email": "test@yahel-naval.com", "name": "Test User", "is_active": True}
+
+@pytest.fixture
+def server():
+    return backend
+
+@pytest.fixture(autouse=True)
+def clean_state():
+    """Empty every collection (indexes stay) and drop in-memory caches after each test"""
+    yield
+    for writer in backend.buffered_writers:
+        writer.flush()
+    for name in backend.db.list_collection_names():
+        backend.db[name].delete_many({})
+    backend.user_cache.invalidate()
+    backend.ai_context_cache.invalidate()
+    backend.service_interval_engine.invalidate()
+    backend.resolved_failure_index.invalidate()
+    backend.search_index.invalidate()
+    backend.response_cache.invalidate()
+    backend.llm_circuit.record_success()
+
+@pytest.fixture
+def user():
+    backend.authenticated_users_collection.insert_one(dict(TEST_USER))
+    return dict(TEST_USER)
+
+@pytest.fixture
+def api(user):
+    """TestClient authenticated as the test user"""
+    from fastapi.testclient import TestClient
+    backend.app.dependency_overrides[backend.get_current_user] = lambda: user
+    yield TestClient(backend.app)
+    backend.app.dependency_overrides.clear()
@@ -0,0 +1,41 @@
+import pytest
+
+def test_actions_in_order_with_typed_params(server):
+    actions, text = server.tokenize_ai_actions(
+        'רשמתי. [ADD_FAILURE: failure_number="F7", system="משאבה", urgency="4", estimated_hours="1.5"] '
+        'ועדכנתי [UPDATE_EQUIPMENT: id="eq-1", current_hours=120] סיימתי'
+    )
+    assert actions == [
+        ("add_failure", {"failure_number": "F7", "system": "משאבה", "urgency": 4, "estimated_hours": 1.5}),
+        ("update_equipment", {"id": "eq-1", "current_hours": 120.0}),
+    ]
+    assert text == "רשמתי.  ועדכנתי  סיימתי"
+
+def test_quoted_values_keep_commas_brackets_and_quotes(server):
+    actions, _ = server.tokenize_ai_actions(
+        '[ADD_FAILURE: description="נזילה בצנרת [קו 2], ליד המשאבה "הראשית"", system="צנרת"]'
+    )
+    assert actions[0][1] == {"description": 'נזילה בצנרת [קו 2], ליד המשאבה "הראשית"', "system": "צנרת"}
+
+def test_list_params_are_split(server):
+    actions, _ = server.tokenize_ai_actions('[ADD_CONVERSATION: goals="יעד א, יעד ב", meeting_type="אישי"]')
+    assert actions[0][1]["goals"] == ["יעד א", "יעד ב"]
+
+@pytest.mark.parametrize("urgency, expected", [("5", 5), ("גבוהה", 1), ("", 1)])
+def test_bad_int_params_fall_back(server, urgency, expected):
+    actions, _ = server.tokenize_ai_actions(f'[ADD_FAILURE: urgency="{urgency}"]')
+    assert actions[0][1]["urgency"] == expected
+
+def test_unknown_tags_are_removed_but_not_executed(server):
+    actions, text = server.tokenize_ai_actions('בוצע [DELETE_EVERYTHING: id="1"]')
+    assert actions == []
+    assert text == "בוצע "
+
+def test_unterminated_tag_stays_in_text(server):
+    reply = 'כמעט [ADD_FAILURE: system="מנוע'
+    actions, text = server.tokenize_ai_actions(reply)
+    assert actions == [] and text == reply
+
+def test_parse_ai_actions_matches_tokenizer(server):
+    reply = '[ADD_DAILY_WORK: task="בדיקה", date="2025-03-01"]'
+    assert server.parse_ai_actions(reply) == server.tokenize_ai_actions(reply)[0]
@@ -0,0 +1,64 @@
+class CountingCollection:
+    """Collection wrapper that counts bulk_write calls"""
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.bulk_writes = 0
+
+    def bulk_write(self, *args, **kwargs):
+        self.bulk_writes += 1
+        return self.collection.bulk_write(*args, **kwargs)
+
+def insert_failure(server, user_id, failure_number, **fields):
+    server.active_failures_collection.insert_one({
+        "id": f"failure-{user_id}-{failure_number}", "user_id": user_id, "failure_number": failure_number,
+        "date": "2025-03-01", "system": "מנוע", "description": "רעש", "urgency": 3, "assignee": "דני",
+        "estimated_hours": 2, "status": "פעיל", "created_at": "2025-03-01T08:00:00", **fields
+    })
+
+def test_one_bulk_write_per_collection(server, user, monkeypatch):
+    collections = [(key, CountingCollection(collection)) for key, collection in server.AI_ACTION_COLLECTIONS]
+    monkeypatch.setattr(server, "AI_ACTION_COLLECTIONS", collections)
+    actions = [("add_failure", {"failure_number": f"F{i}", "system": "משאבה"}) for i in range(5)]
+    actions.append(("add_daily_work", {"task": "בדיקה", "date": "2025-03-01"}))
+
+    results = server.run_ai_actions(actions, user['id'])
+    assert [result['status'] for result in results] == ['ok'] * 6
+    assert {key: wrapper.bulk_writes for key, wrapper in collections if wrapper.bulk_writes} == {"failures": 1, "daily_work": 1}
+    assert server.active_failures_collection.count_documents({"user_id": user['id']}) == 5
+
+def test_later_actions_see_earlier_ones_in_the_same_reply(server, user):
+    results = server.run_ai_actions([
+        ("add_failure", {"failure_number": "F1", "system": "משאבה"}),
+        ("update_failure", {"failure_number": "F1", "urgency": 5}),
+        ("add_failure", {"failure_number": "F2"}),
+        ("delete_failure", {"failure_number": "F2"}),
+    ], user['id'])
+    assert [result['status'] for result in results] == ['ok'] * 4
+    stored = list(server.active_failures_collection.find({"user_id": user['id']}, {"_id": 0}))
+    assert [(failure['failure_number'], failure['urgency']) for failure in stored] == [("F1", 5)]
+
+def test_failed_actions_report_no_tables(server, user):
+    insert_failure(server, user['id'], "F1")
+    results = server.run_ai_actions([
+        ("update_failure", {"failure_number": "F9", "urgency": 5}),
+        ("update_failure", {"failure_number": "F1"}),
+        ("update_failure", {"failure_number": "F1", "urgency": 4}),
+    ], user['id'])
+    assert [result['status'] for result in results] == ['not_found', 'no_changes', 'ok']
+    assert server.apply_ai_action_results(results, user['id']) == ['תקלות פעילות']
+
+def test_actions_only_touch_the_users_own_rows(server, user):
+    insert_failure(server, "other-user", "F1")
+    results = server.run_ai_actions([("delete_failure", {"failure_number": "F1"})], user['id'])
+    assert results[0]['status'] == 'not_found'
+    assert server.active_failures_collection.count_documents({"user_id": "other-user"}) == 1
+
+def test_closing_a_failure_moves_it_to_resolved(server, user):
+    insert_failure(server, user['id'], "F1")
+    results = server.run_ai_actions([("update_failure", {"failure_number": "F1", "status": "נסגר"})], user['id'])
+    assert results[0]['resolved'] and results[0]['needs_resolution_details']
+    assert server.closed_failure_numbers(results) == ["F1"]
+    assert server.active_failures_collection.count_documents({}) == 0
+    resolved = server.resolved_failures_collection.find_one({"failure_number": "F1"})
+    assert resolved['user_id'] == user['id'] and resolved['resolved_by'] == "דני"
@@ -0,0 +1,71 @@
+import sys
+import types
+
+def failures(count):
+    return [
+        {"failure_number": f"F{i}", "system": f"מכלול {i}", "description": "רעש חריג במנוע " * 3,
+         "urgency": 5 if i % 10 == 0 else 1, "status": "פעיל", "assignee": "רונן"}
+        for i in range(count)
+    ]
+
+def test_tokenizer_is_not_loaded_at_import(server):
+    assert "get_token_encoder" in dir(server)
+    assert not hasattr(server, "token_encoder")
+
+def test_tokenizer_failure_falls_back_to_character_estimate(server, monkeypatch):
+    broken = types.ModuleType("tiktoken")
+
+    def get_encoding(name):
+        raise OSError("network unreachable")
+
+    broken.get_encoding = get_encoding
+    monkeypatch.setitem(sys.modules, "tiktoken", broken)
+    monkeypatch.setattr(server, "_token_encoder", None)
+    monkeypatch.setattr(server, "_token_encoder_loaded", False)
+
+    assert server.estimate_tokens("א" * 30) == 10
+    assert server._token_encoder_loaded  # Not retried on every call
+    assert server.estimate_tokens("") == 0
+
+def test_context_stays_within_budget_and_keeps_urgent_rows(server):
+    context = server.build_ai_context({"failures": failures(200)}, {}, token_budget=400)
+    assert context["tokens"] <= 400
+    sections = context["sections"]
+    assert 0 < sections["failures"]["included"] < sections["failures"]["total"] == 200
+    assert "F0|" in context["text"] and "F10|" in context["text"]  # Urgency 5 rows rank first
+
+def test_zero_budget_has_no_context(server):
+    context = server.build_ai_context({"failures": failures(5), "summary": {"failures": 5}}, {}, token_budget=0)
+    assert context["text"] == ""
+
+FAILURE = {"failure_number": "F1", "date": "2025-03-01", "system": "מנוע ראשי", "description": "רעש חריג",
+           "urgency": 4, "assignee": "רונן", "estimated_hours": 2}
+
+def test_context_is_served_from_cache_until_data_changes(server, api, user):
+    first = server.get_cached_ai_context(user['id'])
+    assert not first['cached']
+    assert server.get_cached_ai_context(user['id'])['cached']
+
+    api.post("/api/failures", json=FAILURE)
+    rebuilt = server.get_cached_ai_context(user['id'])
+    assert not rebuilt['cached']
+    assert "F1|" in rebuilt['context']['text']
+
+def test_writes_of_one_user_keep_other_users_cached(server, api, user):
+    server.get_cached_ai_context("other-user")
+    api.post("/api/failures", json=FAILURE)
+    assert server.get_cached_ai_context("other-user")['cached']
+
+def test_context_variants_are_cached_separately(server, user):
+    server.get_cached_ai_context(user['id'], token_budget=500)
+    assert not server.get_cached_ai_context(user['id'], token_budget=1000)['cached']
+    assert server.get_cached_ai_context(user['id'], token_budget=500)['cached']
+
+def test_cache_evicts_least_recently_used_user(server):
+    cache = server.AIContextCache(max_size=2)
+    cache.set("a", (), 1, {"context": "a"})
+    cache.set("b", (), 1, {"context": "b"})
+    cache.get("a", (), 1)
+    cache.set("c", (), 1, {"context": "c"})
+    assert cache.get("b", (), 1) is None
+    assert cache.get("a", (), 1) == {"context": "a"}
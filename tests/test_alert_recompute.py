@@ -0,0 +1,67 @@
+import asyncio
+from datetime import datetime, timedelta
+
+def insert_equipment(server, user_id, current_hours, alert_level=None):
+    server.equipment_hours_collection.insert_one({
+        "id": "eq-1", "user_id": user_id, "system": "מנוע ראשי", "system_type": "מנועים",
+        "current_hours": current_hours, "alert_level": alert_level
+    })
+
+def test_first_run_fills_levels_without_events(server, user):
+    insert_equipment(server, user['id'], 100)
+    result = server.recompute_derived_fields()
+    assert result == {"maintenance_updated": 0, "equipment_updated": 1, "events": 0}
+    assert server.equipment_hours_collection.find_one({"id": "eq-1"})['alert_level'] == "ירוק"
+
+def test_unchanged_rows_are_not_written(server, user):
+    insert_equipment(server, user['id'], 100)
+    server.recompute_derived_fields()
+    assert server.recompute_derived_fields()['equipment_updated'] == 0
+
+def test_level_change_records_an_escalation_event(server, user):
+    insert_equipment(server, user['id'], 100)
+    server.recompute_derived_fields()
+    server.equipment_hours_collection.update_one({"id": "eq-1"}, {"$set": {"current_hours": 245}})
+
+    assert server.recompute_derived_fields()['events'] == 1
+    event = server.alert_events_collection.find_one({}, {"_id": 0})
+    assert (event['previous'], event['current'], event['escalation']) == ("ירוק", "אדום", True)
+    assert event['user_id'] == user['id'] and not event['delivered']
+
+def test_only_escalations_are_notified(server, user, monkeypatch):
+    sent = []
+
+    async def send_notification(**kwargs):
+        sent.append(kwargs)
+
+    monkeypatch.setattr(server.push_service, "send_notification", send_notification)
+    insert_equipment(server, user['id'], 245, alert_level="ירוק")
+    server.recompute_derived_fields()  # ירוק -> אדום
+    server.equipment_hours_collection.update_one({"id": "eq-1"}, {"$set": {"current_hours": 260}})
+    server.recompute_derived_fields()  # אדום -> ירוק after the service boundary
+
+    result = asyncio.run(server.push_service.deliver_alert_events())
+    assert result == {"events": 2, "notifications": 1}
+    assert sent[0]['user_id'] == user['id']
+    assert server.alert_events_collection.count_documents({"delivered": False}) == 0
+
+def test_leader_lock_is_held_by_one_worker(server):
+    first = server.MongoLeaderLock(server.scheduler_locks_collection, "test-leader")
+    second = server.MongoLeaderLock(server.scheduler_locks_collection, "test-leader")
+
+    assert first.acquire()
+    assert first.acquire()  # Renewal
+    assert not second.acquire()
+
+    first.release()
+    assert second.acquire()
+
+def test_expired_lease_can_be_taken_over(server):
+    first = server.MongoLeaderLock(server.scheduler_locks_collection, "test-leader")
+    second = server.MongoLeaderLock(server.scheduler_locks_collection, "test-leader")
+    assert first.acquire()
+    server.scheduler_locks_collection.update_one(
+        {"_id": "test-leader"}, {"$set": {"expires_at": datetime.utcnow() - timedelta(seconds=1)}}
+    )
+    assert second.acquire()
+    assert not first.acquire()
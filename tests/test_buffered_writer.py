@@ -0,0 +1,73 @@
+import asyncio
+
+class FlakyCollection:
+    """Collection whose first insert_many fails"""
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.failures = 1
+
+    def insert_many(self, documents, ordered=True):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("mongo unreachable")
+        return self.collection.insert_many(documents, ordered=ordered)
+
+def test_records_are_buffered_until_flushed(server):
+    collection = server.db.test_buffer
+    flushed = []
+    writer = server.BufferedWriter("test", collection, on_flush=flushed.extend, flush_seconds=60)
+
+    async def scenario():
+        writer.start()
+        writer.add({"id": "r1", "session_id": "s1"})
+        writer.add({"id": "r2", "session_id": "s2"})
+        assert collection.count_documents({}) == 0
+        assert [record["id"] for record in writer.pending(lambda record: record["session_id"] == "s1")] == ["r1"]
+        await writer.stop()
+
+    asyncio.run(scenario())
+    assert collection.count_documents({}) == 2
+    assert [record["id"] for record in flushed] == ["r1", "r2"]
+    assert writer.pending(lambda record: True) == []
+
+def test_full_buffer_flushes_without_waiting(server):
+    collection = server.db.test_buffer
+    writer = server.BufferedWriter("test", collection, max_docs=2, flush_seconds=60)
+
+    async def scenario():
+        writer.start()
+        writer.add({"id": "r1"})
+        writer.add({"id": "r2"})
+        await asyncio.sleep(0.05)  # The flush runs in a worker thread
+        assert collection.count_documents({}) == 2
+        await writer.stop()
+
+    asyncio.run(scenario())
+
+def test_failed_flush_keeps_the_records(server):
+    collection = server.db.test_buffer
+    writer = server.BufferedWriter("test", FlakyCollection(collection), flush_seconds=60)
+
+    async def scenario():
+        writer.start()
+        writer.add({"id": "r1"})
+        assert writer.flush() == 0
+        assert [record["id"] for record in writer.pending(lambda record: True)] == ["r1"]
+        await writer.stop()
+
+    asyncio.run(scenario())
+    assert [record["id"] for record in collection.find({}, {"_id": 0})] == ["r1"]
+
+def test_already_written_records_are_not_an_error(server):
+    collection = server.db.test_buffer
+    collection.create_index("id", unique=True)
+    writer = server.BufferedWriter("test", collection)
+    writer.add({"id": "r1"})
+    writer.add({"id": "r1"})  # E.g. a retry after a flush whose reply was lost
+    assert collection.count_documents({}) == 1
+
+def test_without_start_records_are_written_immediately(server):
+    writer = server.BufferedWriter("test", server.db.test_buffer)
+    writer.add({"id": "r1"})
+    assert server.db.test_buffer.count_documents({}) == 1
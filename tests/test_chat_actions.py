@@ -0,0 +1,67 @@
+import asyncio
+import time
+
+def insert_failure(server, user_id, failure_number="F5"):
+    server.active_failures_collection.insert_one({
+        "id": f"failure-{failure_number}", "user_id": user_id, "failure_number": failure_number,
+        "date": "2025-03-01", "system": "מנוע", "description": "רעש", "urgency": 3, "assignee": "דני",
+        "estimated_hours": 2, "status": "פעיל", "created_at": "2025-03-01T08:00:00"
+    })
+
+def test_retried_close_command_is_replayed(server, user):
+    insert_failure(server, user['id'])
+
+    async def send():
+        return await server.create_yahel_ai_agent("סגרי את התקלה F5", "s1", [], user, client_message_id="m1")
+
+    first = asyncio.run(send())
+    retried = asyncio.run(send())
+
+    assert first.intent == "close_failure"
+    assert first.chat_id == server.chat_record_id(user['id'], "m1")
+    assert retried.response == first.response
+    assert retried.chat_id == first.chat_id
+    assert server.resolved_failures_collection.count_documents({"failure_number": "F5"}) == 1
+    server.chat_log_writer.flush()
+    assert server.ai_chat_history_collection.count_documents({"id": first.chat_id}) == 1
+
+def test_fast_path_without_client_message_id_gets_a_fresh_record(server, user):
+    first = server.handle_chat_query("כמה תקלות פעילות יש?", "s1", [], user)
+    second = server.handle_chat_query("כמה תקלות פעילות יש?", "s1", [], user)
+    assert first.chat_id and second.chat_id and first.chat_id != second.chat_id
+
+def test_next_turn_waits_for_the_session_actions(server, user, monkeypatch):
+    events = []
+
+    def slow_actions(chat_id, user_id):
+        time.sleep(0.1)
+        events.append("actions")
+
+    monkeypatch.setattr(server, "execute_chat_actions", slow_actions)
+
+    async def scenario():
+        server.schedule_chat_actions("chat-1", user['id'], "s1")
+        async with server.llm_limiter.session(user['id'], "s1"):
+            events.append("next turn")
+
+    asyncio.run(scenario())
+    assert events == ["actions", "next turn"]
+    assert not server.llm_limiter._session_actions
+
+def test_other_sessions_do_not_wait(server, user, monkeypatch):
+    events = []
+
+    def slow_actions(chat_id, user_id):
+        time.sleep(0.1)
+        events.append("actions")
+
+    monkeypatch.setattr(server, "execute_chat_actions", slow_actions)
+
+    async def scenario():
+        future = server.schedule_chat_actions("chat-1", user['id'], "s1")
+        async with server.llm_limiter.session(user['id'], "s2"):
+            events.append("other session")
+        await future
+
+    asyncio.run(scenario())
+    assert events == ["other session", "actions"]
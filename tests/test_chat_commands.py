@@ -0,0 +1,54 @@
+import pytest
+
+@pytest.mark.parametrize("message, failure_number", [
+    ("סגרי את התקלה F5", "F5"),
+    ("בבקשה תסגרי תקלה מספר f12.", "F12"),
+    ("התקלה F7 טופלה", "F7"),
+    ("סיימנו עם התקלה F3 בבקשה!", "F3"),
+])
+def test_close_commands_are_recognized(server, message, failure_number):
+    assert server.match_close_failure_command(message) == failure_number
+
+@pytest.mark.parametrize("message", [
+    "למה התקלה F5 עדיין לא נסגרה?",
+    "סגרי את התקלה F5 ותוסיפי משימה למחר",
+    "אפשר לסגור את התקלה?",
+    "התקלה F7 טופלה אבל צריך לבדוק שוב את המשאבה",
+])
+def test_other_messages_are_left_to_the_model(server, message):
+    assert server.match_close_failure_command(message) is None
+
+def test_resolution_details_are_parsed_by_label(server):
+    assert server.parse_resolution_details("איך: החלפנו אטם, זמן: 3.5 שעות, מי: רונן, מניעה: בדיקה חודשית") == {
+        "resolution_method": "החלפנו אטם",
+        "actual_hours": "3.5",
+        "resolved_by": "רונן",
+        "lessons_learned": "בדיקה חודשית",
+    }
+    assert server.parse_resolution_details("החלפנו אטם, איך: זה לקח זמן") is None
+
+def insert_failure(server, user_id, failure_number="F5"):
+    server.active_failures_collection.insert_one({
+        "id": f"failure-{failure_number}", "user_id": user_id, "failure_number": failure_number,
+        "date": "2025-03-01", "system": "מנוע", "description": "רעש", "urgency": 3, "assignee": "דני",
+        "estimated_hours": 2, "status": "פעיל", "created_at": "2025-03-01T08:00:00"
+    })
+
+def test_close_then_details_updates_the_resolved_failure(server, user):
+    insert_failure(server, user['id'])
+    closed = server.handle_chat_command("סגרי את התקלה F5", "s1", [], user)
+    assert closed.intent == "close_failure"
+    assert "סגרתי את התקלה F5 (מנוע)" in closed.response
+
+    details = server.handle_chat_command("איך: החלפנו אטם, זמן: 3 שעות", "s1", [], user)
+    assert details.intent == "resolution_details"
+    resolved = server.resolved_failures_collection.find_one({"failure_number": "F5"})
+    assert (resolved['resolution_method'], resolved['actual_hours']) == ("החלפנו אטם", 3.0)
+
+def test_details_in_a_session_without_a_closed_failure_go_to_the_model(server, user):
+    assert server.handle_chat_command("איך: החלפנו אטם", "s1", [], user) is None
+
+def test_unknown_failure_is_reported(server, user):
+    response = server.handle_chat_command("סגרי את התקלה F99", "s1", [], user)
+    assert "לא מצאתי תקלה פעילה מספר F99" in response.response
+    assert response.updated_tables == []
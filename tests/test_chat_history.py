@@ -0,0 +1,51 @@
+from datetime import datetime, timedelta
+
+START = datetime(2025, 3, 1, 8)
+
+def add_turns(server, user_id, count, session_id="s1", first=0):
+    for turn in range(first, first + count):
+        server.chat_log_writer.add({
+            "id": f"chat-{session_id}-{turn}", "session_id": session_id, "user_id": user_id,
+            "user_message": f"שאלה {turn}. עוד פרטים", "ai_response": f"תשובה {turn}",
+            "timestamp": (START + timedelta(minutes=turn)).isoformat(),
+            "updated_tables": [], "closed_failures": []
+        })
+
+def test_older_turns_are_folded_into_the_summary(server, user):
+    add_turns(server, user['id'], 6)
+    server.chat_log_writer.flush()
+
+    history = server.load_chat_history(user['id'], "s1")
+    assert [turn['user_message'] for turn in history['recent']] == ["שאלה 3. עוד פרטים", "שאלה 4. עוד פרטים", "שאלה 5. עוד פרטים"]
+    assert history['summary'] == ["יהל: שאלה 0. | ג'סיקה: תשובה 0", "יהל: שאלה 1. | ג'סיקה: תשובה 1", "יהל: שאלה 2. | ג'סיקה: תשובה 2"]
+    assert history['turns'] == 6
+
+def test_buffered_turns_are_part_of_the_history(server, user):
+    add_turns(server, user['id'], 2)
+    history = server.load_chat_history(user['id'], "s1")
+    assert [turn['ai_response'] for turn in history['recent']] == ["תשובה 0", "תשובה 1"]
+
+def test_summary_keeps_only_the_latest_lines(server, user):
+    for batch in range(4):  # Flushed over several turns, as in a long session
+        add_turns(server, user['id'], 5, first=batch * 5)
+        server.chat_log_writer.flush()
+    summary = server.load_chat_history(user['id'], "s1")['summary']
+    assert len(summary) == server.CHAT_SUMMARY_MAX_LINES
+    assert summary[-1].startswith("יהל: שאלה 16.")
+
+def test_sessions_are_kept_apart(server, user):
+    add_turns(server, user['id'], 2, session_id="s1")
+    add_turns(server, user['id'], 1, session_id="s2")
+    assert len(server.load_chat_history(user['id'], "s2")['recent']) == 1
+    assert server.load_chat_history("other-user", "s1")['recent'] == []
+
+def test_summary_line_records_what_changed(server):
+    line = server.summarize_chat_turn({"user_message": "סגרי את התקלה F5", "ai_response": "סגרתי",
+                                        "closed_failures": ["F5"], "updated_tables": ["תקלות פעילות"]})
+    assert line == "יהל: סגרי את התקלה F5 | נסגרו: F5 | עודכן: תקלות פעילות"
+
+def test_clearing_a_session_drops_its_summary(server, api, user):
+    add_turns(server, user['id'], 5)
+    server.chat_log_writer.flush()
+    assert api.delete("/api/ai-chat/history/s1").status_code == 200
+    assert server.load_chat_history(user['id'], "s1") == {"summary": [], "recent": [], "turns": 0}
@@ -0,0 +1,54 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+@pytest.mark.parametrize("message, intent", [
+    ("כמה תקלות דחופות יש?", "urgent_failures"),
+    ("כמה תקלות פתוחות יש לנו", "open_failures"),
+    ("יש תקלות פתוחות?", "open_failures"),
+    ("ג'סיקה, מה התקלות הפעילות?", "open_failures"),
+    ("מה צריך לעשות השבוע?", "due_this_week"),
+    ("אילו אחזקות יש השבוע?", "due_this_week"),
+    ("מה באיחור?", "overdue_maintenance"),
+    ("מה יש לי היום", "today_work"),
+    ("מה מתוכנן להיום?", "today_work"),
+    ("אילו מכלולים צריכים טיפול", "equipment_service"),
+    ("מה המצב של התקלה F1?", "failure_status"),
+    ("מה הסטטוס של תקלה f12", "failure_status"),
+    ("מה עם התקלה F7?", "failure_status"),
+])
+def test_list_questions_take_the_fast_path(server, message, intent):
+    match = server.match_chat_query(message)
+    assert match is not None and match[0] == intent
+
+@pytest.mark.parametrize("message", [
+    "מה דעתך על חלוקת העבודה בצוות השבוע?",
+    "יש לי בעיה עם הצוות השבוע",
+    "מה אני צריך לעשות היום עם הצוות?",
+    "מה לעשות עם התקלה F12?",
+    "מה את חושבת על התקלות הדחופות שנפתחו השבוע אצל המשמרת של רונן?",
+    "למה יש כל כך הרבה תקלות?",
+    "איך אני משפר את הצוות השבוע?",
+    "תוסיפי תקלה דחופה במנוע",
+    "מה הדרך הכי טובה לטפל בתקלה F3?",
+    "שלום מה נשמע",
+    "מה היה בפגישה השבוע?",
+])
+def test_free_form_messages_go_to_the_model(server, message):
+    assert server.match_chat_query(message) is None
+
+def test_fast_path_answers_from_the_database(server, user):
+    today = datetime.now().date()
+    server.active_failures_collection.insert_many([
+        {"id": "a1", "user_id": user['id'], "failure_number": "F1", "system": "מנוע", "description": "רעש", "urgency": 5, "status": "פעיל"},
+        {"id": "a2", "user_id": user['id'], "failure_number": "F2", "system": "משאבה", "description": "נזילה", "urgency": 2, "status": "פעיל"},
+        {"id": "a3", "user_id": "someone-else", "failure_number": "F3", "system": "מדחס", "description": "חום", "urgency": 5, "status": "פעיל"},
+    ])
+    server.daily_work_collection.insert_one({"id": "w1", "user_id": user['id'], "date": today.isoformat(), "task": "בדיקת מנוע", "status": "מתוכנן"})
+
+    urgent = server.handle_chat_query("כמה תקלות דחופות יש?", "s1", [], user)
+    assert urgent.intent == "urgent_failures"
+    assert "יש 1 תקלות דחופות" in urgent.response and "F3" not in urgent.response
+
+    assert "להיום מתוכננות 1 משימות" in server.handle_chat_query("מה מתוכנן להיום?", "s1", [], user).response
+    assert "לא מצאתי" in server.handle_chat_query("מה המצב של התקלה F9?", "s1", [], user).response
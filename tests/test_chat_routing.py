@@ -0,0 +1,38 @@
+import pytest
+
+@pytest.mark.parametrize("message, tier", [
+    ("תודה רבה!", "ack"),
+    ("אוקיי, מעולה", "ack"),
+    ("כן", "coaching"),  # A bare yes may confirm an action Jessica proposed
+    ("תוסיפי תקלה במשאבת הדלק", "command"),
+    ("יש תקלה בגנרטור 2", "command"),
+    ("כמה תקלות פעילות יש?", "data"),
+    ("מה מתוכנן למחר?", "data"),
+    ("איך לשפר את המוטיבציה בצוות?", "coaching"),
+    ("למה יש כל כך הרבה תקלות?", "coaching"),
+    ("ספרי לי משהו", "coaching"),
+])
+def test_messages_are_routed_by_complexity(server, message, tier):
+    assert server.classify_chat_message(message) == tier
+
+def test_each_tier_uses_its_model_and_budget(server, user):
+    ack = server.build_ai_chat_request("תודה", "s1", [], user)
+    data = server.build_ai_chat_request("כמה תקלות פעילות יש?", "s1", [], user)
+    coaching = server.build_ai_chat_request("איך לשפר את המוטיבציה בצוות?", "s1", [], user)
+
+    assert (ack["tier"], ack["model"]) == ("ack", server.AI_CHAT_MODEL_LIGHT)
+    assert ack["ai_context"]["tokens"] == 0
+    assert (coaching["tier"], coaching["model"]) == ("coaching", server.AI_CHAT_MODEL_COACHING)
+    assert set(data["ai_context"]["sections"]) <= set(server.DEPARTMENT_CONTEXT_SECTIONS)
+
+def test_tier_metrics_are_recorded_per_tier(server):
+    metrics = server.ChatTierMetrics()
+    metrics.record("data", 100.0, 500, {"prompt_tokens": 1000, "cached_tokens": 800, "completion_tokens": 50})
+    metrics.record("data", 300.0, 500, {"prompt_tokens": 1000, "cached_tokens": 0, "completion_tokens": 50})
+    snapshot = metrics.snapshot()
+    assert list(snapshot) == ["data"]
+    assert (snapshot["data"]["calls"], snapshot["data"]["avg_cached_tokens"]) == (2, 400)
+
+@pytest.mark.parametrize("message", ["תוסיפי משימה למחר", "תוסיף תקלה בגנרטור", "הוסיפי אחזקה חודשית"])
+def test_add_command_forms_are_commands(server, message):
+    assert server.classify_chat_message(message) == "command"
@@ -0,0 +1,47 @@
+import json
+
+def read_events(response):
+    return [json.loads(line[len("data: "):]) for line in response.text.splitlines() if line.startswith("data: ")]
+
+def test_filter_hides_tags_split_across_chunks(server):
+    tag_filter = server.ActionTagStreamFilter()
+    chunks = ["רשמתי ", "את התקלה [ADD_FA", 'ILURE: system="מנוע", desc', 'ription="רעש [חזק]"] וסיימתי']
+    visible = "".join(tag_filter.feed(chunk) for chunk in chunks) + tag_filter.flush()
+    assert visible == "רשמתי את התקלה  וסיימתי"
+
+def test_filter_shows_brackets_that_are_not_tags(server):
+    tag_filter = server.ActionTagStreamFilter()
+    visible = tag_filter.feed("ראה [סעיף 3] ו[A") + tag_filter.feed("DDRESS]") + tag_filter.flush()
+    assert visible == "ראה [סעיף 3] ו[ADDRESS]"
+
+def test_filter_flushes_an_unterminated_tag(server):
+    tag_filter = server.ActionTagStreamFilter()
+    assert tag_filter.feed('סוף [UPDATE_FAILURE: status="נסגר') == "סוף "
+    assert tag_filter.flush() == '[UPDATE_FAILURE: status="נסגר'
+
+def test_stream_sends_tokens_done_and_actions(server, api, user):
+    response = api.post("/api/ai-chat/stream", json={"user_message": "נמצאה תקלה במשאבת הדלק, תרשמי אותה", "session_id": "s1"})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+
+    events = read_events(response)
+    assert [event["type"] for event in (events[0], events[-2], events[-1])] == ["start", "done", "actions"]
+    streamed = "".join(event["text"] for event in events if event["type"] == "token")
+    assert "[ADD_FAILURE" not in streamed
+    assert streamed.strip() == events[-2]["response"]
+    assert events[-1]["status"] == "done"
+    assert events[-1]["updated_tables"]
+    assert server.active_failures_collection.count_documents({"user_id": user['id']}) == 1
+
+def test_stream_reports_an_open_circuit_as_error_event(server, api, monkeypatch):
+    def unavailable():
+        raise server.LlmUnavailable("llm circuit is open")
+
+    monkeypatch.setattr(server.llm_circuit, "before_call", unavailable)
+    events = read_events(api.post("/api/ai-chat/stream", json={"user_message": "ספרי לי על הצוות שלי", "session_id": "s1"}))
+    assert events[-1] == {"type": "error", "response": server.LLM_UNAVAILABLE_MESSAGE}
+
+def test_fast_path_answers_stream_as_one_token(server, api):
+    events = read_events(api.post("/api/ai-chat/stream", json={"user_message": "כמה תקלות פעילות יש?", "session_id": "s1"}))
+    assert [event["type"] for event in events] == ["start", "token", "done"]
+    assert events[1]["text"] == events[2]["response"]
@@ -0,0 +1,62 @@
+from datetime import datetime, timedelta
+
+def insert_equipment(server, user_id, equipment_id, current_hours, usage_rate_per_day=None):
+    document = {
+        "id": equipment_id, "user_id": user_id, "system": f"מכלול {equipment_id}", "system_type": "גנרטורים",
+        "current_hours": current_hours, "usage_rate_per_day": usage_rate_per_day,
+        "last_reading_at": datetime.now().isoformat()
+    }
+    server.equipment_hours_collection.insert_one(server.calculate_service_hours(document))
+
+def test_equipment_due_by_forecast_within_days(server, user):
+    # 400 - 340 = 60 hours to service: outside a 50 hour window, but 6 days away at 10 h/day
+    insert_equipment(server, user['id'], "fast", 340, usage_rate_per_day=10.0)
+    # Same hours at 1 h/day is 60 days away
+    insert_equipment(server, user['id'], "slow", 340, usage_rate_per_day=1.0)
+
+    items = server.get_due_items(user['id'], within_days=7, within_hours=50)
+
+    assert [item['id'] for item in items] == ["fast"]
+    assert items[0]['due_by'] == "forecast"
+    assert items[0]['days_until_service'] == 6
+    assert items[0]['predicted_service_date'] == (datetime.now() + timedelta(days=6)).isoformat()[:10]
+
+def test_missing_stored_forecast_is_filled_by_the_recompute_job(server, user):
+    insert_equipment(server, user['id'], "gen", 390, usage_rate_per_day=10.0)
+    server.equipment_hours_collection.update_one({"id": "gen"}, {"$unset": {"predicted_service_date": 1}})
+
+    items = server.get_due_items(user['id'], within_days=7, within_hours=50)
+    assert items[0]['due_by'] == "hours"
+    assert items[0]['predicted_service_date'] is None
+
+    server.recompute_derived_fields()
+    items = server.get_due_items(user['id'], within_days=7, within_hours=50)
+    assert items[0]['predicted_service_date'] == (datetime.now() + timedelta(days=1)).isoformat()[:10]
+
+def test_due_route_ranks_maintenance_and_equipment(server, api, user):
+    today = datetime.now().date()
+    server.pending_maintenance_collection.insert_one({
+        "id": "m1", "user_id": user['id'], "maintenance_type": "החלפת שמן", "system": "מנוע",
+        "next_due": (today - timedelta(days=2)).isoformat(), "status": "ממתין"
+    })
+    insert_equipment(server, user['id'], "gen", 380)
+
+    body = api.get("/api/due", params={"within_days": 7, "within_hours": 50}).json()
+
+    assert body['counts'] == {"maintenance": 1, "equipment": 1}
+    assert [item['id'] for item in body['items']] == ["m1", "gen"]
+    assert body['items'][1]['predicted_service_date'] is None
+
+def test_completed_maintenance_is_not_due(server, api, user):
+    overdue = (datetime.now().date() - timedelta(days=3)).isoformat()
+    server.pending_maintenance_collection.insert_many([
+        {"id": "done", "user_id": user['id'], "maintenance_type": "החלפת מסנן", "system": "מזגן",
+         "next_due": overdue, "status": "הושלם"},
+        {"id": "open", "user_id": user['id'], "maintenance_type": "החלפת שמן", "system": "מנוע",
+         "next_due": overdue, "status": "ממתין"},
+    ])
+
+    assert [item['id'] for item in server.get_due_items(user['id'], within_days=0, within_hours=0)] == ["open"]
+    assert api.get("/api/due").json()['counts']['maintenance'] == 1
+    answer = server.answer_overdue_maintenance(user['id'], None)
+    assert "החלפת שמן" in answer and "החלפת מסנן" not in answer
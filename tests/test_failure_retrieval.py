@@ -0,0 +1,60 @@
+RESOLVED = [
+    ("R1", "משאבת דלק", "נזילת דלק מהאטם של המשאבה", "החלפת אטם", "לבדוק אטמים כל חודש"),
+    ("R2", "גנרטור 2", "הגנרטור לא מתניע בבוקר", "החלפת מצבר", "בדיקת מתח מצבר שבועית"),
+    ("R3", "מזגן חדר מכונות", "המזגן לא מקרר", "מילוי גז", ""),
+]
+
+def insert_resolved(server, user_id, rows=RESOLVED):
+    server.resolved_failures_collection.insert_many([
+        {"id": f"{user_id}-{number}", "user_id": user_id, "failure_number": number, "system": system,
+         "description": description, "resolution_method": method, "lessons_learned": lessons,
+         "resolved_date": "2025-03-01", "resolved_at": f"2025-03-01T08:0{index}:00"}
+        for index, (number, system, description, method, lessons) in enumerate(rows)
+    ])
+
+def search(server, user_id, text, **kwargs):
+    version = server.get_data_versions(user_id)["resolved_failures"]
+    return server.resolved_failure_index.search(user_id, text, version, **kwargs)
+
+def test_hebrew_normalization(server):
+    assert server.normalize_hebrew('צה"ל, שָׁלוֹם!') == "צהל שלומ"
+
+def test_most_similar_failure_ranks_first(server, user):
+    insert_resolved(server, user['id'])
+    results = search(server, user['id'], "יש נזילה של דלק ליד המשאבה")
+    assert results[0]["failure_number"] == "R1"
+    assert all(result["score"] >= server.RETRIEVAL_MIN_SCORE for result in results)
+
+def test_unrelated_message_finds_nothing(server, user):
+    insert_resolved(server, user['id'])
+    assert search(server, user['id'], "מתי הפגישה עם המפקד") == []
+
+def test_other_users_failures_are_not_returned(server, user):
+    insert_resolved(server, "other-user")
+    assert search(server, user['id'], "נזילת דלק מהמשאבה") == []
+
+def test_newly_resolved_failure_is_found_without_reload(server, user):
+    insert_resolved(server, user['id'])
+    search(server, user['id'], "נזילת דלק")  # Load the index
+
+    failure = {"id": "f-9", "user_id": user['id'], "failure_number": "F9", "date": "2025-03-02", "system": "מדחס אוויר",
+               "description": "רעידות חזקות במדחס", "urgency": 3, "assignee": "דני", "estimated_hours": 2,
+               "status": "פעיל", "created_at": "2025-03-02T08:00:00"}
+    server.active_failures_collection.insert_one(dict(failure))
+    results = server.run_ai_actions([("update_failure", {"failure_number": "F9", "status": "נסגר"})], user['id'])
+    server.apply_ai_action_results(results, user['id'])
+
+    assert search(server, user['id'], "רעידות במדחס האוויר")[0]["failure_number"] == "F9"
+
+def test_external_edit_reloads_the_index(server, user):
+    insert_resolved(server, user['id'])
+    search(server, user['id'], "נזילת דלק")
+    server.resolved_failures_collection.delete_one({"failure_number": "R1"})
+    server.bump_data_version(user['id'], "resolved_failures")
+    assert all(result["failure_number"] != "R1" for result in search(server, user['id'], "נזילת דלק מהמשאבה"))
+
+def test_similar_failures_reach_the_prompt(server, user):
+    insert_resolved(server, user['id'])
+    request = server.build_ai_chat_request("יש נזילה של דלק ליד המשאבה, מה עושים?", "s1", [], user)
+    assert request["similar_failures"][0] == "R1"
+    assert "החלפת אטם" in request["system_message"]
@@ -0,0 +1,50 @@
+EQUIPMENT = {"system": "מנוע ראשי", "system_type": "מנועים", "current_hours": 100.0}
+
+def create_equipment(api, **fields):
+    response = api.post("/api/equipment", json={**EQUIPMENT, **fields})
+    assert response.status_code == 200
+    return response.json()['id']
+
+def reading_count(server, equipment_id):
+    return server.equipment_hour_readings_collection.count_documents({"meta.equipment_id": equipment_id})
+
+def test_put_without_hours_change_records_no_reading(server, api):
+    equipment_id = create_equipment(api)
+    before = server.equipment_hours_collection.find_one({"id": equipment_id})
+
+    response = api.put(f"/api/equipment/{equipment_id}", json={**EQUIPMENT, "system": "מנוע ראשי ימני"})
+    assert response.status_code == 200
+
+    after = server.equipment_hours_collection.find_one({"id": equipment_id})
+    assert after['system'] == "מנוע ראשי ימני"
+    assert after['last_reading_at'] == before['last_reading_at']
+    assert reading_count(server, equipment_id) == 1  # Only the reading from create
+
+def test_put_with_new_hours_records_a_reading(server, api):
+    equipment_id = create_equipment(api)
+    api.put(f"/api/equipment/{equipment_id}", json={**EQUIPMENT, "current_hours": 140.0})
+    assert reading_count(server, equipment_id) == 2
+
+def test_put_unknown_equipment_is_404(server, api):
+    response = api.put("/api/equipment/missing", json=EQUIPMENT)
+    assert response.status_code == 404
+
+def test_ai_update_with_same_hours_records_no_reading(server, api, user):
+    equipment_id = create_equipment(api)
+    results = server.run_ai_actions([("update_equipment", {"id": equipment_id, "current_hours": "100"})], user['id'])
+    assert results[0]['status'] == 'ok'
+    assert reading_count(server, equipment_id) == 1
+
+    server.run_ai_actions([("update_equipment", {"id": equipment_id, "current_hours": "130"})], user['id'])
+    assert reading_count(server, equipment_id) == 2
+
+def test_ingest_rejects_unknown_and_negative_readings(server, api, user):
+    equipment_id = create_equipment(api)
+    result = server.ingest_hour_readings(user['id'], [
+        {"equipment_id": equipment_id, "hours": 120.0, "timestamp": "2030-01-01T08:00:00"},
+        {"equipment_id": equipment_id, "hours": -1.0},
+        {"equipment_id": "missing", "hours": 10.0},
+    ])
+    assert result['accepted'] == 1
+    assert sorted(item['reason'] for item in result['rejected']) == ["equipment not found", "negative hours"]
+    assert server.equipment_hours_collection.find_one({"id": equipment_id})['current_hours'] == 120.0
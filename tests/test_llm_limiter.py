@@ -0,0 +1,76 @@
+import asyncio
+
+import pytest
+
+def test_calls_beyond_the_queue_are_rejected(server):
+    limiter = server.LlmConcurrencyLimiter(max_concurrency=1, max_queue=1, queue_timeout=5)
+
+    async def scenario():
+        release = asyncio.Event()
+
+        async def hold():
+            async with limiter.slot():
+                await release.wait()
+
+        running = asyncio.create_task(hold())
+        queued = asyncio.create_task(hold())
+        while limiter.active < 1:
+            await asyncio.sleep(0)
+        try:
+            assert (limiter.active, limiter.waiting) == (1, 1)
+            with pytest.raises(server.LlmQueueFull):
+                async with limiter.slot():
+                    pass
+        finally:
+            release.set()
+            await asyncio.gather(running, queued)
+
+    asyncio.run(scenario())
+    assert (limiter.completed, limiter.rejected) == (2, 1)
+    assert limiter.metrics()["active"] == 0
+
+def test_queued_call_gives_up_after_the_timeout(server):
+    limiter = server.LlmConcurrencyLimiter(max_concurrency=1, max_queue=5, queue_timeout=0.01)
+
+    async def scenario():
+        async with limiter.slot():
+            with pytest.raises(server.LlmQueueFull):
+                async with limiter.slot():
+                    pass
+
+    asyncio.run(scenario())
+    assert limiter.waiting == 0 and limiter.rejected == 1
+
+def test_session_turns_run_one_at_a_time(server):
+    limiter = server.LlmConcurrencyLimiter()
+    events = []
+
+    async def turn(name):
+        async with limiter.session("u1", "s1"):
+            events.append(f"{name} start")
+            await asyncio.sleep(0.01)
+            events.append(f"{name} end")
+
+    async def scenario():
+        first = asyncio.create_task(turn("first"))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(turn("second"))
+        await asyncio.sleep(0)
+        with pytest.raises(server.LlmQueueFull):
+            limiter.check_capacity("u1", "s1")  # Two turns of the session already pending
+        limiter.check_capacity("u1", "s2")
+        await asyncio.gather(first, second)
+
+    asyncio.run(scenario())
+    assert events == ["first start", "first end", "second start", "second end"]
+    assert limiter.metrics()["sessions_in_progress"] == 0
+
+def test_full_queue_is_a_429_with_retry_after(server, api, monkeypatch):
+    def full(user_id, session_id):
+        raise server.LlmQueueFull(retry_after=7)
+
+    monkeypatch.setattr(server.llm_limiter, "check_capacity", full)
+    for path in ("/api/ai-chat", "/api/ai-chat/stream"):
+        response = api.post(path, json={"user_message": "שלום", "session_id": "s1"})
+        assert response.status_code == 429
+        assert response.headers["Retry-After"] == "7"
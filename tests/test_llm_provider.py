@@ -0,0 +1,36 @@
+import asyncio
+
+import pytest
+
+def test_provider_without_stream_fails_at_instantiation(server):
+    class CompleteOnly(server.LlmProvider):
+        name = "partial"
+
+        async def complete(self, system_message, user_message, session_id, model=None, usage=None):
+            return ""
+
+    with pytest.raises(TypeError):
+        CompleteOnly()
+
+def test_base_provider_cannot_be_instantiated(server):
+    with pytest.raises(TypeError):
+        server.LlmProvider()
+
+def test_registered_providers_are_complete(server):
+    for provider_class in server.LLM_PROVIDERS.values():
+        assert not provider_class.__abstractmethods__
+
+def test_unknown_provider_name_is_rejected(server):
+    with pytest.raises(ValueError):
+        server.create_llm_provider("missing")
+
+def test_stub_provider_streams_what_it_completes(server):
+    provider = server.create_llm_provider("stub")
+
+    async def both():
+        whole = await provider.complete("system", "מה מצב המנועים?", "session-1")
+        chunks = [chunk async for chunk in provider.stream("system", "מה מצב המנועים?")]
+        return whole, "".join(chunks)
+
+    whole, streamed = asyncio.run(both())
+    assert whole and whole == streamed
@@ -0,0 +1,113 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+@pytest.fixture
+def half_open(server, monkeypatch):
+    """Breaker opened long enough ago that the next call is the trial"""
+    monkeypatch.setattr(server, "LLM_RETRY_BASE_SECONDS", 0)
+    breaker = server.llm_circuit
+    breaker.state = "open"
+    breaker.failures = breaker.failure_threshold
+    breaker.opened_at = datetime.now() - timedelta(seconds=breaker.reset_seconds + 1)
+    return breaker
+
+async def ok():
+    return "ok"
+
+def test_cancelled_trial_call_frees_the_trial_slot(server, half_open):
+    async def scenario():
+        started = asyncio.Event()
+
+        async def hang():
+            started.set()
+            await asyncio.sleep(60)
+
+        task = asyncio.create_task(server.call_llm(hang))
+        await started.wait()
+        assert half_open.state == "half_open" and half_open._trial_in_flight
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+        assert not half_open._trial_in_flight
+        return await server.call_llm(ok)
+
+    assert asyncio.run(scenario()) == "ok"
+    assert half_open.state == "closed"
+
+def test_closed_trial_stream_frees_the_trial_slot(server, half_open):
+    async def tokens():
+        yield "שלום"
+        await asyncio.sleep(60)
+        yield "עולם"
+
+    async def tokens_done():
+        yield "תשובה"
+
+    async def scenario():
+        stream = server.stream_llm(tokens)
+        assert await stream.__anext__() == "שלום"
+        await stream.aclose()  # The client went away mid-answer
+
+        assert not half_open._trial_in_flight
+        return [token async for token in server.stream_llm(tokens_done)]
+
+    assert asyncio.run(scenario()) == ["תשובה"]
+    assert half_open.state == "closed"
+
+def test_non_retryable_error_frees_the_trial_slot(server, half_open):
+    async def bad_request():
+        raise ValueError("invalid request")
+
+    with pytest.raises(ValueError):
+        asyncio.run(server.call_llm(bad_request))
+    assert half_open.state == "half_open" and not half_open._trial_in_flight
+    assert asyncio.run(server.call_llm(ok)) == "ok"
+
+def test_second_call_during_trial_fails_fast(server, half_open):
+    async def scenario():
+        started = asyncio.Event()
+
+        async def slow():
+            started.set()
+            await asyncio.sleep(0.05)
+            return "trial"
+
+        trial = asyncio.create_task(server.call_llm(slow))
+        await started.wait()
+        with pytest.raises(server.LlmUnavailable):
+            await server.call_llm(ok)
+        return await trial
+
+    assert asyncio.run(scenario()) == "trial"
+
+def test_retryable_errors_are_retried(server, monkeypatch):
+    monkeypatch.setattr(server, "LLM_RETRY_BASE_SECONDS", 0)
+    attempts = []
+
+    async def flaky():
+        attempts.append(1)
+        if len(attempts) < 2:
+            raise asyncio.TimeoutError()
+        return "ok"
+
+    assert asyncio.run(server.call_llm(flaky)) == "ok"
+    assert len(attempts) == 2
+    assert server.llm_circuit.state == "closed" and server.llm_circuit.failures == 0
+
+def test_circuit_opens_after_threshold(server, monkeypatch):
+    monkeypatch.setattr(server, "LLM_RETRY_BASE_SECONDS", 0)
+
+    async def down():
+        raise asyncio.TimeoutError()
+
+    breaker = server.llm_circuit
+    while breaker.state != "open":
+        # The retry that finds the circuit open fails fast instead
+        with pytest.raises((asyncio.TimeoutError, server.LlmUnavailable)):
+            asyncio.run(server.call_llm(down))
+    assert breaker.failures >= breaker.failure_threshold
+    with pytest.raises(server.LlmUnavailable):
+        asyncio.run(server.call_llm(ok))
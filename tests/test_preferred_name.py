@@ -0,0 +1,44 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from fastapi.security import HTTPAuthorizationCredentials
+
+def profile(server, user_id):
+    return server.authenticated_users_collection.find_one({"id": user_id}, {"_id": 0})
+
+def test_history_backfill_runs_once_without_a_name(server, user):
+    assert server.get_preferred_name(profile(server, user['id'])) is None
+    assert profile(server, user['id'])['preferred_name_checked'] is True
+
+    # A later match in the history is not searched for again
+    server.ai_chat_history_collection.insert_one({"user_id": user['id'], "ai_response": "נעים מאוד! אני אקרא לך: דנה", "timestamp": "2025-01-01T10:00:00"})
+    assert server.get_preferred_name(profile(server, user['id'])) is None
+
+def test_history_backfill_stores_the_name(server, user):
+    server.ai_chat_history_collection.insert_one({"user_id": user['id'], "ai_response": "נעים מאוד! אני אקרא לך: דנה", "timestamp": "2025-01-01T10:00:00"})
+    assert server.get_preferred_name(profile(server, user['id'])) == "דנה"
+    assert profile(server, user['id'])['preferred_name'] == "דנה"
+
+def test_stored_name_is_used_without_history(server, user):
+    server.set_preferred_name(user['id'], "רונן")
+    assert server.get_preferred_name(profile(server, user['id'])) == "רונן"
+
+def authenticate(server, user):
+    token = server.create_access_token({"sub": user['email'], "user_id": user['id']})
+    credentials = HTTPAuthorizationCredentials(scheme="Bearer", credentials=token)
+    return asyncio.run(server.get_current_user(credentials))
+
+def test_cached_inactive_user_is_rejected(server, user):
+    assert authenticate(server, user)['id'] == user['id']
+    server.user_cache.set(user['id'], {**user, "is_active": False})
+    with pytest.raises(HTTPException) as error:
+        authenticate(server, user)
+    assert error.value.status_code == 401
+
+def test_deactivated_user_is_rejected_after_cache_invalidation(server, user):
+    authenticate(server, user)
+    server.authenticated_users_collection.update_one({"id": user['id']}, {"$set": {"is_active": False}})
+    server.user_cache.invalidate(user['id'])
+    with pytest.raises(HTTPException):
+        authenticate(server, user)
@@ -0,0 +1,45 @@
+import asyncio
+
+import pytest
+
+QUESTION = "ספרי לי על הצוות שלי"
+FAILURE = {"failure_number": "F1", "date": "2025-03-01", "system": "מנוע ראשי", "description": "רעש חריג",
+           "urgency": 4, "assignee": "רונן", "estimated_hours": 2}
+
+@pytest.fixture
+def named_user(server, user, monkeypatch):
+    """Cache enabled, for a user whose name is known (first-interaction replies are never cached)"""
+    monkeypatch.setattr(server, "AI_RESPONSE_CACHE_ENABLED", True)
+    server.authenticated_users_collection.update_one({"id": user['id']}, {"$set": {"preferred_name": "רונן"}})
+    return {**user, "preferred_name": "רונן"}
+
+def ask(server, user, message=QUESTION, use_cache=True):
+    return asyncio.run(server.create_yahel_ai_agent(message, "s1", [], user, use_cache=use_cache))
+
+def test_repeated_question_is_answered_from_cache(server, named_user):
+    first = ask(server, named_user)
+    second = ask(server, named_user)
+    assert first.intent is None
+    assert (second.intent, second.response) == ("response_cache", first.response)
+
+def test_data_change_invalidates_the_cached_reply(server, api, named_user):
+    ask(server, named_user)
+    api.post("/api/failures", json=FAILURE)
+    assert ask(server, named_user).intent is None
+
+def test_bypass_skips_the_cache(server, named_user):
+    ask(server, named_user)
+    assert ask(server, named_user, use_cache=False).intent is None
+
+def test_replies_with_actions_are_not_cached(server, named_user):
+    message = "נמצאה תקלה במשאבת הדלק, תרשמי אותה"
+    ask(server, named_user, message)
+    assert ask(server, named_user, message).intent is None
+
+def test_cache_is_off_by_default(server, user):
+    assert not server.is_response_cacheable(QUESTION, user)
+
+def test_entries_expire(server):
+    cache = server.ResponseCache(ttl_seconds=0)
+    cache.set(("u1", "שאלה"), "תשובה")
+    assert cache.get(("u1", "שאלה")) is None
@@ -0,0 +1,37 @@
+FAILURE = {"failure_number": "F1", "date": "2025-03-01", "system": "משאבת דלק", "description": "נזילה מהאטם של המשאבה",
+           "urgency": 4, "assignee": "רונן", "estimated_hours": 2}
+
+def test_prefix_letters_are_stripped(server):
+    assert server.hebrew_prefix_variants("והמנוע") == ["והמנוע", "המנוע", "מנוע"]
+    assert server.hebrew_prefix_variants("בו") == ["בו"]
+
+def test_search_finds_words_with_prefixes_and_highlights_them(server, api, user):
+    api.post("/api/failures", json=FAILURE)
+    response = api.get("/api/search", params={"q": "משאבה"})
+    assert response.status_code == 200
+    body = response.json()
+    assert body["total"] == 1
+    result = body["results"][0]
+    assert (result["source"], result["title"]) == ("failures", "F1 - משאבת דלק")
+    description = next(highlight for highlight in result["highlights"] if highlight["field"] == "description")
+    assert [description["text"][start:end] for start, end in description["matches"]] == ["המשאבה"]
+
+def test_every_term_must_match(server, api, user):
+    api.post("/api/failures", json=FAILURE)
+    assert api.get("/api/search", params={"q": "נזילה דלק"}).json()["total"] == 1
+    assert api.get("/api/search", params={"q": "נזילה גנרטור"}).json()["total"] == 0
+
+def test_new_documents_are_found_after_a_write(server, api, user):
+    assert api.get("/api/search", params={"q": "נזילה"}).json()["total"] == 0
+    api.post("/api/failures", json=FAILURE)
+    assert api.get("/api/search", params={"q": "נזילה"}).json()["total"] == 1
+
+def test_other_users_documents_are_not_searched(server, api, user):
+    server.active_failures_collection.insert_one({**FAILURE, "id": "f-other", "user_id": "other-user"})
+    assert api.get("/api/search", params={"q": "נזילה"}).json()["total"] == 0
+
+def test_sources_filter_and_validation(server, api, user):
+    api.post("/api/failures", json=FAILURE)
+    assert api.get("/api/search", params={"q": "נזילה", "sources": "daily_work"}).json()["total"] == 0
+    assert api.get("/api/search", params={"q": "נזילה", "sources": "emails"}).status_code == 400
+    assert api.get("/api/search", params={"q": "נזילה", "limit": 0}).status_code == 400
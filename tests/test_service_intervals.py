@@ -0,0 +1,57 @@
+import pytest
+
+def test_batch_matches_per_item_rules(server):
+    items = [
+        {"system_type": "מנועים", "current_hours": 0},
+        {"system_type": "מנועים", "current_hours": 250},  # Exactly on a boundary - next interval
+        {"system_type": "מנועים", "current_hours": 5995.5},
+        {"system_type": "גנרטורים", "current_hours": 18000},  # Past the last interval
+        {"system_type": "משאבות", "current_hours": 990},  # Unknown type - fallback table
+    ]
+    server.calculate_service_hours_batch(items)
+    assert [(item['next_service_hours'], item['hours_until_service'], item['alert_level']) for item in items] == [
+        (250, 250, "ירוק"),
+        (500, 250, "ירוק"),
+        (6000, 4.5, "אדום"),
+        (36000, 18000, "ירוק"),
+        (1000, 10, "אדום"),
+    ]
+
+def test_batch_keeps_int_and_float_types(server):
+    items = [
+        {"system_type": "מדחסים", "current_hours": 150},
+        {"system_type": "מדחסים", "current_hours": 150.0},
+    ]
+    server.calculate_service_hours_batch(items)
+    assert type(items[0]['next_service_hours']) is int and type(items[0]['hours_until_service']) is int
+    assert type(items[1]['next_service_hours']) is int and type(items[1]['hours_until_service']) is float
+
+def test_batch_forecasts_service_date_from_usage_rate(server):
+    item = {"system_type": "מדחסים", "current_hours": 100, "usage_rate_per_day": 10.0,
+            "last_reading_at": "2025-03-01T08:00:00"}
+    server.calculate_service_hours(item)
+    assert item['predicted_service_date'] == "2025-03-11"
+
+def test_update_intervals_requires_admin(server, api):
+    response = api.put("/api/service-intervals", json={"system_type": "משאבות", "intervals": [100, 300]})
+    assert response.status_code == 403
+    assert server.service_intervals_collection.count_documents({}) == 0
+
+def test_admin_update_reaches_other_workers(server, api, user, monkeypatch):
+    monkeypatch.setattr(server, "ADMIN_EMAILS", {user['email']})
+    # Another worker's engine, already holding the default tables
+    other_worker = server.ServiceIntervalEngine(server.service_intervals_collection, server.data_versions_collection, check_seconds=0)
+    assert other_worker.get_tables().get("משאבות") is None
+
+    response = api.put("/api/service-intervals", json={"system_type": "משאבות", "intervals": [300, 100]})
+    assert response.status_code == 200
+
+    assert other_worker.get_tables()["משאבות"] == [100, 300]
+    item = other_worker.calculate_batch([{"system_type": "משאבות", "current_hours": 120}])[0]
+    assert item['next_service_hours'] == 300
+
+@pytest.mark.parametrize("intervals", [[], [0, 100], [-5]])
+def test_update_intervals_rejects_non_positive(server, api, user, monkeypatch, intervals):
+    monkeypatch.setattr(server, "ADMIN_EMAILS", {user['email']})
+    response = api.put("/api/service-intervals", json={"system_type": "משאבות", "intervals": intervals})
+    assert response.status_code == 400
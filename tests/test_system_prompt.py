@@ -0,0 +1,30 @@
+from datetime import datetime
+
+FAILURE = {"failure_number": "F1", "date": "2025-03-01", "system": "מנוע ראשי", "description": "רעש חריג",
+           "urgency": 4, "assignee": "רונן", "estimated_hours": 2}
+
+def test_every_prompt_starts_with_the_same_static_prefix(server, api, user):
+    api.post("/api/failures", json=FAILURE)
+    other = {"id": "other-user", "email": "other@yahel-naval.com", "name": "Other", "is_active": True}
+    prompts = [
+        server.build_ai_chat_request("מה מצב התקלות?", "s1", [], user)["system_message"],
+        server.build_ai_chat_request("איך לשפר את המוטיבציה בצוות?", "s2", [], other)["system_message"],
+        server.build_ai_chat_request("תודה", None, [], None)["system_message"],
+    ]
+    for prompt in prompts:
+        assert prompt.startswith(server.JESSICA_STATIC_PROMPT)
+    assert "F1|" in prompts[0] and "F1|" not in prompts[1]
+
+def test_static_prefix_has_no_dynamic_content(server):
+    assert datetime.now().isoformat()[:10] not in server.JESSICA_STATIC_PROMPT
+    assert "{" not in server.JESSICA_STATIC_PROMPT  # No template placeholders
+
+def test_user_section_asks_for_the_name_only_on_first_interaction(server):
+    assert "איך אתה רוצה שאני אקרא לך" in server.build_user_prompt_section(None, True)
+    named = server.build_user_prompt_section("רונן", False)
+    assert "פנה אליו בשם רונן" in named and "איך אתה רוצה" not in named
+
+def test_cached_prefix_tokens_are_recorded(server):
+    usage = {"prompt_tokens": 3000, "completion_tokens": 200, "prompt_tokens_details": {"cached_tokens": 2048}}
+    assert server.record_prompt_usage(usage) == {"prompt_tokens": 3000, "cached_tokens": 2048, "completion_tokens": 200}
+    assert server.record_prompt_usage({}) == {}
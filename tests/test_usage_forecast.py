@@ -0,0 +1,65 @@
+from datetime import datetime, timedelta
+
+EQUIPMENT = {"system": "גנרטור 1", "system_type": "גנרטורים", "current_hours": 100.0}
+
+def insert_equipment(server, user_id):
+    """Equipment last read a week ago, without readings of its own"""
+    document = {**EQUIPMENT, "id": "eq-1", "user_id": user_id, "created_at": "2025-01-01T00:00:00",
+                "last_reading_at": (datetime.now() - timedelta(days=7)).isoformat()}
+    server.equipment_hours_collection.insert_one(server.calculate_service_hours(document))
+    return document['id']
+
+def ingest_daily_readings(server, user_id, equipment_id, start_hours=100.0, per_day=10.0, days=5):
+    """One reading a day ending now, advancing per_day hours each day"""
+    now = datetime.now().replace(microsecond=0) + timedelta(minutes=1)
+    readings = [
+        {"equipment_id": equipment_id, "hours": start_hours + per_day * day,
+         "timestamp": (now - timedelta(days=days - 1 - day)).isoformat()}
+        for day in range(days)
+    ]
+    return server.ingest_hour_readings(user_id, readings)
+
+def test_fit_usage_rates_needs_two_readings_over_a_day(server):
+    now = datetime(2025, 3, 1, 8)
+    readings = [
+        {"meta": {"equipment_id": "a"}, "timestamp": now, "hours": 100.0},
+        {"meta": {"equipment_id": "a"}, "timestamp": now + timedelta(days=2), "hours": 120.0},
+        {"meta": {"equipment_id": "b"}, "timestamp": now, "hours": 50.0},
+        {"meta": {"equipment_id": "b"}, "timestamp": now + timedelta(hours=3), "hours": 53.0},
+    ]
+    rates = server.fit_usage_rates(readings)
+    assert rates["a"] == (10.0, 2)
+    assert rates["b"] == (None, 2)
+
+def test_ingested_readings_persist_rate_and_predicted_date(server, api, user):
+    equipment_id = insert_equipment(server, user['id'])
+    ingest_daily_readings(server, user['id'], equipment_id)
+
+    stored = server.equipment_hours_collection.find_one({"id": equipment_id})
+    assert stored['current_hours'] == 140.0
+    assert stored['usage_rate_per_day'] == 10.0
+    # 400 - 140 = 260 hours to the next service at about 10 hours a day
+    expected = (datetime.fromisoformat(stored['last_reading_at']) + timedelta(days=260 / stored['usage_rate_per_day'])).isoformat()[:10]
+    assert stored['predicted_service_date'] == expected
+
+def test_put_of_other_fields_keeps_the_forecast(server, api, user):
+    equipment_id = insert_equipment(server, user['id'])
+    ingest_daily_readings(server, user['id'], equipment_id)
+    before = server.equipment_hours_collection.find_one({"id": equipment_id})
+
+    api.put(f"/api/equipment/{equipment_id}", json={**EQUIPMENT, "current_hours": 140.0, "last_service_date": "2025-01-01"})
+
+    after = server.equipment_hours_collection.find_one({"id": equipment_id})
+    assert after['usage_rate_per_day'] == before['usage_rate_per_day']
+    assert after['predicted_service_date'] == before['predicted_service_date']
+    assert after['created_at'] == before['created_at']
+
+def test_recompute_fills_missing_predicted_date(server, user):
+    server.equipment_hours_collection.insert_one({
+        "id": "eq-1", "user_id": user['id'], "system": "מדחס", "system_type": "מדחסים",
+        "current_hours": 100, "usage_rate_per_day": 20.0, "last_reading_at": "2025-03-01T08:00:00",
+        "next_service_hours": 200, "hours_until_service": 100, "alert_level": "ירוק"
+    })
+    result = server.recompute_derived_fields()
+    assert result['equipment_updated'] == 1
+    assert server.equipment_hours_collection.find_one({"id": "eq-1"})['predicted_service_date'] == "2025-03-06"
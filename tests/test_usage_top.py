@@ -0,0 +1,43 @@
+from datetime import datetime
+
+OTHER_USER = {"id": "other-user", "email": "other@yahel-naval.com", "name": "Other User", "is_active": True}
+
+def seed_usage(server, user_id, prompt_tokens):
+    server.record_llm_usage(user_id, "full", {"prompt_tokens": prompt_tokens, "completion_tokens": 50}, 100, 250.0)
+    server.ai_chat_history_collection.insert_one({
+        "id": f"chat-{user_id}", "user_id": user_id, "session_id": f"session-{user_id}",
+        "timestamp": datetime.now().isoformat(), "user_message": f"הודעה פרטית של {user_id}",
+        "ai_response": "תשובה", "prompt_tokens": prompt_tokens, "completion_tokens": 50
+    })
+
+def test_non_admin_sees_only_own_usage(server, api, user):
+    server.authenticated_users_collection.insert_one(dict(OTHER_USER))
+    seed_usage(server, user['id'], 1000)
+    seed_usage(server, OTHER_USER['id'], 5000)
+
+    response = api.get("/api/ai-usage/top")
+    assert response.status_code == 200
+    body = response.json()
+    assert [row['user_id'] for row in body['heaviest_users']] == [user['id']]
+    assert [row['user_id'] for row in body['heaviest_prompts']] == [user['id']]
+
+def test_admin_sees_every_user(server, api, user, monkeypatch):
+    monkeypatch.setattr(server, "ADMIN_EMAILS", {user['email']})
+    server.authenticated_users_collection.insert_one(dict(OTHER_USER))
+    seed_usage(server, user['id'], 1000)
+    seed_usage(server, OTHER_USER['id'], 5000)
+
+    body = api.get("/api/ai-usage/top").json()
+    assert [(row['user_id'], row['name']) for row in body['heaviest_users']] == [
+        (OTHER_USER['id'], OTHER_USER['name']), (user['id'], user['name'])
+    ]
+    assert [row['prompt_tokens'] for row in body['heaviest_prompts']] == [5000, 1000]
+
+def test_prompt_text_is_never_returned(server, api, user, monkeypatch):
+    monkeypatch.setattr(server, "ADMIN_EMAILS", {user['email']})
+    seed_usage(server, user['id'], 1000)
+
+    body = api.get("/api/ai-usage/top").json()
+    assert body['heaviest_prompts']
+    for record in body['heaviest_prompts']:
+        assert "user_message" not in record and "ai_response" not in record